@@ -1,8 +1,61 @@
 from abc import ABC, abstractmethod
-from typing import Any, Dict
+import asyncio
+from collections import defaultdict
+import time
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict
+
+from loguru import logger
+
+
+class DisconnectChecker:
+    """按时间间隔检查客户端是否已断开，避免每个 token 都查询一次连接状态"""
+
+    def __init__(self, request, interval: float = 0.5):
+        self.request = request
+        self.interval = interval
+        self.next_check = time.monotonic() + interval
+
+    async def __call__(self) -> bool:
+        if self.request is None:
+            return False
+        now = time.monotonic()
+        if now < self.next_check:
+            return False
+        self.next_check = now + self.interval
+        return await self.request.is_disconnected()
 
 
 class ModelBackend(ABC):
+    # 按模型统计因客户端断开而中止的请求数
+    cancelled_requests: Dict[str, int] = defaultdict(int)
+
     @abstractmethod
     def stream_chat(self, params: Dict[str, Any]):
         pass
+
+    @staticmethod
+    def record_cancel(params: Dict[str, Any]):
+        ModelBackend.cancelled_requests[params.get("model", "")] += 1
+        logger.warning(f"request_id : {params.get('request_id')} 客户端已断开，已中止！")
+
+    async def iterate_with_cancel(
+        self,
+        generator: AsyncIterator,
+        params: Dict[str, Any],
+        abort: Callable[[], Awaitable[Any]],
+    ):
+        """迭代后端的输出，客户端断开或请求被取消时调用 abort 中止后端的生成"""
+        is_disconnected = DisconnectChecker(params.get("request", None))
+        try:
+            async for output in generator:
+                yield output
+                if await is_disconnected():
+                    break
+            else:
+                return
+        except (asyncio.CancelledError, GeneratorExit):
+            await abort()
+            self.record_cancel(params)
+            raise
+        await abort()
+        self.record_cancel(params)
@@ -3,17 +3,19 @@ import torch
 import os
 import json
 from peft import PeftModel
-from transformers import TextIteratorStreamer
 from transformers.generation.logits_process import LogitsProcessorList
 from threading import Thread
-from gpt_server.model_backend.base import ModelBackend
+from gpt_server.model_backend.base import DisconnectChecker, ModelBackend
+from gpt_server.model_backend.hf_batching import ContinuousBatchingEngine
 from gpt_server.model_backend.utils import (
+    AsyncTextStreamer,
     InvalidScoreLogitsProcessor,
+    get_stop_matcher,
+    load_warmup_schemas,
     StoppingCriteriaList,
     StopAtSpecificTokenCriteria,
     XgrammarLogitsProcessor,
 )
-import asyncio
 from loguru import logger
 
 invalid_score_processor = InvalidScoreLogitsProcessor()
@@ -32,6 +34,9 @@ class HFBackend(ModelBackend):
         self.model = model
         self.tokenizer = tokenizer
         self.xgrammar_processor = XgrammarLogitsProcessor(tokenizer)
+        self.xgrammar_processor.warmup(
+            load_warmup_schemas(os.getenv("grammar_warmup_schemas", None))
+        )
         self.lora_requests = []
         lora = os.getenv("lora", None)
         if lora:
@@ -52,6 +57,18 @@ class HFBackend(ModelBackend):
                     )
                     continue
                 self.model.load_adapter(model_id=lora_path, adapter_name=lora_name)
+        # max_num_seqs 大于 0 时使用连续批处理，所有请求共享一个解码循环
+        self.engine = None
+        max_num_seqs = int(os.getenv("max_num_seqs", "0") or 0)
+        if max_num_seqs > 0:
+            if self.lora_requests:
+                logger.warning("使用 lora 时不支持连续批处理，每个请求单独生成")
+            else:
+                self.engine = ContinuousBatchingEngine(
+                    model=self.model,
+                    tokenizer=self.tokenizer,
+                    max_batch_size=max_num_seqs,
+                )
 
     async def stream_chat(self, params: Dict[str, Any]):
         prompt = params.get("prompt", "")
@@ -63,11 +80,16 @@ class HFBackend(ModelBackend):
         # TODO ValueError: The following `model_kwargs` are not used by the model: ['presence_penalty', 'frequency_penalty'] (note: typos in the generate arguments will also show up in this list)
         # presence_penalty = float(params.get("presence_penalty", 0.0))
         # frequency_penalty = float(params.get("frequency_penalty", 0.0))
-        stop = params.get("stop", [])  # 停止的 token
+        stop_matcher = get_stop_matcher(params.get("stop", None))  # 停止词
         input_ids = params.get("input_ids", None)
-        if input_ids is None:
+        if params.get("prompt_token_ids"):
+            # 客户端直接传入的 token ids
+            input_ids = torch.LongTensor([params["prompt_token_ids"]])
+        elif input_ids is None:
             input_ids = self.tokenizer([prompt], return_tensors="pt").input_ids
         stop_words_ids = params.get("stop_words_ids", [])
+        # 连续批处理在 temperature 为 0 时使用贪心解码
+        engine_temperature = temperature
         if temperature <= 1e-5:
             top_p = 1.0
             temperature = 0.01
@@ -78,11 +100,6 @@ class HFBackend(ModelBackend):
         )
         stopping_criteria.append(stop_specific_token_criteria)
         logits_processor = LogitsProcessorList([invalid_score_processor])
-        streamer = TextIteratorStreamer(
-            self.tokenizer,
-            skip_prompt=True,
-            decode_kwargsl={"skip_special_tokens": True},
-        )
         # TODO
         # ---- 支持 response_format,但是官方对BPE分词器的支持仍然太差 ----
         response_format = params["response_format"]
@@ -98,13 +115,91 @@ class HFBackend(ModelBackend):
                 assert json_schema is not None
                 guided_json = json_schema["schema"]
                 xgrammar_processor = self.xgrammar_processor.get_json_schema_processor(
-                    schema=json.dumps(guided_json)
+                    schema=guided_json
                 )
                 logits_processor.append(xgrammar_processor)
             elif response_format["type"] == "text":
                 pass
 
         # ---- 支持 response_format,但是官方对BPE分词器的支持仍然太差 ----
+        prompt_tokens = len(input_ids.tolist()[0])
+        if self.engine is not None:
+            source = self.engine_text_stream(
+                input_ids=input_ids.tolist()[0],
+                max_new_tokens=max_new_tokens,
+                temperature=engine_temperature,
+                top_p=top_p,
+                stop_token_ids=stop_words_ids,
+                logits_processor=logits_processor,
+            )
+        else:
+            source = self.thread_text_stream(
+                params=params,
+                input_ids=input_ids,
+                max_new_tokens=max_new_tokens,
+                temperature=temperature,
+                top_p=top_p,
+                logits_processor=logits_processor,
+                stopping_criteria=stopping_criteria,
+            )
+        stop_stream = stop_matcher.stream() if stop_matcher else None
+        stop_flag = False
+        is_disconnected = DisconnectChecker(params.get("request", None))
+        finished = False
+        try:
+            current_text = ""
+            completion_tokens = 0
+            async for new_text, completion_tokens in source:
+                if stop_stream is not None:
+                    # 停止词可能跨越多个增量文本，可能是停止词前缀的部分暂不输出
+                    new_text, stop_flag = stop_stream.feed(new_text)
+                current_text = current_text + new_text
+                usage = {
+                    "prompt_tokens": prompt_tokens,
+                    "completion_tokens": completion_tokens,
+                    "total_tokens": prompt_tokens + completion_tokens,
+                }
+                ret = {
+                    "text": new_text,
+                    "error_code": 0,
+                    "usage": usage,
+                }
+                yield ret
+                if stop_flag:
+                    break
+                if await is_disconnected():
+                    break
+            else:
+                finished = True
+                tail = stop_stream.flush() if stop_stream is not None else ""
+                if tail:
+                    current_text = current_text + tail
+                    yield {"text": tail, "error_code": 0, "usage": usage}
+            logger.info(current_text)
+        finally:
+            # 提前结束（停止词、客户端断开或请求被取消）时通知生成线程停止
+            stop_specific_token_criteria.stop = True
+            await source.aclose()
+            if not finished and not stop_flag:
+                self.record_cancel(params)
+
+    async def engine_text_stream(self, **kwargs):
+        """连续批处理：每个 token 产出一次 (增量文本, completion_tokens)"""
+        async for output in self.engine.generate(**kwargs):
+            yield output["text"], output["completion_tokens"]
+
+    async def thread_text_stream(
+        self,
+        params,
+        input_ids,
+        max_new_tokens,
+        temperature,
+        top_p,
+        logits_processor,
+        stopping_criteria,
+    ):
+        """每个请求单独启动一个 model.generate 线程，产出 (增量文本, completion_tokens)"""
+        streamer = AsyncTextStreamer(self.tokenizer, skip_special_tokens=True)
         generation_kwargs = dict(
             input_ids=input_ids.to(self.model.device),
             streamer=streamer,
@@ -128,48 +223,16 @@ class HFBackend(ModelBackend):
         if not use_lora and self.lora_requests:
             context_manager = self.model.disable_adapter()
         with context_manager:
-            thread = Thread(target=self.model.generate, kwargs=generation_kwargs)
+            thread = Thread(
+                target=self.generate_in_thread, args=(streamer, generation_kwargs)
+            )
             thread.start()
-        prompt_tokens = len(input_ids.tolist()[0])
-        completion_tokens = 0
-        stop_flag = False
+        async for output in streamer:
+            yield output
+
+    def generate_in_thread(self, streamer: AsyncTextStreamer, generation_kwargs):
         try:
-            current_text = ""
-            previous_text = ""
-            previous_token_ids = []
-            current_token_ids = []
-            delta_token_ids = []
-            for new_text in streamer:
-                for stop_word in stop:
-                    if stop_word in new_text:
-                        idx = new_text.rfind(stop_word)
-                        stop_flag = True
-                        print(
-                            "********** 停止的单词为:",
-                            stop_word,
-                            "in",
-                            new_text,
-                            "**********",
-                        )
-                        new_text = new_text[:idx]
-                        break
-                current_text = current_text + new_text
-                completion_tokens += 1
-                usage = {
-                    "prompt_tokens": prompt_tokens,
-                    "completion_tokens": completion_tokens,
-                    "total_tokens": prompt_tokens + completion_tokens,
-                }
-                ret = {
-                    "text": new_text,
-                    "error_code": 0,
-                    "usage": usage,
-                }
-                yield ret
-                if stop_flag:
-                    break
-                # 用来解决输出卡顿的问题
-                await asyncio.sleep(0.02)
-            logger.info(current_text)
-        except asyncio.CancelledError as e:
-            stop_specific_token_criteria.stop = True
+            self.model.generate(**generation_kwargs)
+        except Exception as e:
+            logger.exception(f"model.generate 出错: {e}")
+            streamer.put_error(e)
@@ -0,0 +1,333 @@
+import asyncio
+from collections import deque
+import threading
+from typing import Any, Callable, Dict, List, Optional
+
+import torch
+import torch.nn.functional as F
+from loguru import logger
+
+try:
+    from transformers.cache_utils import DynamicCache
+except ImportError:  # 旧版本 transformers 直接使用 tuple 形式的 past_key_values
+    DynamicCache = None
+
+
+def to_legacy_cache(past_key_values):
+    """转换为 ((key, value), ...) 形式，key/value 形状为 (batch, heads, seq_len, head_dim)"""
+    if hasattr(past_key_values, "to_legacy_cache"):
+        return past_key_values.to_legacy_cache()
+    return past_key_values
+
+
+def from_legacy_cache(past_key_values):
+    if DynamicCache is not None:
+        return DynamicCache.from_legacy_cache(past_key_values)
+    return past_key_values
+
+
+def sample_token(scores: torch.Tensor, temperature: float, top_p: float) -> int:
+    """对单个序列的 logits (vocab_size,) 采样，temperature 为 0 时贪心解码"""
+    if temperature <= 1e-5:
+        return int(scores.argmax())
+    probs = torch.softmax(scores / temperature, dim=-1)
+    if top_p < 1.0:
+        sorted_probs, sorted_indices = probs.sort(descending=True)
+        cumulative = sorted_probs.cumsum(dim=-1)
+        # 保留累计概率达到 top_p 之前的 token（至少保留概率最大的一个）
+        sorted_probs[cumulative - sorted_probs > top_p] = 0
+        return int(sorted_indices[torch.multinomial(sorted_probs, 1)])
+    return int(torch.multinomial(probs, 1))
+
+
+class Sequence:
+    """连续批处理中的一个请求，输出通过 asyncio.Queue 交还给请求所在的事件循环"""
+
+    def __init__(
+        self,
+        input_ids: List[int],
+        max_new_tokens: int,
+        temperature: float,
+        top_p: float,
+        stop_token_ids: List[int],
+        logits_processor: Optional[Callable] = None,
+    ):
+        self.input_ids = list(input_ids)
+        self.output_ids: List[int] = []
+        self.max_new_tokens = max_new_tokens
+        self.temperature = temperature
+        self.top_p = top_p
+        self.stop_token_ids = set(stop_token_ids or [])
+        self.logits_processor = logits_processor
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue()
+        # 单独的 KV cache，只在序列不在批次中时使用
+        self.past = None
+        # 已写入 KV cache 的 token 数
+        self.length = 0
+        self.cancelled = False
+        self.finish_reason = None
+        # 增量解码的偏移，避免每个 token 都解码全部输出
+        self.prefix_offset = 0
+        self.read_offset = 0
+        # logits_processor 使用的 token ids，预分配在设备上，每步只写入新 token
+        self.ids_buffer: Optional[torch.Tensor] = None
+
+    @property
+    def done(self) -> bool:
+        return self.cancelled or self.finish_reason is not None
+
+    def all_ids(self, device) -> torch.Tensor:
+        """prompt 与已生成 token 的 ids，形状 (1, seq_len)"""
+        num_ids = len(self.input_ids) + len(self.output_ids)
+        if self.ids_buffer is None:
+            self.ids_buffer = torch.empty(
+                (1, len(self.input_ids) + self.max_new_tokens),
+                dtype=torch.long,
+                device=device,
+            )
+            self.ids_buffer[0, :num_ids] = torch.tensor(
+                self.input_ids + self.output_ids, dtype=torch.long
+            )
+        return self.ids_buffer[:, :num_ids]
+
+    def append_token(self, token_id: int):
+        if self.ids_buffer is not None:
+            num_ids = len(self.input_ids) + len(self.output_ids)
+            if num_ids < self.ids_buffer.shape[1]:
+                self.ids_buffer[0, num_ids] = token_id
+            else:
+                self.ids_buffer = None
+        self.output_ids.append(token_id)
+
+    def put(self, item):
+        try:
+            self.loop.call_soon_threadsafe(self.queue.put_nowait, item)
+        except RuntimeError:  # 事件循环已关闭
+            self.cancelled = True
+
+
+class ContinuousBatchingEngine:
+    """HF 模型的连续批处理引擎
+
+    一个后台线程运行唯一的解码循环：每一步开始前把等待中的请求加入批次，
+    新请求单独 prefill 得到各自的 KV cache，再与正在解码的序列按左侧补齐拼成一个批次，
+    之后每一步对整个批次做一次前向计算。批次成员不变时直接复用批量的 KV cache，
+    有序列加入或结束时才重新拼接，并去掉多余的补齐。
+    """
+
+    def __init__(self, model: torch.nn.Module, tokenizer, max_batch_size: int = 8):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_batch_size = max_batch_size
+        self.eos_token_ids = set()
+        for eos_token_id in (
+            getattr(getattr(model, "generation_config", None), "eos_token_id", None),
+            getattr(tokenizer, "eos_token_id", None),
+        ):
+            if isinstance(eos_token_id, int):
+                self.eos_token_ids.add(eos_token_id)
+            elif eos_token_id:
+                self.eos_token_ids.update(eos_token_id)
+        self.waiting = deque()
+        self.condition = threading.Condition()
+        self.thread = None
+        # 当前批次的序列、批量的 KV cache 以及对应的 attention_mask
+        self.batch: List[Sequence] = []
+        self.batch_past = None
+        self.batch_mask = None
+        self.steps = 0
+
+    @property
+    def device(self):
+        return self.model.device
+
+    def submit(self, seq: Sequence):
+        with self.condition:
+            if self.thread is None:
+                self.thread = threading.Thread(
+                    target=self.run, name="hf-continuous-batching", daemon=True
+                )
+                self.thread.start()
+            self.waiting.append(seq)
+            self.condition.notify()
+
+    async def generate(
+        self,
+        input_ids: List[int],
+        max_new_tokens: int = 512,
+        temperature: float = 1.0,
+        top_p: float = 1.0,
+        stop_token_ids: Optional[List[int]] = None,
+        logits_processor: Optional[Callable] = None,
+    ):
+        """提交一个请求，逐 token 产出 {"text", "token_id", "completion_tokens", "finish_reason"}
+
+        生成器被关闭（停止词、客户端断开或请求被取消）时，序列在下一步开始前被移出批次。
+        """
+        seq = Sequence(
+            input_ids=input_ids,
+            max_new_tokens=max_new_tokens,
+            temperature=temperature,
+            top_p=top_p,
+            stop_token_ids=stop_token_ids,
+            logits_processor=logits_processor,
+        )
+        self.submit(seq)
+        try:
+            while True:
+                item = await seq.queue.get()
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+                if item["finish_reason"] is not None:
+                    return
+        finally:
+            seq.cancelled = True
+
+    # ---------------- 以下方法只在解码线程中调用 ----------------
+    def run(self):
+        with torch.inference_mode():
+            while True:
+                with self.condition:
+                    running = [seq for seq in self.batch if not seq.done]
+                    while not self.waiting and not running:
+                        self.release_batch()
+                        self.condition.wait()
+                    admitted = []
+                    while self.waiting and len(running) + len(admitted) < (
+                        self.max_batch_size
+                    ):
+                        admitted.append(self.waiting.popleft())
+                for seq in admitted:
+                    if not seq.cancelled:
+                        self.run_safely(self.prefill, [seq])
+                running.extend(seq for seq in admitted if not seq.done)
+                if running:
+                    self.run_safely(self.decode, running)
+
+    def run_safely(self, func, seqs: List[Sequence]):
+        try:
+            func(seqs)
+        except Exception as e:
+            logger.exception(f"连续批处理前向计算出错: {e}")
+            for seq in seqs:
+                seq.finish_reason = "error"
+                seq.put(e)
+            if func == self.decode:
+                # 批量的 KV cache 已不可用，批次中的序列全部结束
+                self.release_batch()
+
+    def release_batch(self):
+        self.batch = []
+        self.batch_past = None
+        self.batch_mask = None
+
+    def prefill(self, seqs: List[Sequence]):
+        seq = seqs[0]
+        input_ids = torch.tensor([seq.input_ids], device=self.device)
+        outputs = self.model(input_ids=input_ids, use_cache=True)
+        seq.past = to_legacy_cache(outputs.past_key_values)
+        seq.length = len(seq.input_ids)
+        self.sample([seq], outputs.logits[:, -1, :])
+
+    def decode(self, seqs: List[Sequence]):
+        if seqs != self.batch:
+            self.rebuild_batch(seqs)
+        input_ids = torch.tensor(
+            [[seq.output_ids[-1]] for seq in seqs], device=self.device
+        )
+        attention_mask = F.pad(self.batch_mask, (0, 1), value=1)
+        position_ids = torch.tensor([[seq.length] for seq in seqs], device=self.device)
+        outputs = self.model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            past_key_values=from_legacy_cache(self.batch_past),
+            use_cache=True,
+        )
+        self.batch_past = to_legacy_cache(outputs.past_key_values)
+        self.batch_mask = attention_mask
+        for seq in seqs:
+            seq.length += 1
+        self.steps += 1
+        self.sample(seqs, outputs.logits[:, -1, :])
+
+    def rebuild_batch(self, seqs: List[Sequence]):
+        """批次成员变化时重新拼接 KV cache：先拆出留下的序列，再按最长序列左侧补齐"""
+        if self.batch_past is not None:
+            max_len = self.batch_mask.shape[1]
+            for i, seq in enumerate(self.batch):
+                if seq.done or seq not in seqs:
+                    continue
+                start = max_len - seq.length
+                seq.past = tuple(
+                    (key[i : i + 1, :, start:], value[i : i + 1, :, start:])
+                    for key, value in self.batch_past
+                )
+        self.release_batch()
+        max_len = max(seq.length for seq in seqs)
+        past = []
+        for layer in range(len(seqs[0].past)):
+            keys, values = [], []
+            for seq in seqs:
+                key, value = seq.past[layer]
+                padding = (0, 0, max_len - seq.length, 0)
+                keys.append(F.pad(key, padding))
+                values.append(F.pad(value, padding))
+            past.append((torch.cat(keys), torch.cat(values)))
+        mask = torch.zeros(
+            (len(seqs), max_len), dtype=torch.long, device=self.device
+        )
+        for i, seq in enumerate(seqs):
+            mask[i, max_len - seq.length :] = 1
+            seq.past = None
+        self.batch = list(seqs)
+        self.batch_past = tuple(past)
+        self.batch_mask = mask
+
+    def sample(self, seqs: List[Sequence], logits: torch.Tensor):
+        logits = logits.float()
+        for i, seq in enumerate(seqs):
+            scores = logits[i : i + 1]
+            if seq.logits_processor is not None:
+                scores = seq.logits_processor(seq.all_ids(scores.device), scores)
+            token_id = sample_token(scores[0], seq.temperature, seq.top_p)
+            seq.append_token(token_id)
+            if token_id in seq.stop_token_ids or token_id in self.eos_token_ids:
+                seq.finish_reason = "stop"
+                text = ""
+            else:
+                if len(seq.output_ids) >= seq.max_new_tokens:
+                    seq.finish_reason = "length"
+                text = self.decode_delta(seq)
+            seq.put(
+                {
+                    "text": text,
+                    "token_id": token_id,
+                    "completion_tokens": len(seq.output_ids),
+                    "finish_reason": seq.finish_reason,
+                }
+            )
+
+    def decode_delta(self, seq: Sequence) -> str:
+        """增量解码：只解码最近的几个 token，多字节字符不完整时暂不输出"""
+        output_ids = seq.output_ids
+        prefix_text = self.tokenizer.decode(
+            output_ids[seq.prefix_offset : seq.read_offset], skip_special_tokens=True
+        )
+        new_text = self.tokenizer.decode(
+            output_ids[seq.prefix_offset :], skip_special_tokens=True
+        )
+        if len(new_text) > len(prefix_text) and not new_text.endswith("\ufffd"):
+            seq.prefix_offset = seq.read_offset
+            seq.read_offset = len(output_ids)
+            return new_text[len(prefix_text) :]
+        return ""
+
+    def get_metrics(self) -> Dict[str, Any]:
+        return {
+            "waiting": len(self.waiting),
+            "running": len(self.batch),
+            "steps": self.steps,
+        }
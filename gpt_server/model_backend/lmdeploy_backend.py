@@ -8,10 +8,15 @@ from lmdeploy import (
 from transformers import PreTrainedTokenizerBase
 from typing import Any, Dict, AsyncGenerator
 from lmdeploy.archs import get_task
-from gpt_server.model_handler.reasoning_parser import ReasoningParserManager
+from gpt_server.model_handler.reasoning_parser import create_reasoning_splitter
 from lmdeploy.serve.async_engine import get_names_from_model
 from loguru import logger
 from gpt_server.model_backend.base import ModelBackend
+from gpt_server.model_backend.utils import (
+    get_prompt_token_ids,
+    get_stop_matcher,
+    normalize_stop,
+)
 
 if sys.platform == "linux":
     # 防止Python c库没有加载导致lmdeploy pytorch后端报错
@@ -32,21 +37,6 @@ get_logger("lmdeploy").setLevel(log_level)  # 默认WARNING
 os.environ["TM_LOG_LEVEL"] = "WARNING"
 
 
-def is_stop(output: str, stop_str: str):
-    # 直接创建子序列列表，不在每次调用中重复计算
-    stop_str_sub_seq_list = [stop_str[: i + 1] for i in range(len(stop_str))]
-
-    # 判断是否以 stop_str 子序列结尾
-    for stop_str_sub_seq in stop_str_sub_seq_list:
-        if output.endswith(stop_str_sub_seq):
-            # 找到匹配的子序列，返回截断后的输出和状态
-            sub_seq_len = len(stop_str_sub_seq)
-            return output[:-sub_seq_len], stop_str_sub_seq == stop_str
-
-    # 如果没有匹配的子序列且整体不在结尾，返回原始输出
-    return output, False
-
-
 def is_messages_with_tool(messages: list):
     flag = False
     for msg in messages:
@@ -104,20 +94,15 @@ class LMDeployBackend(ModelBackend):
         top_k = params.get("top_k", 50)
 
         max_new_tokens = int(params.get("max_new_tokens", 1024 * 8))
-        stop_str = params.get("stop", None)
         stop_token_ids = params.get("stop_words_ids", None) or []
         presence_penalty = float(params.get("presence_penalty", 0.0))
         frequency_penalty = float(params.get("frequency_penalty", 0.0))
         reasoning_parser_type = params.get("reasoning_parser", None)
         request = params.get("request", None)
         enable_thinking = bool(params.get("enable_thinking", True))
-        # Handle stop_str
-        stop = set()
-        if isinstance(stop_str, str) and stop_str != "":
-            stop.add(stop_str)
-        elif isinstance(stop_str, list) and stop_str != []:
-            stop.update(stop_str)
-        # prompt_token_ids = input_ids.tolist()[0]
+        stop = normalize_stop(params.get("stop", None))
+        stop_matcher = get_stop_matcher(stop)
+        stop_stream = stop_matcher.stream() if stop_matcher else None
         # make sampling params in vllm
         top_p = max(top_p, 1e-5)
         gen_config = GenerationConfig(
@@ -126,7 +111,7 @@ class LMDeployBackend(ModelBackend):
             temperature=temperature,
             max_new_tokens=max_new_tokens,  # 存在问题
             top_k=50 if top_k == -1 else top_k,
-            stop_words=list(stop),
+            stop_words=stop,
             skip_special_tokens=True,
             response_format=params["response_format"],
         )
@@ -136,25 +121,35 @@ class LMDeployBackend(ModelBackend):
         if self.chat_template_name == "base":
             messages = prompt or messages
         multimodal = params.get("multimodal", False)
+        # 有 token ids 时 lmdeploy 不再渲染模板和分词
+        prompt_token_ids = None
         if multimodal:  # 多模态模型
             messages = params["messages"]
+        else:
+            prompt_token_ids = get_prompt_token_ids(params)
         if isinstance(messages, str):
             logger.info(f"使用prompt模式")
             logger.info(prompt)
         else:
             logger.info(f"使用messages模式")
-        results_generator = self.async_engine.generate(
-            messages=messages,
-            session_id=int(request_id),
-            gen_config=gen_config,
-            enable_thinking=enable_thinking,
+        results_generator = self.iterate_with_cancel(
+            self.async_engine.generate(
+                messages=messages,
+                session_id=int(request_id),
+                gen_config=gen_config,
+                enable_thinking=enable_thinking,
+                input_ids=prompt_token_ids,
+            ),
+            params,
+            # 停止 session 以释放 KV cache
+            abort=lambda: self.async_engine.stop_session(int(request_id)),
         )
         usage = {}
-        previous_text = ""
+        stop_hit = False
         current_text = ""
-        previous_token_ids = []
-        current_token_ids = []
-        delta_token_ids = []
+        reasoning_splitter = create_reasoning_splitter(
+            reasoning_parser_type, self.tokenizer, self.reasoning_parser_cache
+        )
         async for request_output in results_generator:
             current_text = current_text + request_output.response
 
@@ -171,62 +166,26 @@ class LMDeployBackend(ModelBackend):
                 "finish_reason": request_output.finish_reason,
             }
 
-            if reasoning_parser_type:
-                reasoning_parser = None
-                delta_token_ids = (
-                    request_output.token_ids
-                    if request_output.token_ids is not None
-                    else []
-                )
-                current_token_ids = current_token_ids + delta_token_ids
-                if reasoning_parser_type in self.reasoning_parser_cache:
-                    reasoning_parser = self.reasoning_parser_cache.get(
-                        reasoning_parser_type
-                    )
-                else:
-                    reasoning_parser = ReasoningParserManager.get(
-                        reasoning_parser_type
-                    )(self.tokenizer)
-                    self.reasoning_parser_cache[reasoning_parser_type] = (
-                        reasoning_parser
-                    )
-                reasoning_delta = reasoning_parser.extract_reasoning_content_streaming(
-                    previous_text=previous_text,
-                    current_text=current_text,
-                    delta_text=request_output.response,
-                    previous_token_ids=previous_token_ids,
-                    current_token_ids=current_token_ids,
-                    delta_token_ids=delta_token_ids,
+            if reasoning_splitter is not None:
+                # request_output.token_ids 即本次新增的 token id
+                ret["text"], ret["reasoning_content"] = reasoning_splitter.feed(
+                    request_output.response, request_output.token_ids
                 )
-                if reasoning_delta is not None:
-                    ret["text"] = (
-                        reasoning_delta.content if reasoning_delta.content else ""
-                    )
-                    ret["reasoning_content"] = (
-                        reasoning_delta.reasoning_content
-                        if reasoning_delta.reasoning_content
-                        else ""
-                    )
-                previous_token_ids = current_token_ids
-            # TODO ------------------------修复LMDeploy stop 无法停止的问题-------------------------------------------
-            # output_info_list = []
-            # for stop_str in list(stop):
-            #     if stop_str:
-            #         text, bool_value = is_stop(output=current_text, stop_str=stop_str)
-            #         output_info_list.append(
-            #             {"text": text, "bool_value": bool_value, "text_len": len(text)}
-            #         )
-            # output_info_list.sort(key=lambda x: x["text_len"])
-            # output_info = output_info_list[0]
-            # ret["text"] = output_info["text"][len(previous_text) :]
-            # if output_info["bool_value"]:
-            #     ret["finish_reason"] = "stop"
-            #     yield ret
-            #     break
-            # TODO ------------------------修复LMDeploy stop 无法停止的问题-------------------------------------------
+            # lmdeploy 的 stop_words 只对单个 token 生效，跨 token 的停止词在这里匹配
+            if stop_stream is not None:
+                if stop_hit:
+                    # 已命中停止词，等待 stop_session 结束生成
+                    continue
+                ret["text"], stop_hit = stop_stream.feed(ret["text"])
+                if stop_hit:
+                    ret["finish_reason"] = "stop"
+                    await self.async_engine.stop_session(int(request_id))
+                    yield ret
+                    continue
+                if request_output.finish_reason is not None:
+                    ret["text"] += stop_stream.flush()
             if not ret["text"] and not ret.get("reasoning_content", ""):
                 continue
             yield ret
-            previous_text = current_text
         logger.info(current_text)
         logger.info(usage)
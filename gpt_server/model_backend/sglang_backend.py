@@ -3,13 +3,16 @@ import base64
 from io import BytesIO
 import os
 from typing import Any, Dict, AsyncGenerator, List, Optional
-from fastchat.utils import is_partial_stop
+from gpt_server.model_backend.utils import (
+    canonical_schema,
+    get_prompt_token_ids,
+    normalize_stop,
+)
 from gpt_server.model_backend.base import ModelBackend
 from loguru import logger
 from PIL import Image
 import sglang as sgl
 from transformers import PreTrainedTokenizerBase
-from sglang.utils import convert_json_schema_to_str
 from sglang.srt.conversation import generate_chat_conv
 
 from qwen_vl_utils import process_vision_info
@@ -76,17 +79,12 @@ class SGLangBackend(ModelBackend):
         top_p = float(params.get("top_p", 0.8))
         top_k = params.get("top_k", -1)
         max_new_tokens = int(params.get("max_new_tokens", 1024 * 8))
-        stop_str = params.get("stop", None)
         stop_token_ids = params.get("stop_words_ids", None) or []
         presence_penalty = float(params.get("presence_penalty", 0.0))
         frequency_penalty = float(params.get("frequency_penalty", 0.0))
         request = params.get("request", None)
-        # Handle stop_str
-        stop = set()
-        if isinstance(stop_str, str) and stop_str != "":
-            stop.add(stop_str)
-        elif isinstance(stop_str, list) and stop_str != []:
-            stop.update(stop_str)
+        # 停止词由推理引擎在生成过程中匹配
+        stop = normalize_stop(params.get("stop", None))
         base64_images = []
         multimodal = params.get("multimodal", False)
         if multimodal:  # 多模态模型
@@ -113,7 +111,8 @@ class SGLangBackend(ModelBackend):
         json_schema = None
         if response_format is not None:
             if response_format["type"] == "json_schema":
-                json_schema = convert_json_schema_to_str(
+                # 规范化后相同的 schema 能命中 sglang 的语法编译缓存
+                json_schema = canonical_schema(
                     response_format["json_schema"]["schema"]
                 )
         sampling_params = {
@@ -128,10 +127,12 @@ class SGLangBackend(ModelBackend):
             "json_schema": json_schema,
         }
         image_data = base64_images if base64_images else None
+        # 有 token ids 时跳过 sglang 的分词，text 和 input_ids 只能传一个
+        prompt_token_ids = None if multimodal else get_prompt_token_ids(params)
 
         obj = GenerateReqInput(
-            text=prompt,
-            input_ids=None,
+            text=prompt if prompt_token_ids is None else None,
+            input_ids=prompt_token_ids,
             sampling_params=sampling_params,
             image_data=image_data,
             return_logprob=False,
@@ -143,40 +144,44 @@ class SGLangBackend(ModelBackend):
             custom_logit_processor=None,
             rid=request_id,
         )
-        generator = self.async_engine.tokenizer_manager.generate_request(obj, None)
+
+        async def abort():
+            self.async_engine.tokenizer_manager.abort_request(request_id)
+
+        generator = self.iterate_with_cancel(
+            self.async_engine.tokenizer_manager.generate_request(obj, None),
+            params,
+            abort=abort,
+        )
         previous_text = ""
         aborted = False
-        try:
-            async for chunk in generator:
-                current_text = chunk["text"]
-                meta_info = chunk["meta_info"]
-                delta_text = current_text[len(previous_text) :]
+        async for chunk in generator:
+            current_text = chunk["text"]
+            meta_info = chunk["meta_info"]
+            delta_text = current_text[len(previous_text) :]
 
-                prompt_tokens = meta_info["prompt_tokens"]
-                completion_tokens = meta_info["completion_tokens"]
-                usage = {
-                    "prompt_tokens": prompt_tokens,
-                    "completion_tokens": completion_tokens,
-                    "total_tokens": prompt_tokens + completion_tokens,
-                }
-                ret = {
-                    "text": delta_text,
-                    "error_code": 0,
-                    "usage": usage,
-                    "finish_reason": (
-                        meta_info["finish_reason"]["type"]
-                        if meta_info["finish_reason"]
-                        else None
-                    ),
-                }
-                if not ret["text"]:
-                    continue
-                yield ret
-                previous_text = current_text
-                if aborted:
-                    break
-            logger.info(current_text)
-            logger.info(usage)
-        except asyncio.CancelledError as e:
-            self.async_engine.tokenizer_manager.abort_request(request_id)
-            logger.warning(f"request_id : {request_id} 已中断！")
+            prompt_tokens = meta_info["prompt_tokens"]
+            completion_tokens = meta_info["completion_tokens"]
+            usage = {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+            }
+            ret = {
+                "text": delta_text,
+                "error_code": 0,
+                "usage": usage,
+                "finish_reason": (
+                    meta_info["finish_reason"]["type"]
+                    if meta_info["finish_reason"]
+                    else None
+                ),
+            }
+            if not ret["text"]:
+                continue
+            yield ret
+            previous_text = current_text
+            if aborted:
+                break
+        logger.info(current_text)
+        logger.info(usage)
@@ -1,7 +1,14 @@
-from typing import List, Type, Union
+import asyncio
+from collections import OrderedDict, deque
+from functools import lru_cache
+import hashlib
+import json
+import os
+import threading
+from typing import List, Optional, Tuple, Type, Union
 from pydantic import BaseModel
 from transformers.generation.logits_process import LogitsProcessor
-from transformers import PreTrainedTokenizerBase
+from transformers import PreTrainedTokenizerBase, TextStreamer
 from transformers.generation.stopping_criteria import (
     StoppingCriteria,
     StoppingCriteriaList,
@@ -10,28 +17,102 @@ from transformers.generation.stopping_criteria import (
 )
 import xgrammar as xgr
 import torch
+from loguru import logger
 
 
-class XgrammarLogitsProcessor(LogitsProcessor):
-    def __init__(self, tokenizer: PreTrainedTokenizerBase):
+def canonical_schema(schema: Union[str, dict]) -> str:
+    """JSON schema 的规范化字符串（键排序、无多余空白），字段顺序不同的相同 schema 得到相同结果"""
+    if isinstance(schema, str):
+        try:
+            schema = json.loads(schema)
+        except ValueError:
+            return schema
+    return json.dumps(schema, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+
+
+def schema_hash(schema: Union[str, dict]) -> str:
+    return hashlib.blake2b(
+        canonical_schema(schema).encode(), digest_size=16
+    ).hexdigest()
+
+
+def load_warmup_schemas(value: Optional[str]) -> List[Union[str, dict]]:
+    """解析配置中需要预热的 JSON schema 列表（JSON 字符串），元素为 schema 或 schema 文件路径"""
+    if not value:
+        return []
+    schemas = []
+    for item in json.loads(value):
+        if isinstance(item, str) and os.path.isfile(item):
+            with open(item, encoding="utf-8") as f:
+                item = json.load(f)
+        schemas.append(item)
+    return schemas
+
+
+class XgrammarLogitsProcessor:
+    """
+    xgrammar 编译结果的线程安全 LRU 缓存，按规范化 schema 的 hash 复用编译好的语法。
+    每次请求都创建新的 LogitsProcessor（其中的匹配状态属于单个请求），不在实例上保存。
+    """
+
+    def __init__(self, tokenizer: PreTrainedTokenizerBase, max_size: int = 128):
         tokenizer_info = xgr.TokenizerInfo.from_huggingface(tokenizer)
         self.grammar_compiler = xgr.GrammarCompiler(tokenizer_info)
-        # -----------
+        self.max_size = max_size
+        self.compiled_grammars = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_compiled_grammar(self, key: str, compile_func):
+        with self.lock:
+            compiled_grammar = self.compiled_grammars.get(key)
+            if compiled_grammar is not None:
+                self.compiled_grammars.move_to_end(key)
+                self.hits += 1
+                return compiled_grammar
+            self.misses += 1
+        # 编译可能较慢，不持有锁；并发编译同一个 schema 时以后完成的为准
+        compiled_grammar = compile_func()
+        with self.lock:
+            self.compiled_grammars[key] = compiled_grammar
+            self.compiled_grammars.move_to_end(key)
+            while len(self.compiled_grammars) > self.max_size:
+                self.compiled_grammars.popitem(last=False)
+        return compiled_grammar
 
     def get_json_grammar_processor(self):
-        compiled_grammar = self.grammar_compiler.compile_builtin_json_grammar()
-        self.xgr_logits_processor = xgr.contrib.hf.LogitsProcessor(compiled_grammar)
-        return self.xgr_logits_processor
+        compiled_grammar = self.get_compiled_grammar(
+            "builtin_json", self.grammar_compiler.compile_builtin_json_grammar
+        )
+        return xgr.contrib.hf.LogitsProcessor(compiled_grammar)
 
-    def get_json_schema_processor(self, schema: Union[str, Type[BaseModel]]):
-        compiled_grammar = self.grammar_compiler.compile_json_schema(schema)
-        self.xgr_logits_processor = xgr.contrib.hf.LogitsProcessor(compiled_grammar)
-        return self.xgr_logits_processor
+    def get_json_schema_processor(self, schema: Union[str, dict, Type[BaseModel]]):
+        if isinstance(schema, type) and issubclass(schema, BaseModel):
+            schema = schema.model_json_schema()
+        canonical = canonical_schema(schema)
+        compiled_grammar = self.get_compiled_grammar(
+            schema_hash(canonical),
+            lambda: self.grammar_compiler.compile_json_schema(canonical),
+        )
+        return xgr.contrib.hf.LogitsProcessor(compiled_grammar)
 
-    def __call__(
-        self, input_ids: torch.LongTensor, scores: torch.FloatTensor
-    ) -> torch.FloatTensor:
-        return self.xgr_logits_processor(input_ids=input_ids, scores=scores)
+    def warmup(self, schemas: List[Union[str, dict]]):
+        """启动时预先编译常用的 schema"""
+        for schema in schemas:
+            try:
+                self.get_json_schema_processor(schema)
+            except Exception as e:
+                logger.warning(f"预热 JSON schema 失败: {e}")
+        logger.info(f"已预热 {len(self.compiled_grammars)} 个 JSON schema 语法")
+
+    def metrics(self):
+        with self.lock:
+            return {
+                "size": len(self.compiled_grammars),
+                "hits": self.hits,
+                "misses": self.misses,
+            }
 
 
 class InvalidScoreLogitsProcessor(LogitsProcessor):
@@ -65,3 +146,164 @@ class StopAtSpecificTokenCriteria(StoppingCriteria):
         if self.stop:
             return True
         return input_ids[0][-1].detach().cpu().numpy() in self.token_id_list
+
+
+class AsyncTextStreamer(TextStreamer):
+    """
+    在 model.generate 线程中解码，通过 call_soon_threadsafe 把文本交给事件循环，
+    异步迭代得到 (text, completion_tokens)，等待期间不阻塞事件循环
+    """
+
+    def __init__(self, tokenizer: PreTrainedTokenizerBase, **decode_kwargs):
+        super().__init__(tokenizer, skip_prompt=True, **decode_kwargs)
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue()
+        self.stop_signal = object()
+        # 已生成的 token 数（不含 prompt）
+        self.completion_tokens = 0
+
+    def put(self, value):
+        if not self.next_tokens_are_prompt:
+            self.completion_tokens += value.numel()
+        super().put(value)
+
+    def on_finalized_text(self, text: str, stream_end: bool = False):
+        if text:
+            self.put_nowait((text, self.completion_tokens))
+        if stream_end:
+            self.put_nowait(self.stop_signal)
+
+    def put_error(self, error: Exception):
+        self.put_nowait(error)
+
+    def put_nowait(self, item):
+        try:
+            self.loop.call_soon_threadsafe(self.queue.put_nowait, item)
+        except RuntimeError:  # 事件循环已关闭
+            pass
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        item = await self.queue.get()
+        if item is self.stop_signal:
+            raise StopAsyncIteration
+        if isinstance(item, Exception):
+            raise item
+        return item
+
+
+def get_prompt_token_ids(params: dict) -> Optional[List[int]]:
+    """客户端直接传入的 prompt_token_ids 优先，其次是 worker 分词得到的 input_ids"""
+    prompt_token_ids = params.get("prompt_token_ids", None)
+    if prompt_token_ids:
+        return list(prompt_token_ids)
+    input_ids = params.get("input_ids", None)
+    if input_ids is None:
+        return None
+    if isinstance(input_ids, torch.Tensor):
+        return input_ids.tolist()[0]
+    return list(input_ids)
+
+
+def normalize_stop(stop: Optional[Union[str, List[str]]]) -> List[str]:
+    """把请求中的 stop（str / list / None）整理为去重后的非空字符串列表"""
+    if isinstance(stop, str):
+        stop = [stop]
+    return list(dict.fromkeys(s for s in stop or [] if isinstance(s, str) and s))
+
+
+class StopMatcher:
+    """
+    多个停止词的 Aho-Corasick 自动机，构建一次后可被所有请求共享，
+    每个请求通过 stream() 得到各自的匹配状态
+    """
+
+    def __init__(self, patterns: List[str]):
+        self.patterns = patterns
+        # 每个节点的转移表、失败指针、深度，以及以该节点结尾的最长停止词长度
+        self.goto = [{}]
+        self.fail = [0]
+        self.depth = [0]
+        self.match = [0]
+        for pattern in patterns:
+            node = 0
+            for char in pattern:
+                next_node = self.goto[node].get(char)
+                if next_node is None:
+                    next_node = len(self.goto)
+                    self.goto[node][char] = next_node
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.depth.append(self.depth[node] + 1)
+                    self.match.append(0)
+                node = next_node
+            self.match[node] = len(pattern)
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, next_node in self.goto[node].items():
+                fail = self.fail[node]
+                while fail and char not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[next_node] = self.goto[fail].get(char, 0)
+                self.match[next_node] = max(
+                    self.match[next_node], self.match[self.fail[next_node]]
+                )
+                queue.append(next_node)
+
+    def stream(self) -> "StopStream":
+        return StopStream(self)
+
+
+class StopStream:
+    """
+    单个请求的流式停止词匹配状态，跨增量文本保持自动机状态。
+    只扣留末尾可能是停止词前缀的部分，其余文本立即输出。
+    """
+
+    def __init__(self, matcher: StopMatcher):
+        self.matcher = matcher
+        self.node = 0
+        # 已送入自动机、但可能是停止词前缀而暂未输出的文本
+        self.pending = ""
+        self.stopped = False
+
+    def feed(self, text: str) -> Tuple[str, bool]:
+        """输入增量文本，返回 (可以输出的文本, 是否命中停止词)；命中时文本截断到停止词之前"""
+        if self.stopped:
+            return "", True
+        goto, fail, match = self.matcher.goto, self.matcher.fail, self.matcher.match
+        node = self.node
+        for i, char in enumerate(text):
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            if match[node]:
+                self.stopped = True
+                end = len(self.pending) + i + 1 - match[node]
+                return (self.pending + text)[:end], True
+        self.node = node
+        buffer = self.pending + text
+        split = len(buffer) - self.matcher.depth[node]
+        self.pending = buffer[split:]
+        return buffer[:split], False
+
+    def flush(self) -> str:
+        """生成结束时取出扣留的文本"""
+        text, self.pending = self.pending, ""
+        return "" if self.stopped else text
+
+
+@lru_cache(maxsize=256)
+def _get_stop_matcher(patterns: Tuple[str, ...]) -> StopMatcher:
+    return StopMatcher(list(patterns))
+
+
+def get_stop_matcher(stop: Optional[Union[str, List[str]]]) -> Optional[StopMatcher]:
+    """相同的停止词集合复用同一个自动机，没有停止词时返回 None"""
+    patterns = normalize_stop(stop)
+    if not patterns:
+        return None
+    return _get_stop_matcher(tuple(sorted(patterns)))
@@ -1,12 +1,16 @@
 import json
 import os
-from typing import Any, Dict, AsyncGenerator
+from typing import Any, Dict, AsyncGenerator, Optional
 from vllm import SamplingParams, AsyncLLMEngine, AsyncEngineArgs
 from vllm.sampling_params import GuidedDecodingParams
-from fastchat.utils import is_partial_stop
+from gpt_server.model_backend.utils import (
+    canonical_schema,
+    get_prompt_token_ids,
+    normalize_stop,
+)
 from gpt_server.model_backend.base import ModelBackend
 from loguru import logger
-from lmdeploy.serve.openai.reasoning_parser import ReasoningParserManager
+from gpt_server.model_handler.reasoning_parser import create_reasoning_splitter
 from vllm.lora.request import LoRARequest
 from transformers import AutoTokenizer
 from vllm.entrypoints.chat_utils import (
@@ -22,6 +26,22 @@ import ray
 ray.init(ignore_reinit_error=True, num_cpus=8)
 
 
+def get_guided_decoding(
+    json_schema: Optional[str], json_object: Optional[bool]
+) -> GuidedDecodingParams:
+    """每个请求创建新的 GuidedDecodingParams（会放入各自可变的 SamplingParams），
+    json_schema 为规范化后的字符串，相同 schema 命中 vllm 内部的语法编译缓存"""
+    return GuidedDecodingParams.from_optional(
+        json=json_schema,
+        regex=None,
+        choice=None,
+        grammar=None,
+        json_object=json_object,
+        backend="xgrammar",
+        whitespace_pattern=None,
+    )
+
+
 class VllmBackend(ModelBackend):
     def __init__(self, model_path, tokenizer: AutoTokenizer) -> None:
         lora = os.getenv("lora", None)
@@ -71,18 +91,13 @@ class VllmBackend(ModelBackend):
         top_p = float(params.get("top_p", 0.8))
         top_k = int(params.get("top_k", 0))
         max_new_tokens = int(params.get("max_new_tokens", 1024 * 8))
-        stop_str = params.get("stop", None)
         stop_token_ids = params.get("stop_words_ids", None) or []
         presence_penalty = float(params.get("presence_penalty", 0.0))
         frequency_penalty = float(params.get("frequency_penalty", 0.0))
         repetition_penalty = float(params.get("repetition_penalty", 1.0))
         request = params.get("request", None)
-        # Handle stop_str
-        stop = set()
-        if isinstance(stop_str, str) and stop_str != "":
-            stop.add(stop_str)
-        elif isinstance(stop_str, list) and stop_str != []:
-            stop.update(stop_str)
+        # 停止词由推理引擎在生成过程中匹配
+        stop = normalize_stop(params.get("stop", None))
 
         multimodal = params.get("multimodal", False)
         if multimodal:  # 多模态模型
@@ -104,10 +119,9 @@ class VllmBackend(ModelBackend):
             mm_data = await mm_data_future
             inputs = {"multi_modal_data": mm_data, "prompt": prompt}
         else:
-            input_ids = params.get("input_ids", None)
+            prompt_token_ids = get_prompt_token_ids(params)
             inputs = {"prompt": prompt}
-            if input_ids is not None:
-                prompt_token_ids = input_ids.tolist()[0]
+            if prompt_token_ids is not None:
                 inputs["prompt_token_ids"] = prompt_token_ids
         # ----------------------------------------------------------------
         # make sampling params in vllm
@@ -126,23 +140,15 @@ class VllmBackend(ModelBackend):
             if response_format["type"] == "json_schema":
                 json_schema = response_format["json_schema"]
                 assert json_schema is not None
-                guided_json = json_schema["schema"]
+                guided_json = canonical_schema(json_schema["schema"])
 
-            guided_decoding = GuidedDecodingParams.from_optional(
-                json=guided_json,
-                regex=None,
-                choice=None,
-                grammar=None,
-                json_object=guided_json_object,
-                backend="xgrammar",
-                whitespace_pattern=None,
-            )
+            guided_decoding = get_guided_decoding(guided_json, guided_json_object)
         sampling = SamplingParams(
             top_p=top_p,
             top_k=top_k,
             temperature=temperature,
             max_tokens=max_new_tokens,
-            stop=list(stop),
+            stop=stop,
             stop_token_ids=stop_token_ids,
             presence_penalty=presence_penalty,
             frequency_penalty=frequency_penalty,
@@ -155,21 +161,27 @@ class VllmBackend(ModelBackend):
                 lora_request = lora
                 break
 
-        results_generator = self.engine.generate(
-            prompt=inputs,
-            sampling_params=sampling,
-            request_id=request_id,
-            lora_request=lora_request,
+        results_generator = self.iterate_with_cancel(
+            self.engine.generate(
+                prompt=inputs,
+                sampling_params=sampling,
+                request_id=request_id,
+                lora_request=lora_request,
+            ),
+            params,
+            abort=lambda: self.engine.abort(request_id),
         )
         current_text = ""
         previous_text = ""
-        previous_token_ids = []
-        current_token_ids = []
-        delta_token_ids = []
+        previous_num_tokens = 0
+        reasoning_splitter = create_reasoning_splitter(
+            params.get("reasoning_parser", None),
+            self.tokenizer,
+            self.reasoning_parser_cache,
+        )
         async for request_output in results_generator:
             current_text = request_output.outputs[0].text
             delta_text = current_text[len(previous_text) :]
-            aborted = False
 
             prompt_tokens = len(request_output.prompt_token_ids)
             completion_tokens = sum(
@@ -186,46 +198,17 @@ class VllmBackend(ModelBackend):
                 "usage": usage,
                 "finish_reason": request_output.outputs[0].finish_reason,
             }
-            reasoning_parser_type = params.get("reasoning_parser", None)
-            if reasoning_parser_type:
-                reasoning_parser = None
-                current_token_ids = list(request_output.outputs[0].token_ids)
-                delta_token_ids = current_token_ids[len(previous_token_ids) :]
-                if reasoning_parser_type in self.reasoning_parser_cache:
-                    reasoning_parser = self.reasoning_parser_cache.get(
-                        reasoning_parser_type
-                    )
-                else:
-                    reasoning_parser = ReasoningParserManager.get(
-                        reasoning_parser_type
-                    )(self.tokenizer)
-                    self.reasoning_parser_cache[reasoning_parser_type] = (
-                        reasoning_parser
-                    )
-                reasoning_delta = reasoning_parser.extract_reasoning_content_streaming(
-                    previous_text=previous_text,
-                    current_text=current_text,
-                    delta_text=delta_text,  #
-                    previous_token_ids=previous_token_ids,  #
-                    current_token_ids=current_token_ids,
-                    delta_token_ids=delta_token_ids,  #
+            if reasoning_splitter is not None:
+                # 只取本次新增的 token id
+                token_ids = request_output.outputs[0].token_ids
+                delta_token_ids = token_ids[previous_num_tokens:]
+                previous_num_tokens = len(token_ids)
+                ret["text"], ret["reasoning_content"] = reasoning_splitter.feed(
+                    delta_text, delta_token_ids
                 )
-                if reasoning_delta is not None:
-                    ret["text"] = (
-                        reasoning_delta.content if reasoning_delta.content else ""
-                    )
-                    ret["reasoning_content"] = (
-                        reasoning_delta.reasoning_content
-                        if reasoning_delta.reasoning_content
-                        else ""
-                    )
-                # previous_text = current_text
-                previous_token_ids = current_token_ids
 
             yield ret
             previous_text = current_text
-            if aborted:
-                break
         logger.info(f"Lora: {request_output.lora_request}")
         logger.info(current_text)
         logger.info(usage)
@@ -1,10 +1,122 @@
-from typing import Optional
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Callable, List, Optional
 from lmdeploy.model import MODELS, Qwen7BChat, ChatGLM3, get_text
+import hashlib
 import json
+import threading
+
+import orjson
+
+
+def content_hash(obj) -> bytes:
+    return hashlib.blake2b(orjson.dumps(obj), digest_size=16).digest()
+
+
+class PromptCache:
+    """渲染结果的线程安全 LRU 缓存（messages2prompt 在 asyncio.to_thread 中并发调用）"""
+
+    def __init__(self, max_size: int = 1024):
+        self.max_size = max_size
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: bytes, record: bool = True) -> Optional[str]:
+        with self.lock:
+            value = self.cache.get(key)
+            if value is not None:
+                self.cache.move_to_end(key)
+            if record:
+                if value is None:
+                    self.misses += 1
+                else:
+                    self.hits += 1
+            return value
+
+    def record(self, hit: bool):
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def put(self, key: bytes, value: str):
+        with self.lock:
+            self.cache[key] = value
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.max_size:
+                self.cache.popitem(last=False)
+
+    def metrics(self):
+        with self.lock:
+            return {"size": len(self.cache), "hits": self.hits, "misses": self.misses}
+
+
+class CachedPromptMixin(ABC):
+    """缓存 system + tools 部分以及之前轮次的渲染结果
+
+    多轮的 agent 请求中 tools 和历史消息通常不变，只有最后几条消息是新的：
+    - header（system + tools）按内容 hash 缓存，不再逐个 json.dumps tools
+    - 之前轮次的渲染结果按消息的链式 hash 缓存，只渲染新增的消息
+    """
+
+    def init_prompt_cache(self, max_size: int = 1024):
+        self.header_cache = PromptCache(max_size)
+        self.prefix_cache = PromptCache(max_size)
+
+    def cached_header(self, key, render: Callable[[], str]) -> str:
+        key = content_hash(key)
+        header = self.header_cache.get(key)
+        if header is None:
+            header = render()
+            self.header_cache.put(key, header)
+        return header
+
+    def prefix_closed(self, messages: List[dict], end: int) -> bool:
+        """messages[:end] 的渲染结果是否与之后的消息无关，只有这样的前缀可以缓存"""
+        return True
+
+    @abstractmethod
+    def render_message(self, messages: List[dict], index: int) -> str:
+        pass
+
+    def render_messages(self, messages: List[dict], seed) -> str:
+        """渲染 messages，seed 是影响渲染结果的其它内容（如 header）"""
+        keys = []
+        hasher = hashlib.blake2b(orjson.dumps(seed), digest_size=16)
+        for message in messages:
+            hasher.update(orjson.dumps(message))
+            keys.append(hasher.copy().digest())
+        # 从后往前查找已缓存的最长前缀
+        start, ret = 0, ""
+        for end in range(len(messages), 0, -1):
+            if self.prefix_closed(messages, end):
+                cached = self.prefix_cache.get(keys[end - 1], record=False)
+                if cached is not None:
+                    start, ret = end, cached
+                    break
+        self.prefix_cache.record(start > 0)
+        parts = [ret]
+        for index in range(start, len(messages)):
+            parts.append(self.render_message(messages, index))
+        # 缓存当前最长的可缓存前缀，下一轮请求可以直接复用
+        for end in range(len(messages), start, -1):
+            if self.prefix_closed(messages, end):
+                self.prefix_cache.put(keys[end - 1], "".join(parts[: end - start + 1]))
+                break
+        return "".join(parts)
+
+    def prompt_cache_metrics(self):
+        return {
+            "header": self.header_cache.metrics(),
+            "prefix": self.prefix_cache.metrics(),
+        }
 
 
 @MODELS.register_module(name="glm4", force=True)
-class Glm4Chat(ChatGLM3):
+class Glm4Chat(CachedPromptMixin, ChatGLM3):
     """Chat template of glm-4 model."""
 
     def __init__(
@@ -42,6 +154,7 @@ Action Input: {{"a": "1","b": "2"}}
         self.start = "[gMASK]<sop>"
         self.tools = tools
         self.eotools = eotools
+        self.init_prompt_cache()
 
     @classmethod
     def match(cls, model_path: str) -> Optional[str]:
@@ -81,6 +194,38 @@ Action Input: {{"a": "1","b": "2"}}
 
         if isinstance(messages, str):
             return self.get_prompt(messages, sequence_start)
+        ret = ""
+        system = None
+        if self.meta_instruction is not None and sequence_start:
+            if len(messages) and messages[0]["role"] != "system":
+                ret += f"{self.system}{self.meta_instruction}{self.eosys}"
+        if tools is not None and len(tools) > 0:
+            if len(messages) and messages[0]["role"] == "system":
+                # 切片而不是 pop，不修改调用方的 messages
+                system = messages[0]["content"]
+                messages = messages[1:]
+            ret += self.cached_header(
+                ("glm4", system, tools), lambda: self.render_tools(system, tools)
+            )
+        ret += self.render_messages(messages, ("glm4", ret))
+        eoa = self.eoa + self.separator
+        if len(messages) and messages[-1]["role"] == "assistant" and len(eoa) > 0:
+            return ret[: -len(eoa)]  # prefix of response
+        ret += f"{self.assistant}"
+        return ret
+
+    def render_tools(self, system: Optional[str], tools: List[dict]) -> str:
+        tool_names = ",".join(tool["function"]["name"] for tool in tools)
+        eotools = self.eotools.format(tool_names=tool_names)
+        tool_prompt = ""
+        for tool in tools:
+            tool_prompt += self.separator
+            tool_prompt += f'{{"type": "function", "function": {json.dumps(tool, ensure_ascii=False)}}}'
+        if system is None:
+            system = self.meta_instruction
+        return f"{self.system}{system}{self.tools}{tool_prompt}{eotools}{self.eosys}"
+
+    def render_message(self, messages: List[dict], index: int) -> str:
         box_map = dict(
             user=self.user, assistant=self.assistant, system=self.system, tool=self.tool
         )
@@ -90,42 +235,13 @@ Action Input: {{"a": "1","b": "2"}}
             system=self.eosys,
             tool=self.eotool,
         )
-        ret = ""
-        if self.meta_instruction is not None and sequence_start:
-            if len(messages) and messages[0]["role"] != "system":
-                ret += f"{self.system}{self.meta_instruction}{self.eosys}"
-        tool_prompt = ""
-        if tools is not None and len(tools) > 0:
-            tool_names = []
-            for tool in tools:
-                tool_names.append(tool["function"]["name"])
-            tool_names = ",".join(tool_names)
-            eotools = self.eotools.format(tool_names=tool_names)
-            for tool in tools:
-                tool_prompt += self.separator
-                tool_prompt += f'{{"type": "function", "function": {json.dumps(tool, ensure_ascii=False)}}}'
-            if len(messages) and messages[0]["role"] == "system":
-                ret += f"{self.system}{messages[0]['content']}{self.tools}{tool_prompt}{eotools}{self.eosys}"
-                messages.pop(0)
-            else:
-                ret += f"{self.system}{self.meta_instruction}{self.tools}{tool_prompt}{eotools}{self.eosys}"
-
-        for message in messages:
-            role = message["role"]
-            content = get_text(message["content"])
-            ret += f"{box_map[role]}{content}{eox_map[role]}"
-        if (
-            len(messages)
-            and messages[-1]["role"] == "assistant"
-            and len(eox_map["assistant"]) > 0
-        ):
-            return ret[: -len(eox_map["assistant"])]  # prefix of response
-        ret += f"{self.assistant}"
-        return ret
+        role = messages[index]["role"]
+        content = get_text(messages[index]["content"])
+        return f"{box_map[role]}{content}{eox_map[role]}"
 
 
 @MODELS.register_module(name="qwen2_5")
-class Qwen2d5Chat(Qwen7BChat):
+class Qwen2d5Chat(CachedPromptMixin, Qwen7BChat):
     """Chat template for Qwen2.5-Instruct series."""
 
     def __init__(
@@ -168,6 +284,7 @@ class Qwen2d5Chat(Qwen7BChat):
             stop_words=stop_words,
             **kwargs,
         )
+        self.init_prompt_cache()
 
     def messages2prompt(
         self, messages, sequence_start=True, tools=None, enable_thinking=None, **kwargs
@@ -182,61 +299,77 @@ class Qwen2d5Chat(Qwen7BChat):
         """
         if isinstance(messages, str):
             return self.get_prompt(messages, sequence_start)
-        box_map = dict(user=self.user, assistant=self.assistant, system=self.system)
-        ret = ""
-        tool_prompt = ""
+        system = None
+        if len(messages) and messages[0]["role"] == "system":
+            system = messages[0]["content"]
+        ret = self.cached_header(
+            ("qwen2_5", system, tools, sequence_start),
+            lambda: self.render_header(system, tools, sequence_start),
+        )
+        ret += self.render_messages(messages, ("qwen2_5", ret))
+        ret += f"{self.assistant}"
+        if enable_thinking is False:
+            ret += "<think>\n\n</think>\n\n"
+        return ret
+
+    def render_header(
+        self, system: Optional[str], tools: Optional[List[dict]], sequence_start: bool
+    ) -> str:
         if tools is not None and len(tools) > 0:
+            tool_prompt = ""
             for tool in tools:
                 tool_prompt += self.separator
                 tool_prompt += f'{{"type": "function", "function": {json.dumps(tool, ensure_ascii=False)}}}'
-            if len(messages) and messages[0]["role"] == "system":
-                ret += f"{self.system}{messages[0]['content']}{self.tools}{tool_prompt}{self.eotools}{self.eosys}"
-            else:
-                ret += f"{self.system}{self.meta_instruction}{self.tools}{tool_prompt}{self.eotools}{self.eosys}"
-        else:
-            if self.meta_instruction is not None and sequence_start:
-                if len(messages) and messages[0]["role"] == "system":
-                    ret += f"{self.system}{messages[0]['content']}{self.eosys}"
-                else:
-                    ret += f"{self.system}{self.meta_instruction}{self.eosys}"
+            if system is None:
+                system = self.meta_instruction
+            return f"{self.system}{system}{self.tools}{tool_prompt}{self.eotools}{self.eosys}"
+        if self.meta_instruction is not None and sequence_start:
+            if system is None:
+                system = self.meta_instruction
+            return f"{self.system}{system}{self.eosys}"
+        return ""
 
-        for index, message in enumerate(messages):
+    def prefix_closed(self, messages: List[dict], end: int) -> bool:
+        # 连续的 tool 消息合并为一个 user 轮次，结尾取决于下一条消息
+        return messages[end - 1]["role"] != "tool"
+
+    def render_message(self, messages: List[dict], index: int) -> str:
+        box_map = dict(user=self.user, assistant=self.assistant, system=self.system)
+        message = messages[index]
+        ret = ""
+        if (
+            message["role"] == "user"
+            or (message["role"] == "system" and index != 0)
+            or (message["role"] == "assistant" and message.get("tool_calls") is None)
+        ):
+            ret += f"{box_map[message['role']]}{message['content']}{self.eosys}"
+        elif message["role"] == "assistant":
+            name = message.get("name", "")
+            ret += f"<|im_start|>assistant name: {name}"
             if (
-                message["role"] == "user"
-                or (message["role"] == "system" and index != 0)
-                or (
-                    message["role"] == "assistant" and message.get("tool_calls") is None
-                )
-            ):
-                ret += f"{box_map[message['role']]}{message['content']}{self.eosys}"
-            elif message["role"] == "assistant":
-                name = message.get("name", "")
-                ret += f"<|im_start|>assistant name: {name}"
-                if (
-                    message.get("content")
-                    is not None
-                    # and message.get("tool_calls") is None
-                ):  # 是否添加and message.get("tool_calls") is None 来去掉带tool的 content内容
-                    ret += f"{self.separator}{message['content']}"
-
-                if message.get("tool_calls") is not None:
-                    tool_calls = message["tool_calls"]
-                    for tool_call in tool_calls:
-                        if tool_call.get("function") is not None:
-                            tool_call = tool_call["function"]
-                        if isinstance(tool_call["arguments"], str):
-                            tool_call["arguments"] = json.loads(tool_call["arguments"])
-                        ret += f'{self.separator}<tool_call>{self.separator}{{"name": "{tool_call["name"]}", "arguments": {json.dumps(tool_call["arguments"], ensure_ascii=False)}}}{self.separator}</tool_call>'
-                ret += self.eosys
-            if message["role"] == "tool":
-                if index == 0 or messages[index - 1]["role"] != "tool":
-                    ret += f"<|im_start|>user"
-                ret += f"{self.separator}<tool_response>{self.separator}{message['content']}{self.separator}</tool_response>"
-                if index == len(messages) - 1 or messages[index + 1]["role"] != "tool":
-                    ret += f"{self.eoh}"
-        ret += f"{self.assistant}"
-        if enable_thinking is False:
-            ret += "<think>\n\n</think>\n\n"
+                message.get("content")
+                is not None
+                # and message.get("tool_calls") is None
+            ):  # 是否添加and message.get("tool_calls") is None 来去掉带tool的 content内容
+                ret += f"{self.separator}{message['content']}"
+
+            if message.get("tool_calls") is not None:
+                tool_calls = message["tool_calls"]
+                for tool_call in tool_calls:
+                    if tool_call.get("function") is not None:
+                        tool_call = tool_call["function"]
+                    # 解析到局部变量，不修改调用方的消息（前缀 hash 基于原始内容）
+                    arguments = tool_call["arguments"]
+                    if isinstance(arguments, str):
+                        arguments = json.loads(arguments)
+                    ret += f'{self.separator}<tool_call>{self.separator}{{"name": "{tool_call["name"]}", "arguments": {json.dumps(arguments, ensure_ascii=False)}}}{self.separator}</tool_call>'
+            ret += self.eosys
+        if message["role"] == "tool":
+            if index == 0 or messages[index - 1]["role"] != "tool":
+                ret += f"<|im_start|>user"
+            ret += f"{self.separator}<tool_response>{self.separator}{message['content']}{self.separator}</tool_response>"
+            if index == len(messages) - 1 or messages[index + 1]["role"] != "tool":
+                ret += f"{self.eoh}"
         return ret
 
     @classmethod
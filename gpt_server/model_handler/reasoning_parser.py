@@ -1,7 +1,7 @@
 # Copyright (c) OpenMMLab. All rights reserved.
 # modified from https://github.com/vllm-project/vllm/tree/v0.7.3/vllm/entrypoints/openai/reasoning_parsers
 import re
-from typing import Optional, Sequence, Tuple, Union
+from typing import NamedTuple, Optional, Sequence, Tuple, Union
 
 from lmdeploy.serve.openai.protocol import ChatCompletionRequest, DeltaMessage
 
@@ -160,3 +160,78 @@ class DeepSeekR1ReasoningParser(ReasoningParser):
                 return reasoning_content, None
 
             return reasoning_content, final_output
+
+
+class ThinkTokens(NamedTuple):
+    start: str
+    end: str
+    start_id: Optional[int]
+    end_id: Optional[int]
+
+
+# 各 reasoning_parser 使用的思考标记，未列出的默认使用 <think></think>
+THINK_TAGS = {
+    "deepseek-r1": ("<think>", "</think>"),
+    "qwen-qwq": ("<think>", "</think>"),
+}
+
+
+def resolve_think_tokens(parser_type: str, tokenizer: object) -> ThinkTokens:
+    """查找思考标记的 token id，结果与请求无关，可以按 parser_type 缓存"""
+    start, end = THINK_TAGS.get(parser_type, ("<think>", "</think>"))
+    vocab = tokenizer.get_vocab()
+    return ThinkTokens(start, end, vocab.get(start), vocab.get(end))
+
+
+class ReasoningSplitter:
+    """单个请求的流式思考内容拆分状态机
+
+    只处理每次的增量文本和增量 token id，用 in_think 记录是否仍在思考中，
+    每个 chunk 的开销与增量长度成正比，与已生成的长度无关。
+    与 DeepSeekR1ReasoningParser 一致：</think> 之前（即使没有 <think>）都是思考内容。
+    """
+
+    def __init__(self, think_tokens: ThinkTokens):
+        self.think_tokens = think_tokens
+        self.in_think = True
+
+    def feed(
+        self, delta_text: str, delta_token_ids: Optional[Sequence[int]] = None
+    ) -> Tuple[str, str]:
+        """返回 (content, reasoning_content)"""
+        if not self.in_think:
+            return delta_text, ""
+        think_tokens = self.think_tokens
+        if delta_token_ids and think_tokens.end_id is not None:
+            think_end = think_tokens.end_id in delta_token_ids
+        else:
+            # 没有 token id 时按文本判断
+            think_end = think_tokens.end in delta_text
+        if not think_end:
+            return "", self.strip_start(delta_text)
+        self.in_think = False
+        end_index = delta_text.find(think_tokens.end)
+        if end_index < 0:
+            return "", self.strip_start(delta_text)
+        reasoning_content = self.strip_start(delta_text[:end_index])
+        content = delta_text[end_index + len(think_tokens.end) :]
+        return content, reasoning_content
+
+    def strip_start(self, text: str) -> str:
+        start = self.think_tokens.start
+        if start in text:
+            return text.replace(start, "", 1)
+        return text
+
+
+def create_reasoning_splitter(
+    parser_type: Optional[str], tokenizer: object, cache: dict
+) -> Optional[ReasoningSplitter]:
+    """每个请求创建独立的拆分状态，思考标记的 token id 按 parser_type 缓存在 cache 中"""
+    if not parser_type:
+        return None
+    think_tokens = cache.get(parser_type)
+    if think_tokens is None:
+        think_tokens = resolve_think_tokens(parser_type, tokenizer)
+        cache[parser_type] = think_tokens
+    return ReasoningSplitter(think_tokens)
@@ -1,24 +1,22 @@
+from abc import ABC, abstractmethod
+import copy
 import json
 import uuid
 from loguru import logger
 import re
-from typing import Dict, List, Literal, Sequence, Union, Optional
+from typing import Dict, List, Literal, Sequence, Tuple, Union, Optional
 
-import partial_json_parser
 from pydantic import BaseModel, Field
 import shortuuid
-from partial_json_parser.core.options import Allow
 
 from lmdeploy.serve.openai.protocol import (
     ChatCompletionRequest,
-    DeltaFunctionCall,
     DeltaMessage,
     DeltaToolCall,
     FunctionCall,
 )
 
 from lmdeploy.serve.openai.tool_parser import ToolParser, ToolParserManager
-from lmdeploy.serve.openai.tool_parser.utils import extract_intermediate_diff
 from lmdeploy.serve.openai.tool_parser import ToolParser
 
 
@@ -56,6 +54,9 @@ class GLMToolParser(ToolParser):
             return obj.get("arguments")
         return None
 
+    def create_streamer(self) -> "GLMToolCallStreamer":
+        return GLMToolCallStreamer()
+
     def extract_tool_calls(
         self,
         model_output: str,
@@ -94,7 +95,6 @@ class Qwen2d5ToolParser(ToolParser):
 
     def __init__(self, tokenizer: object):
         super().__init__(tokenizer)
-        self.position = 0
         self.tool_start_token = "<tool_call>"
         self.tool_end_token = "</tool_call>"
         self.pattern = r"<tool_call>(.*?)</tool_call>"
@@ -106,146 +106,8 @@ class Qwen2d5ToolParser(ToolParser):
             return obj.get("arguments")
         return None
 
-    def extract_tool_calls_streaming(
-        self,
-        previous_text: str,
-        current_text: str,
-        delta_text: str,
-        previous_token_ids: Sequence[int],
-        current_token_ids: Sequence[int],
-        delta_token_ids: Sequence[int],
-        request: ChatCompletionRequest,
-    ) -> Union[DeltaMessage, None]:
-        if self.tool_start_token not in current_text:
-            self.position = len(current_text)
-            return DeltaMessage(content=delta_text)
-        # if the tool call is sended, return a empty delta message
-        # to make sure the finish_reason will be send correctly.
-        if self.current_tool_id > 0:
-            return DeltaMessage(content="")
-
-        last_pos = self.position
-        if self.tool_start_token not in current_text[last_pos:]:
-            return None
-
-        new_delta = current_text[last_pos:]
-        text, action = new_delta.split(self.tool_start_token)
-
-        if len(text) > 0:
-            self.position = self.position + len(text)
-            return DeltaMessage(content=text)
-
-        action = action.strip()
-        action = action.split(self.tool_end_token.strip())[0]
-
-        # bit mask flags for partial JSON parsing. If the name hasn't been
-        # sent yet, don't allow sending
-        # an incomplete string since OpenAI only ever (as far as I have
-        # seen) allows sending the entire tool/ function name at once.
-        flags = Allow.ALL if self.current_tool_name_sent else Allow.ALL & ~Allow.STR
-
-        try:
-            parsable_arr = action
-
-            # tool calls are generated in an object in inernlm2
-            # it's not support parallel tool calls
-            try:
-                tool_call_arr: Dict = partial_json_parser.loads(parsable_arr, flags)
-            except partial_json_parser.core.exceptions.MalformedJSON:
-                logger.debug("not enough tokens to parse into JSON yet")
-                return None
-
-            # if the current tool name hasn't been sent, send if available
-            # - otherwise send nothing
-            if not self.current_tool_name_sent:
-                function_name = tool_call_arr.get("name")
-                if function_name:
-                    self.current_tool_id = self.current_tool_id + 1
-                    delta = DeltaMessage(
-                        tool_calls=[
-                            DeltaToolCall(
-                                index=self.current_tool_id,
-                                type="function",
-                                id=f"chatcmpl-tool-{shortuuid.random()}",
-                                function=DeltaFunctionCall(
-                                    name=function_name
-                                ).model_dump(exclude_none=True),
-                            )
-                        ]
-                    )
-                    self.current_tool_name_sent = True
-                    self.streamed_args_for_tool.append("")
-                else:
-                    delta = None
-            # now we know we're on the same tool call and we're streaming
-            # arguments
-            else:
-                prev_arguments = self.get_argments(
-                    self.prev_tool_call_arr[self.current_tool_id]
-                )
-                cur_arguments = self.get_argments(tool_call_arr)
-
-                # not arguments generated
-                if not cur_arguments and not prev_arguments:
-                    delta = None
-                # will never happen
-                elif not cur_arguments and prev_arguments:
-                    logger.error(
-                        "INVARIANT - impossible to have arguments reset "
-                        "mid-arguments"
-                    )
-                    delta = None
-                # first time to get parameters
-                elif cur_arguments and not prev_arguments:
-                    cur_arguments_json = json.dumps(cur_arguments, ensure_ascii=False)
-
-                    arguments_delta = cur_arguments_json[
-                        : cur_arguments_json.index(delta_text) + len(delta_text)
-                    ]
-                    delta = DeltaMessage(
-                        tool_calls=[
-                            DeltaToolCall(
-                                index=self.current_tool_id,
-                                function=DeltaFunctionCall(
-                                    arguments=arguments_delta
-                                ).model_dump(exclude_none=True),
-                            )
-                        ]
-                    )
-                    self.streamed_args_for_tool[self.current_tool_id] += arguments_delta
-                # both prev and cur parameters, send the increase parameters
-                elif cur_arguments and prev_arguments:
-                    cur_args_json = json.dumps(cur_arguments, ensure_ascii=False)
-                    prev_args_json = json.dumps(prev_arguments, ensure_ascii=False)
-
-                    argument_diff = extract_intermediate_diff(
-                        cur_args_json, prev_args_json
-                    )
-
-                    delta = DeltaMessage(
-                        tool_calls=[
-                            DeltaToolCall(
-                                index=self.current_tool_id,
-                                function=DeltaFunctionCall(
-                                    arguments=argument_diff
-                                ).model_dump(exclude_none=True),
-                            )
-                        ]
-                    )
-                    self.streamed_args_for_tool[self.current_tool_id] += argument_diff
-
-            # check to see if the name is defined and has been sent. if so,
-            # stream the name - otherwise keep waiting
-            # finish by setting old and returning None as base case
-            tool_call_arr["arguments"] = self.get_argments(tool_call_arr)
-            self.prev_tool_call_arr = [tool_call_arr]
-            return delta
-        except Exception:
-            logger.exception("Error trying to handle streaming tool call.")
-            logger.debug(
-                "Skipping chunk as a result of tool streaming extraction " "error"
-            )
-            return None
+    def create_streamer(self) -> "QwenToolCallStreamer":
+        return QwenToolCallStreamer(self.tool_start_token, self.tool_end_token)
 
     def extract_tool_calls(
         self,
@@ -313,6 +175,305 @@ class Qwen2d5ToolParser(ToolParser):
         )
 
 
+def partial_tag_len(text: str, tag: str) -> int:
+    """text 末尾与 tag 前缀重合的最长长度，这部分可能是 tag 的开头，需要暂缓输出"""
+    for n in range(min(len(text), len(tag) - 1), 0, -1):
+        if text.endswith(tag[:n]):
+            return n
+    return 0
+
+
+class JsonObjectScanner:
+    """可恢复的 JSON 对象扫描器
+
+    逐字符跟踪顶层对象的字段名、字符串与嵌套深度，跨多次 feed 保持状态，
+    每次 feed 的开销只与增量长度有关。name 字段解码后保存在 self.name，
+    arguments / parameters 字段的原始 JSON 文本按增量返回。
+    """
+
+    ARGUMENT_KEYS = ("arguments", "parameters")
+
+    def __init__(self):
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+        # 顶层是否在等待字段名，以及当前值所属的字段
+        self.expect_key = False
+        self.key = None
+        # 正在收集的顶层字符串（字段名、name 或字符串形式的 arguments）
+        self.collect = None
+        self.collect_target = None
+        self.name = None
+        # 是否正在输出对象 / 数组形式的 arguments
+        self.capturing = False
+
+    def feed(self, text: str) -> Tuple[int, str]:
+        """返回 (顶层对象结束后的位置，未结束为 -1, arguments 的增量文本)"""
+        fragments = []
+        capture_start = 0 if self.capturing else None
+        for i, char in enumerate(text):
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif char == "\\":
+                    self.escape = True
+                elif char == '"':
+                    self.in_string = False
+                    if self.collect is not None:
+                        self.end_top_level_string(fragments)
+                    continue
+                if self.collect is not None:
+                    self.collect.append(char)
+                continue
+            if char == '"':
+                self.in_string = True
+                if self.depth == 1:
+                    if self.expect_key:
+                        self.collect, self.collect_target = [], "key"
+                    elif self.key == "name":
+                        self.collect, self.collect_target = [], "name"
+                    elif self.key in self.ARGUMENT_KEYS:
+                        self.collect, self.collect_target = [], "arguments"
+            elif char in "{[":
+                self.depth += 1
+                if self.depth == 1:
+                    self.expect_key = True
+                elif self.depth == 2 and self.key in self.ARGUMENT_KEYS:
+                    self.capturing = True
+                    capture_start = i
+            elif char in "}]":
+                self.depth -= 1
+                if self.depth == 1 and self.capturing:
+                    self.capturing = False
+                    fragments.append(text[capture_start : i + 1])
+                    capture_start = None
+                elif self.depth == 0:
+                    return i + 1, "".join(fragments)
+            elif self.depth == 1:
+                if char == ":":
+                    self.expect_key = False
+                elif char == ",":
+                    self.expect_key = True
+                    self.key = None
+        if self.capturing and capture_start is not None:
+            fragments.append(text[capture_start:])
+        return -1, "".join(fragments)
+
+    def end_top_level_string(self, fragments: List[str]):
+        value = json.loads('"' + "".join(self.collect) + '"')
+        if self.collect_target == "key":
+            self.key = value
+        elif self.collect_target == "name":
+            self.name = value
+        else:
+            # arguments 本身是 JSON 字符串
+            fragments.append(value)
+        self.collect = self.collect_target = None
+
+
+class ToolCallStreamer(ABC):
+    """单个请求的流式工具调用提取
+
+    feed 输入增量文本，返回 (普通文本, tool_calls 增量)。tool_calls 增量采用 OpenAI 流式格式：
+    每个工具调用第一次出现时携带 id、type 和 name，之后只携带 arguments 的增量。
+    """
+
+    def __init__(self):
+        self.buffer = ""
+        self.tool_calls: List[dict] = []
+        # 函数名确定之前收到的 arguments
+        self.pending_arguments = ""
+
+    @property
+    def tools_called(self) -> bool:
+        return len(self.tool_calls) > 0
+
+    def start_tool_call(self, name: str, deltas: List[dict]):
+        index = len(self.tool_calls)
+        tool_call = {
+            "index": index,
+            "id": f"chatcmpl-tool-{shortuuid.random()}",
+            "type": "function",
+            "function": {"name": name, "arguments": ""},
+        }
+        self.tool_calls.append(tool_call)
+        deltas.append(copy.deepcopy(tool_call))
+        if self.pending_arguments:
+            self.add_arguments(self.pending_arguments, deltas)
+            self.pending_arguments = ""
+
+    def add_arguments(self, fragment: str, deltas: List[dict]):
+        if not fragment:
+            return
+        tool_call = self.tool_calls[-1]
+        tool_call["function"]["arguments"] += fragment
+        if deltas and deltas[-1]["index"] == tool_call["index"]:
+            deltas[-1]["function"]["arguments"] += fragment
+        else:
+            deltas.append(
+                {"index": tool_call["index"], "function": {"arguments": fragment}}
+            )
+
+    @abstractmethod
+    def feed(self, delta_text: str) -> Tuple[str, List[dict]]:
+        pass
+
+    @abstractmethod
+    def flush(self) -> str:
+        """生成结束时取出暂缓输出的普通文本"""
+        pass
+
+
+class QwenToolCallStreamer(ToolCallStreamer):
+    """<tool_call>{"name": ..., "arguments": {...}}</tool_call> 格式"""
+
+    TEXT, BODY, AFTER_BODY = range(3)
+
+    def __init__(self, tool_start_token="<tool_call>", tool_end_token="</tool_call>"):
+        super().__init__()
+        self.tool_start_token = tool_start_token
+        self.tool_end_token = tool_end_token
+        self.state = self.TEXT
+        self.scanner = None
+        self.in_tool_call = False
+        # 工具调用之间的空白不作为普通文本输出
+        self.skip_whitespace = False
+
+    def feed(self, delta_text: str) -> Tuple[str, List[dict]]:
+        self.buffer += delta_text
+        texts, deltas = [], []
+        while self.buffer:
+            if self.state == self.TEXT:
+                if self.skip_whitespace:
+                    self.buffer = self.buffer.lstrip()
+                    if not self.buffer:
+                        break
+                index = self.buffer.find(self.tool_start_token)
+                if index < 0:
+                    keep = partial_tag_len(self.buffer, self.tool_start_token)
+                    end = len(self.buffer) - keep
+                    if end > 0:
+                        self.skip_whitespace = False
+                    texts.append(self.buffer[:end])
+                    self.buffer = self.buffer[end:]
+                    break
+                texts.append(self.buffer[:index])
+                self.buffer = self.buffer[index + len(self.tool_start_token) :]
+                self.state = self.BODY
+                self.scanner = JsonObjectScanner()
+            elif self.state == self.BODY:
+                end, fragment = self.scanner.feed(self.buffer)
+                if not self.in_tool_call and self.scanner.name is not None:
+                    self.start_tool_call(self.scanner.name, deltas)
+                    self.in_tool_call = True
+                if self.in_tool_call:
+                    self.add_arguments(fragment, deltas)
+                else:
+                    self.pending_arguments += fragment
+                if end < 0:
+                    self.buffer = ""
+                    break
+                # 没有 name 的工具调用直接丢弃
+                self.in_tool_call = False
+                self.pending_arguments = ""
+                self.buffer = self.buffer[end:]
+                self.state = self.AFTER_BODY
+            else:
+                index = self.buffer.find(self.tool_end_token)
+                if index < 0:
+                    keep = partial_tag_len(self.buffer, self.tool_end_token)
+                    self.buffer = self.buffer[len(self.buffer) - keep :]
+                    break
+                self.buffer = self.buffer[index + len(self.tool_end_token) :]
+                self.state = self.TEXT
+                self.skip_whitespace = True
+        return "".join(texts), deltas
+
+    def flush(self) -> str:
+        text, self.buffer = self.buffer, ""
+        return text if self.state == self.TEXT else ""
+
+
+class GLMToolCallStreamer(ToolCallStreamer):
+    """Action: name / Action Input: {...} / Observation 格式"""
+
+    TEXT, NAME, ARGUMENTS, DONE = range(4)
+
+    def __init__(self):
+        super().__init__()
+        self.state = self.TEXT
+        self.name_chars = []
+        self.arguments_started = False
+
+    def feed(self, delta_text: str) -> Tuple[str, List[dict]]:
+        self.buffer += delta_text
+        texts, deltas = [], []
+        while self.buffer:
+            if self.state == self.TEXT:
+                index = self.buffer.find("Action:")
+                if index < 0:
+                    end = len(self.buffer) - partial_tag_len(self.buffer, "Action:")
+                    texts.append(self.buffer[:end])
+                    self.buffer = self.buffer[end:]
+                    break
+                texts.append(self.buffer[:index])
+                self.buffer = self.buffer[index + len("Action:") :]
+                self.state = self.NAME
+            elif self.state == self.NAME:
+                index = self.buffer.find("Action Input:")
+                if index < 0:
+                    end = len(self.buffer) - partial_tag_len(
+                        self.buffer, "Action Input:"
+                    )
+                    self.name_chars.append(self.buffer[:end])
+                    self.buffer = self.buffer[end:]
+                    break
+                self.name_chars.append(self.buffer[:index])
+                self.buffer = self.buffer[index + len("Action Input:") :]
+                name = "".join(self.name_chars).strip().strip(".")
+                self.start_tool_call(name, deltas)
+                self.state = self.ARGUMENTS
+            elif self.state == self.ARGUMENTS:
+                if not self.arguments_started:
+                    self.buffer = self.buffer.lstrip()
+                    if not self.buffer:
+                        break
+                    self.arguments_started = True
+                index = self.buffer.find("Observation")
+                if index >= 0:
+                    self.add_arguments(self.buffer[:index].rstrip(), deltas)
+                    self.buffer = ""
+                    self.state = self.DONE
+                    break
+                # 末尾的空白和可能是 Observation 开头的部分暂缓输出
+                end = len(self.buffer) - partial_tag_len(self.buffer, "Observation")
+                end = len(self.buffer[:end].rstrip())
+                self.add_arguments(self.buffer[:end], deltas)
+                self.buffer = self.buffer[end:]
+                break
+            else:
+                self.buffer = ""
+        return "".join(texts), deltas
+
+    def flush(self) -> str:
+        text, self.buffer = self.buffer, ""
+        return text if self.state == self.TEXT else ""
+
+
+def merge_tool_call_deltas(tool_calls: List[dict], deltas: List[dict]) -> List[dict]:
+    """把流式的 tool_calls 增量合并为完整的 tool_calls（用于非流式接口）"""
+    for delta in deltas:
+        index = delta.get("index")
+        if index is not None and index < len(tool_calls) and "id" not in delta:
+            function = tool_calls[index]["function"]
+            function["arguments"] = function.get("arguments", "") + delta[
+                "function"
+            ].get("arguments", "")
+        else:
+            tool_calls.append(copy.deepcopy(delta))
+    return tool_calls
+
+
 def tool_parser(full_text: str, tool_parser: ToolParser, tools, ret):
     tool_call_info = tool_parser.extract_tool_calls(full_text, tools)
     tools_called = tool_call_info.tools_called
@@ -323,13 +484,13 @@ def tool_parser(full_text: str, tool_parser: ToolParser, tools, ret):
         ret["text"] = ""
         ret["tool_calls"] = tool_calls
         ret["finish_reason"] = "tool_calls"
-        return json.dumps(ret).encode() + b"\0"
+        return ret
     else:
         logger.info(f"工具解析失败, tool_calls: {tool_calls}")
         ret["text"] = ""
         ret["tool_calls"] = tool_calls
         ret["finish_reason"] = "tool_calls"
-        return json.dumps(ret).encode() + b"\0"
+        return ret
 
 
 if __name__ == "__main__":
@@ -57,6 +57,16 @@ def build_chat_input(tokenizer, messages: List[dict], max_new_tokens: int = 0):
     return torch.LongTensor([input_tokens])
 
 
+def build_chat_prompt(tokenizer, messages: List[dict]):
+    """返回 (prompt, input_ids)，可以在预处理进程池中执行"""
+    input_ids = build_chat_input(tokenizer=tokenizer, messages=messages).tolist()[0]
+    return tokenizer.decode(input_ids), input_ids
+
+
+def build_completion_prompt(tokenizer, text: str):
+    return text, tokenizer(text).input_ids
+
+
 class BaiChuanWorker(ModelWorkerBase):
     def __init__(
         self,
@@ -94,14 +104,16 @@ class BaiChuanWorker(ModelWorkerBase):
                 task = "chat"
             elif isinstance(messages, str):
                 task = "completion"
+            # 分词不在事件循环中执行，配置了 preprocess_workers 时在进程池中执行
             if task == "chat":
-                input_ids = build_chat_input(
-                    tokenizer=self.tokenizer, messages=messages
+                text, input_ids = await self.call_with_tokenizer(
+                    build_chat_prompt, messages
                 )
-                text = self.tokenizer.decode(input_ids.tolist()[0])
             elif task == "completion":
-                text = messages
-                input_ids = self.tokenizer([text], return_tensors="pt").input_ids
+                text, input_ids = await self.call_with_tokenizer(
+                    build_completion_prompt, messages
+                )
+            input_ids = torch.LongTensor([input_ids])
 
             params["messages"] = messages
             params["prompt"] = text
@@ -112,21 +124,21 @@ class BaiChuanWorker(ModelWorkerBase):
             async for ret in self.backend.stream_chat(params=params):
                 response = ret["text"]
 
-                yield json.dumps(ret).encode() + b"\0"
+                yield ret
 
         except torch.cuda.OutOfMemoryError as e:
             ret = {
                 "text": f"{SERVER_ERROR_MSG}\n\n({e})",
                 "error_code": ErrorCode.CUDA_OUT_OF_MEMORY,
             }
-            yield json.dumps(ret).encode() + b"\0"
+            yield ret
         except (ValueError, RuntimeError) as e:
             logger.info(e)
             ret = {
                 "text": f"{SERVER_ERROR_MSG}\n\n({e})",
                 "error_code": ErrorCode.INTERNAL_ERROR,
             }
-            yield json.dumps(ret).encode() + b"\0"
+            yield ret
 
 
 if __name__ == "__main__":
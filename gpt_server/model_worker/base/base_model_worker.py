@@ -8,6 +8,7 @@ import requests
 
 from fastchat.constants import WORKER_HEART_BEAT_INTERVAL
 from fastchat.conversation import Conversation
+from gpt_server.model_backend.base import ModelBackend
 from fastchat.utils import pretty_print_semaphore
 
 
@@ -152,6 +153,7 @@ class BaseModelWorker:
             "model_names": self.model_names,
             "speed": 1,
             "queue_length": self.get_queue_length(),
+            "cancelled_requests": dict(ModelBackend.cancelled_requests),
         }
 
     def count_token(self, params):
@@ -1,6 +1,6 @@
 import asyncio
 from datetime import datetime
-from typing import List
+from typing import Callable, List, Optional, Tuple
 import json
 import sys
 import shutil
@@ -21,6 +21,16 @@ from transformers import (
 import uuid
 from gpt_server.utils import get_free_tcp_port, STATIC_DIR, local_ip
 from gpt_server.model_worker.base.base_model_worker import BaseModelWorker
+from gpt_server.model_handler.tool_parser import merge_tool_call_deltas
+from gpt_server.model_worker.base.preprocess_pool import (
+    PreprocessPool,
+    render_prompt,
+)
+from gpt_server.serving.framing import (
+    FRAME_FORMAT_HEADER,
+    FrameEncoder,
+    negotiate_frame_format,
+)
 
 worker = None
 app = FastAPI()
@@ -64,6 +74,9 @@ async def run_scheduler():
 
 
 class ModelWorkerBase(BaseModelWorker, ABC):
+    # embedding worker 能否直接使用 input_ids，不能时先用模型的 tokenizer 解码为文本
+    supports_input_ids = False
+
     def __init__(
         self,
         controller_addr: str,
@@ -110,7 +123,14 @@ class ModelWorkerBase(BaseModelWorker, ABC):
         self.model = None
         self.backend = None
         self.tokenizer = None
+        # 子类设置 chat template，预处理进程池按名称在子进程中创建相同的 template
+        self.chat_template = None
+        self.chat_template_name = None
         self.load_model_tokenizer(model_path)
+        self.preprocess_pool = None
+        preprocess_workers = int(os.getenv("preprocess_workers", 0))
+        if preprocess_workers > 0 and self.tokenizer is not None:
+            self.preprocess_pool = PreprocessPool(model_path, preprocess_workers)
         self.context_len = self.get_context_length()
         logger.info(f"Loading the model {self.model_names} on worker {worker_id} ...")
         self.init_heart_beat()
@@ -190,12 +210,69 @@ class ModelWorkerBase(BaseModelWorker, ABC):
             self.backend = HFBackend(tokenizer=self.tokenizer, model=self.model)
         logger.info("load_model_tokenizer 完成")
 
+    async def render_prompt(
+        self, messages, tools=None, tokenize: bool = False, **kwargs
+    ) -> Tuple[str, Optional[List[int]]]:
+        """渲染 chat template，tokenize 为 True 时同时返回 token ids
+
+        配置了 preprocess_workers 时在进程池中执行，否则在线程中执行
+        """
+        if self.preprocess_pool is not None:
+            return await self.preprocess_pool.render_prompt(
+                self.chat_template_name, messages, tools, tokenize, **kwargs
+            )
+        return await asyncio.to_thread(
+            render_prompt,
+            self.chat_template,
+            self.tokenizer,
+            messages,
+            tools,
+            tokenize,
+            kwargs,
+        )
+
+    async def call_with_tokenizer(
+        self, func: Callable, *args
+    ) -> Tuple[str, Optional[List[int]]]:
+        """执行 func(tokenizer, *args) -> (prompt, input_ids)，func 需要是模块级函数"""
+        if self.preprocess_pool is not None:
+            return await self.preprocess_pool.call_with_tokenizer(func, *args)
+        return await asyncio.to_thread(func, self.tokenizer, *args)
+
+    def decode_input_ids(self, input_ids: List[List[int]]) -> List[str]:
+        tokenizer = self.tokenizer
+        if tokenizer is None:
+            # embedding worker 不加载 self.tokenizer，按需加载模型自己的 tokenizer
+            tokenizer = getattr(self, "input_tokenizer", None)
+            if tokenizer is None:
+                tokenizer = AutoTokenizer.from_pretrained(
+                    self.model_path, trust_remote_code=True
+                )
+                self.input_tokenizer = tokenizer
+        return tokenizer.batch_decode(input_ids, skip_special_tokens=True)
+
+    async def count_token_async(self, params):
+        if self.preprocess_pool is None:
+            return await asyncio.to_thread(self.count_token, params)
+        return {
+            "count": await self.preprocess_pool.count_tokens(params["prompt"]),
+            "error_code": 0,
+        }
+
     async def generate_gate(self, params):
         full_text = ""
+        ret = {}
+        tool_calls = None
         async for ret in self.generate_stream_gate(params):
-            full_text += json.loads(ret[:-1].decode()).get("text", "")
-        ret = json.loads(ret[:-1].decode())
+            full_text += ret.get("text", "")
+            if ret.get("tool_calls"):
+                # 流式输出的 tool_calls 是增量，需要合并为完整的 tool_calls
+                tool_calls = merge_tool_call_deltas(tool_calls or [], ret["tool_calls"])
         ret["text"] = full_text
+        if tool_calls is not None:
+            for tool_call in tool_calls:
+                tool_call.pop("index", None)
+            ret["tool_calls"] = tool_calls
         return ret
 
     @classmethod
@@ -243,6 +320,12 @@ class ModelWorkerBase(BaseModelWorker, ABC):
         parser.add_argument("--enable_prefix_caching", type=str, default="False")
         parser.add_argument("--dtype", type=str, default="auto")
         parser.add_argument("--max_model_len", type=str, default=None)
+        # max_num_seqs hf 后端连续批处理的最大并发序列数
+        parser.add_argument("--max_num_seqs", type=str, default=None)
+        # grammar_warmup_schemas 启动时预编译的 JSON schema 列表
+        parser.add_argument("--grammar_warmup_schemas", type=str, default=None)
+        # preprocess_workers chat template 渲染和分词的进程数，0 表示在线程中执行
+        parser.add_argument("--preprocess_workers", type=str, default=None)
         parser.add_argument("--gpu_memory_utilization", type=str, default="0.8")
         # kv_cache_quant_policy
         parser.add_argument("--kv_cache_quant_policy", type=str, default="0")
@@ -273,6 +356,12 @@ class ModelWorkerBase(BaseModelWorker, ABC):
             os.environ["lora"] = args.lora
         if args.max_model_len:
             os.environ["max_model_len"] = args.max_model_len
+        if args.max_num_seqs:
+            os.environ["max_num_seqs"] = args.max_num_seqs
+        if args.grammar_warmup_schemas:
+            os.environ["grammar_warmup_schemas"] = args.grammar_warmup_schemas
+        if args.preprocess_workers:
+            os.environ["preprocess_workers"] = args.preprocess_workers
         if args.vad_model:
             os.environ["vad_model"] = args.vad_model
         if args.punc_model:
@@ -333,6 +422,12 @@ def create_background_tasks(request_id):
     return background_tasks
 
 
+async def encode_frames(generator, frame_format: str):
+    encoder = FrameEncoder(frame_format)
+    async for ret in generator:
+        yield encoder.encode(ret)
+
+
 request_id = 0
 
 
@@ -351,9 +446,15 @@ async def api_generate_stream(request: Request):
     params["request"] = request
     params.pop("prompt")
     logger.debug(f"params {params}")
-    generator = worker.generate_stream_gate(params)
+    # 与 API server 协商帧格式，旧版本的 API server 和 controller 使用 json
+    frame_format = negotiate_frame_format(request.headers.get(FRAME_FORMAT_HEADER))
+    generator = encode_frames(worker.generate_stream_gate(params), frame_format)
     background_tasks = create_background_tasks(request_id)
-    return StreamingResponse(generator, background=background_tasks)
+    return StreamingResponse(
+        generator,
+        background=background_tasks,
+        headers={FRAME_FORMAT_HEADER: frame_format},
+    )
 
 
 @app.post("/worker_generate_voice_stream")
@@ -411,7 +512,7 @@ async def api_get_status(request: Request):
 @app.post("/count_token")
 async def api_count_token(request: Request):
     params = await request.json()
-    return worker.count_token(params)
+    return await worker.count_token_async(params)
 
 
 @app.post("/worker_get_conv_template")
@@ -421,7 +522,8 @@ async def api_get_conv(request: Request):
 
 @app.post("/model_details")
 async def api_model_details(request: Request):
-    return {"context_length": worker.context_len}
+    # API server 按 model_path 加载本地 tokenizer 计数
+    return {"context_length": worker.context_len, "model_path": worker.model_path}
 
 
 @app.post("/worker_get_embeddings")
@@ -429,6 +531,10 @@ async def api_get_embeddings(request: Request):
     params = await request.json()
     await acquire_worker_semaphore()
     logger.debug(f"params {params}")
+    if params.get("input_ids") and not worker.supports_input_ids:
+        params["input"] = await asyncio.to_thread(
+            worker.decode_input_ids, params.pop("input_ids")
+        )
     embedding = await worker.get_embeddings(params)
     release_worker_semaphore()
     return JSONResponse(content=embedding)
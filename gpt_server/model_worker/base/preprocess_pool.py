@@ -0,0 +1,185 @@
+"""chat template 渲染和分词的进程池
+
+渲染长 prompt 和分词是 CPU 密集的 Python 代码，放在线程中执行仍然和事件循环争抢 GIL，
+10 万 token 级别的 prompt 会明显拖慢同一 worker 上其它请求的流式输出。
+进程池中的每个进程各自持有一份 tokenizer 和 chat template，返回渲染后的 prompt 和 token ids，
+较长的 token ids 通过共享内存传回，避免 pickle 大列表。
+"""
+
+import asyncio
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor
+from multiprocessing import shared_memory
+from typing import Callable, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+from loguru import logger
+
+# token ids 数量达到该值时通过共享内存传回
+SHM_MIN_IDS = 16384
+
+# 进程池子进程中的 tokenizer 和 chat template
+_tokenizer = None
+_chat_templates = {}
+
+
+class SharedIds(NamedTuple):
+    """保存在共享内存中的 token ids"""
+
+    name: str
+    length: int
+
+
+def pack_ids(input_ids: Optional[List[int]]):
+    """子进程中调用：较长的 token ids 写入共享内存，由主进程读取后释放"""
+    if input_ids is None or len(input_ids) < SHM_MIN_IDS:
+        return input_ids
+    array = np.asarray(input_ids, dtype=np.int32)
+    shm = shared_memory.SharedMemory(create=True, size=array.nbytes)
+    np.ndarray(array.shape, dtype=np.int32, buffer=shm.buf)[:] = array
+    shm.close()
+    return SharedIds(shm.name, len(array))
+
+
+def unpack_ids(input_ids) -> Optional[List[int]]:
+    if not isinstance(input_ids, SharedIds):
+        return input_ids
+    shm = shared_memory.SharedMemory(name=input_ids.name)
+    try:
+        array = np.ndarray((input_ids.length,), dtype=np.int32, buffer=shm.buf)
+        return array.tolist()
+    finally:
+        shm.close()
+        shm.unlink()
+
+
+def release_ids(future: Future):
+    """等待方已取消时释放子进程创建的共享内存，避免泄漏"""
+    if future.cancelled() or future.exception() is not None:
+        return
+    _, input_ids = future.result()
+    if isinstance(input_ids, SharedIds):
+        try:
+            shm = shared_memory.SharedMemory(name=input_ids.name)
+        except FileNotFoundError:
+            return
+        shm.close()
+        shm.unlink()
+
+
+def get_chat_template(template_name: str):
+    chat_template = _chat_templates.get(template_name)
+    if chat_template is None:
+        from gpt_server.model_handler.prompts import MODELS
+
+        chat_template = MODELS.module_dict[template_name]()
+        _chat_templates[template_name] = chat_template
+    return chat_template
+
+
+def render_prompt(
+    chat_template, tokenizer, messages, tools, tokenize: bool, kwargs: dict
+) -> Tuple[str, Optional[List[int]]]:
+    """渲染 prompt，tokenize 为 True 时同时返回 token ids（进程池和线程共用）"""
+    if isinstance(messages, str):
+        prompt = messages
+    else:
+        prompt = chat_template.messages2prompt(messages, True, tools, **kwargs)
+    input_ids = tokenizer(prompt).input_ids if tokenize else None
+    return prompt, input_ids
+
+
+def count_tokens(tokenizer, prompt: str) -> int:
+    try:
+        return len(tokenizer(prompt).input_ids)
+    except TypeError:
+        return tokenizer.num_tokens(prompt)
+
+
+def _init_process(model_path: str):
+    from transformers import AutoTokenizer
+
+    global _tokenizer
+    _tokenizer = AutoTokenizer.from_pretrained(
+        model_path,
+        trust_remote_code=True,
+        encode_special_tokens=True,
+    )
+
+
+def _ready():
+    return True
+
+
+def _render_prompt(template_name, messages, tools, tokenize, kwargs):
+    chat_template = get_chat_template(template_name) if template_name else None
+    prompt, input_ids = render_prompt(
+        chat_template, _tokenizer, messages, tools, tokenize, kwargs
+    )
+    return prompt, pack_ids(input_ids)
+
+
+def _count_tokens(prompt):
+    return count_tokens(_tokenizer, prompt)
+
+
+def _call_with_tokenizer(func, args):
+    prompt, input_ids = func(_tokenizer, *args)
+    return prompt, pack_ids(input_ids)
+
+
+class PreprocessPool:
+    """worker 的预处理进程池，num_workers 由 model_config 中的 preprocess_workers 配置"""
+
+    def __init__(self, model_path: str, num_workers: int):
+        self.num_workers = num_workers
+        # 主进程可能已经初始化了 CUDA，不能 fork
+        self.executor = ProcessPoolExecutor(
+            max_workers=num_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_process,
+            initargs=(model_path,),
+        )
+        # 提前启动子进程并加载 tokenizer，避免第一批请求等待
+        for _ in range(num_workers):
+            self.executor.submit(_ready)
+        logger.info(f"预处理进程池已启动, 进程数: {num_workers}")
+
+    async def submit(self, func: Callable, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, func, *args)
+
+    async def submit_ids(self, func: Callable, *args):
+        """提交返回 (prompt, input_ids) 的任务，共享内存中的 input_ids 由主进程读取后释放"""
+        future = self.executor.submit(func, *args)
+        try:
+            prompt, input_ids = await asyncio.wrap_future(future)
+        except asyncio.CancelledError:
+            # 子进程可能已在执行，结果返回后仍需释放共享内存
+            future.add_done_callback(release_ids)
+            raise
+        return prompt, unpack_ids(input_ids)
+
+    async def render_prompt(
+        self,
+        template_name: Optional[str],
+        messages,
+        tools=None,
+        tokenize: bool = False,
+        **kwargs,
+    ) -> Tuple[str, Optional[List[int]]]:
+        return await self.submit_ids(
+            _render_prompt, template_name, messages, tools, tokenize, kwargs
+        )
+
+    async def count_tokens(self, prompt: str) -> int:
+        return await self.submit(_count_tokens, prompt)
+
+    async def call_with_tokenizer(
+        self, func: Callable, *args
+    ) -> Tuple[str, Optional[List[int]]]:
+        """在子进程中执行 func(tokenizer, *args)，func 需要是模块级函数并返回 (prompt, input_ids)"""
+        return await self.submit_ids(_call_with_tokenizer, func, args)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -1,4 +1,4 @@
-import asyncio
+import os
 import json
 from typing import List
 from fastchat.constants import ErrorCode, SERVER_ERROR_MSG
@@ -44,7 +44,8 @@ class ChatGLMWorker(ModelWorkerBase):
             model_type="AutoModel",
             multimodal=False,
         )
-        self.chat_template = MODELS.module_dict["glm4"]()
+        self.chat_template_name = "glm4"
+        self.chat_template = MODELS.module_dict[self.chat_template_name]()
         self.tool_parser = ToolParserManager.module_dict["glm"](
             tokenizer=self.tokenizer
         )
@@ -66,17 +67,16 @@ class ChatGLMWorker(ModelWorkerBase):
             elif isinstance(tool_choice, dict):
                 tools = pop_matching_tool(tools=tools, tool_choice=tool_choice)
             if not self.vision_config:
-                if isinstance(messages, list):
-                    text = await asyncio.to_thread(
-                        self.chat_template.messages2prompt, messages, True, tools
-                    )
-                elif isinstance(messages, str):
-                    text = messages
-                    # input_ids = self.tokenizer([text], return_tensors="pt").input_ids
-
-                # text = self.tokenizer.decode(input_ids.tolist()[0])
+                # hf 后端直接使用 token ids，分词和渲染一起完成
+                text, input_ids = await self.render_prompt(
+                    messages,
+                    tools,
+                    tokenize=os.getenv("backend") == "hf"
+                    and not params.get("prompt_token_ids"),
+                )
                 params["prompt"] = text
-                # params["input_ids"] = input_ids
+                if input_ids is not None:
+                    params["input_ids"] = torch.LongTensor([input_ids])
             else:  # 多模态模型
                 params["multimodal"] = True
             # ---------------添加额外的参数------------------------
@@ -86,28 +86,45 @@ class ChatGLMWorker(ModelWorkerBase):
             # ---------------添加额外的参数------------------------
             full_text = ""
             ret = {}
+            # 传入 tools 时边生成边提取工具调用，客户端无需等待生成结束
+            tool_streamer = self.tool_parser.create_streamer() if tools else None
             async for ret in self.backend.stream_chat(params=params):
-                full_text += ret["text"]
-
-                yield json.dumps(ret).encode() + b"\0"
+                full_text += ret.get("text", "")
+                if tool_streamer is not None:
+                    ret["text"], tool_calls = tool_streamer.feed(ret.get("text", ""))
+                    if tool_calls:
+                        ret["tool_calls"] = tool_calls
+                yield ret
             # ------ add tool_calls ------
-            yield tool_parser(
-                full_text=full_text, tool_parser=self.tool_parser, tools=tools, ret=ret
-            )
+            if tool_streamer is not None and tool_streamer.tools_called:
+                ret = {**ret, "text": tool_streamer.flush(), "finish_reason": "tool_calls"}
+                ret.pop("tool_calls", None)
+                ret.pop("reasoning_content", None)
+                yield ret
+            else:
+                tail = tool_streamer.flush() if tool_streamer is not None else ""
+                ret = tool_parser(
+                    full_text=full_text,
+                    tool_parser=self.tool_parser,
+                    tools=tools,
+                    ret=ret,
+                )
+                ret["text"] = tail
+                yield ret
             # ------ add tool_calls ------
         except torch.cuda.OutOfMemoryError as e:
             ret = {
                 "text": f"{SERVER_ERROR_MSG}\n\n({e})",
                 "error_code": ErrorCode.CUDA_OUT_OF_MEMORY,
             }
-            yield json.dumps(ret).encode() + b"\0"
+            yield ret
         except (ValueError, RuntimeError) as e:
             logger.info(e)
             ret = {
                 "text": f"{SERVER_ERROR_MSG}\n\n({e})",
                 "error_code": ErrorCode.INTERNAL_ERROR,
             }
-            yield json.dumps(ret).encode() + b"\0"
+            yield ret
 
 
 if __name__ == "__main__":
@@ -50,6 +50,8 @@ class EmbeddingWorker(ModelWorkerBase):
         enable_prefix_caching = bool(os.getenv("enable_prefix_caching", False))
 
         self.mode = get_embedding_mode(model_path=model_path)
+        # embedding 模式可以直接使用 token ids
+        self.supports_input_ids = self.mode == "embedding"
         self.engine = LLM(
             model=model_path,
             tensor_parallel_size=tensor_parallel_size,
@@ -65,11 +67,16 @@ class EmbeddingWorker(ModelWorkerBase):
         self.call_ct += 1
         ret = {"embedding": [], "token_num": 0}
         texts: list = params["input"]
+        input_ids = params.get("input_ids", None)
         embedding = []
         if self.mode == "embedding":
-            texts = list(map(lambda x: x.replace("\n", " "), texts))
+            if input_ids:
+                # 直接使用客户端传入的 token ids，跳过分词
+                prompts = [{"prompt_token_ids": ids} for ids in input_ids]
+            else:
+                prompts = list(map(lambda x: x.replace("\n", " "), texts))
             # ----------
-            outputs = self.engine.embed(texts)
+            outputs = self.engine.embed(prompts)
             embedding = [o.outputs.embedding for o in outputs]
             embeddings_np = np.array(embedding)
             # ------ L2归一化（沿axis=1，即对每一行进行归一化）-------
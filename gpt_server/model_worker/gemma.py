@@ -58,14 +58,14 @@ class GemmaWorker(ModelWorkerBase):
             async for ret in self.backend.stream_chat(params=params):
                 response = ret["text"]
 
-                yield json.dumps(ret).encode() + b"\0"
+                yield ret
 
         except torch.cuda.OutOfMemoryError as e:
             ret = {
                 "text": f"{SERVER_ERROR_MSG}\n\n({e})",
                 "error_code": ErrorCode.CUDA_OUT_OF_MEMORY,
             }
-            yield json.dumps(ret).encode() + b"\0"
+            yield ret
         except (ValueError, RuntimeError) as e:
             traceback.print_exc()
             logger.info(e)
@@ -73,7 +73,7 @@ class GemmaWorker(ModelWorkerBase):
                 "text": f"{SERVER_ERROR_MSG}\n\n({e})",
                 "error_code": ErrorCode.INTERNAL_ERROR,
             }
-            yield json.dumps(ret).encode() + b"\0"
+            yield ret
 
 
 if __name__ == "__main__":
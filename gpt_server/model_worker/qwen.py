@@ -1,5 +1,6 @@
 import asyncio
 import json
+import os
 from typing import List
 from fastchat.constants import ErrorCode, SERVER_ERROR_MSG
 from loguru import logger
@@ -52,7 +53,8 @@ class QwenWorker(ModelWorkerBase):
         ]
         logger.warning(f"{model_names[0]} 停用词: {self.stop}")
 
-        self.chat_template = MODELS.module_dict["qwen2_5"]()
+        self.chat_template_name = "qwen2_5"
+        self.chat_template = MODELS.module_dict[self.chat_template_name]()
         self.tool_parser = ToolParserManager.module_dict["qwen2_5"](
             tokenizer=self.tokenizer
         )
@@ -73,21 +75,17 @@ class QwenWorker(ModelWorkerBase):
                 tools = pop_matching_tool(tools=tools, tool_choice=tool_choice)
 
             if not self.vision_config:
-                if isinstance(messages, list):
-                    # text = self.chat_template.messages2prompt(messages, True, tools)
-                    text = await asyncio.to_thread(
-                        self.chat_template.messages2prompt,
-                        messages,
-                        True,
-                        tools,
-                        enable_thinking=bool(params.get("enable_thinking", True)),
-                    )
-                elif isinstance(messages, str):
-                    text = messages
-
-                # input_ids = self.tokenizer([text], return_tensors="pt").input_ids
-                # params["input_ids"] = input_ids
+                # hf 后端直接使用 token ids，分词和渲染一起完成
+                text, input_ids = await self.render_prompt(
+                    messages,
+                    tools,
+                    tokenize=os.getenv("backend") == "hf"
+                    and not params.get("prompt_token_ids"),
+                    enable_thinking=bool(params.get("enable_thinking", True)),
+                )
                 params["prompt"] = text
+                if input_ids is not None:
+                    params["input_ids"] = torch.LongTensor([input_ids])
             else:  # 多模态
                 if isinstance(messages, list):
                     text = await asyncio.to_thread(
@@ -113,20 +111,38 @@ class QwenWorker(ModelWorkerBase):
             # ---------------添加额外的参数------------------------
             full_text = ""
             ret = {}
+            # 传入 tools 时边生成边提取工具调用，客户端无需等待生成结束
+            tool_streamer = self.tool_parser.create_streamer() if tools else None
             async for ret in self.backend.stream_chat(params=params):
                 full_text += ret.get("text", "")
-                yield json.dumps(ret).encode() + b"\0"
+                if tool_streamer is not None:
+                    ret["text"], tool_calls = tool_streamer.feed(ret.get("text", ""))
+                    if tool_calls:
+                        ret["tool_calls"] = tool_calls
+                yield ret
             # ------ add tool_calls ------
-            yield tool_parser(
-                full_text=full_text, tool_parser=self.tool_parser, tools=tools, ret=ret
-            )
+            if tool_streamer is not None and tool_streamer.tools_called:
+                ret = {**ret, "text": tool_streamer.flush(), "finish_reason": "tool_calls"}
+                ret.pop("tool_calls", None)
+                ret.pop("reasoning_content", None)
+                yield ret
+            else:
+                tail = tool_streamer.flush() if tool_streamer is not None else ""
+                ret = tool_parser(
+                    full_text=full_text,
+                    tool_parser=self.tool_parser,
+                    tools=tools,
+                    ret=ret,
+                )
+                ret["text"] = tail
+                yield ret
             # ------ add tool_calls ------
         except torch.cuda.OutOfMemoryError as e:
             ret = {
                 "text": f"{SERVER_ERROR_MSG}\n\n({e})",
                 "error_code": ErrorCode.CUDA_OUT_OF_MEMORY,
             }
-            yield json.dumps(ret).encode() + b"\0"
+            yield ret
         except (ValueError, RuntimeError) as e:
             traceback.print_exc()
             logger.info(e)
@@ -134,7 +150,7 @@ class QwenWorker(ModelWorkerBase):
                 "text": f"{SERVER_ERROR_MSG}\n\n({e})",
                 "error_code": ErrorCode.INTERNAL_ERROR,
             }
-            yield json.dumps(ret).encode() + b"\0"
+            yield ret
 
 
 if __name__ == "__main__":
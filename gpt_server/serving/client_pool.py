@@ -0,0 +1,115 @@
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+import importlib.util
+from typing import Dict, Optional
+
+import httpx
+from loguru import logger
+
+
+@dataclass
+class PoolStats:
+    in_flight: int = 0
+    peak_in_flight: int = 0
+    total_requests: int = 0
+    # 发起请求时连接数已达上限，需要排队等待空闲连接的次数
+    saturated_requests: int = 0
+    pool_timeouts: int = 0
+    errors: int = 0
+
+
+class ClientPool:
+    """API server 进程内共享的 HTTP 连接池
+
+    每个 worker（按 scheme://host:port 区分）拥有独立的 httpx.AsyncClient，
+    从而实现按 worker 的连接数上限和长连接复用；对端支持时启用 HTTP/2。
+    """
+
+    def __init__(
+        self,
+        max_connections_per_worker: int = 512,
+        max_keepalive_per_worker: int = 128,
+        keepalive_expiry: float = 60,
+        timeout: Optional[httpx.Timeout] = None,
+    ):
+        self.max_connections_per_worker = max_connections_per_worker
+        self.max_keepalive_per_worker = max_keepalive_per_worker
+        self.keepalive_expiry = keepalive_expiry
+        self.timeout = timeout or httpx.Timeout(3 * 3600, connect=10)
+        # HTTP/2 依赖 h2，未安装时退回 HTTP/1.1
+        self.http2 = importlib.util.find_spec("h2") is not None
+        self.clients: Dict[str, httpx.AsyncClient] = {}
+        self.stats: Dict[str, PoolStats] = {}
+
+    @staticmethod
+    def get_origin(url: str) -> str:
+        url = httpx.URL(url)
+        return f"{url.scheme}://{url.netloc.decode()}"
+
+    def get_client(self, url: str) -> httpx.AsyncClient:
+        origin = self.get_origin(url)
+        client = self.clients.get(origin)
+        if client is None:
+            client = httpx.AsyncClient(
+                http2=self.http2,
+                limits=httpx.Limits(
+                    max_connections=self.max_connections_per_worker,
+                    max_keepalive_connections=self.max_keepalive_per_worker,
+                    keepalive_expiry=self.keepalive_expiry,
+                ),
+                timeout=self.timeout,
+            )
+            self.clients[origin] = client
+            self.stats[origin] = PoolStats()
+            logger.debug(f"create http client for {origin}, http2: {self.http2}")
+        return client
+
+    @asynccontextmanager
+    async def track(self, url: str):
+        origin = self.get_origin(url)
+        stats = self.stats[origin]
+        stats.total_requests += 1
+        if stats.in_flight >= self.max_connections_per_worker:
+            stats.saturated_requests += 1
+        stats.in_flight += 1
+        stats.peak_in_flight = max(stats.peak_in_flight, stats.in_flight)
+        try:
+            yield
+        except httpx.PoolTimeout:
+            stats.pool_timeouts += 1
+            raise
+        except httpx.HTTPError:
+            stats.errors += 1
+            raise
+        finally:
+            stats.in_flight -= 1
+
+    async def post(self, url: str, **kwargs) -> httpx.Response:
+        client = self.get_client(url)
+        async with self.track(url):
+            return await client.post(url, **kwargs)
+
+    @asynccontextmanager
+    async def stream(self, method: str, url: str, **kwargs):
+        client = self.get_client(url)
+        async with self.track(url):
+            async with client.stream(method, url, **kwargs) as response:
+                yield response
+
+    def metrics(self) -> dict:
+        return {
+            "http2": self.http2,
+            "max_connections_per_worker": self.max_connections_per_worker,
+            "workers": {
+                origin: {
+                    **vars(stats),
+                    "saturation": stats.in_flight / self.max_connections_per_worker,
+                }
+                for origin, stats in self.stats.items()
+            },
+        }
+
+    async def aclose(self):
+        for client in self.clients.values():
+            await client.aclose()
+        self.clients.clear()
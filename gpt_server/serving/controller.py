@@ -3,6 +3,7 @@ A controller manages distributed workers.
 It sends worker addresses to clients.
 """
 
+from abc import ABC, abstractmethod
 import argparse
 import asyncio
 import dataclasses
@@ -10,14 +11,14 @@ from enum import Enum, auto
 import json
 import logging
 import os
+import random
 import time
-from typing import List, Union
-import threading
+from typing import Dict, List, Set, Tuple, Union
+from contextlib import asynccontextmanager
 
 from fastapi import FastAPI, Request
 from fastapi.responses import StreamingResponse
-import numpy as np
-import requests
+import httpx
 import uvicorn
 
 from fastchat.constants import (
@@ -27,11 +28,16 @@ from fastchat.constants import (
     SERVER_ERROR_MSG,
 )
 from loguru import logger
+from gpt_server.serving.framing import FrameReader
+
+# 注册表推送流的心跳间隔（秒）
+REGISTRY_PING_INTERVAL = 15
 
 
 class DispatchMethod(Enum):
     LOTTERY = auto()
     SHORTEST_QUEUE = auto()
+    POWER_OF_TWO = auto()
 
     @classmethod
     def from_str(cls, name):
@@ -39,6 +45,8 @@ class DispatchMethod(Enum):
             return cls.LOTTERY
         elif name == "shortest_queue":
             return cls.SHORTEST_QUEUE
+        elif name == "power_of_two":
+            return cls.POWER_OF_TWO
         else:
             raise ValueError(f"Invalid dispatch method")
 
@@ -53,24 +61,108 @@ class WorkerInfo:
     multimodal: bool
 
 
-def heart_beat_controller(controller):
+def normalized_queue_length(w_info: WorkerInfo) -> float:
+    """按处理速度归一化后的排队长度"""
+    return w_info.queue_length / max(w_info.speed, 1e-4)
+
+
+class DispatchStrategy(ABC):
+    """从可用 worker 中选出一个的分发策略"""
+
+    @abstractmethod
+    def select(self, candidates: List[Tuple[str, WorkerInfo]]) -> str:
+        pass
+
+
+class ShortestQueueStrategy(DispatchStrategy):
+    def select(self, candidates: List[Tuple[str, WorkerInfo]]) -> str:
+        return min(candidates, key=lambda item: normalized_queue_length(item[1]))[0]
+
+
+class LotteryStrategy(DispatchStrategy):
+    """按速度加权随机，排队越长的 worker 权重越低"""
+
+    def select(self, candidates: List[Tuple[str, WorkerInfo]]) -> str:
+        weights = [
+            max(w_info.speed, 0) / (w_info.queue_length + 1)
+            for _, w_info in candidates
+        ]
+        if sum(weights) < 1e-4:
+            return random.choice(candidates)[0]
+        return random.choices(candidates, weights=weights)[0][0]
+
+
+class PowerOfTwoStrategy(DispatchStrategy):
+    """随机抽取两个 worker，选择归一化排队长度更短的一个"""
+
+    def select(self, candidates: List[Tuple[str, WorkerInfo]]) -> str:
+        if len(candidates) <= 2:
+            sampled = candidates
+        else:
+            sampled = random.sample(candidates, 2)
+        return min(sampled, key=lambda item: normalized_queue_length(item[1]))[0]
+
+
+dispatch_strategies = {
+    DispatchMethod.LOTTERY: LotteryStrategy,
+    DispatchMethod.SHORTEST_QUEUE: ShortestQueueStrategy,
+    DispatchMethod.POWER_OF_TWO: PowerOfTwoStrategy,
+}
+
+
+async def heart_beat_controller(controller: "Controller"):
     while True:
-        time.sleep(CONTROLLER_HEART_BEAT_EXPIRATION)
-        controller.remove_stale_workers_by_expiration()
+        await asyncio.sleep(CONTROLLER_HEART_BEAT_EXPIRATION)
+        try:
+            controller.remove_stale_workers_by_expiration()
+        except Exception:
+            logger.exception("remove stale workers failed")
 
 
 class Controller:
-    def __init__(self, dispatch_method: str):
+    def __init__(
+        self,
+        dispatch_method: str,
+        status_timeout: float = 5,
+        max_connections: int = 256,
+    ):
         # Dict[str -> WorkerInfo]
         self.worker_info = {}
         self.dispatch_method = DispatchMethod.from_str(dispatch_method)
-
-        self.heart_beat_thread = threading.Thread(
-            target=heart_beat_controller, args=(self,)
+        self.dispatch_strategy: DispatchStrategy = dispatch_strategies[
+            self.dispatch_method
+        ]()
+        # 每个 worker 状态探测的截止时间（秒）
+        self.status_timeout = status_timeout
+        self.max_connections = max_connections
+        # 所有对 worker 的请求共用一个异步连接池，在 lifespan 中创建
+        self.client: httpx.AsyncClient = None
+        self.heart_beat_task: asyncio.Task = None
+        # 并发的 refresh 请求合并为同一次刷新
+        self._refresh_task: asyncio.Task = None
+        # 推送给 API server 的注册表变更流
+        self.registry_version = 0
+        self.registry_subscribers: Set[asyncio.Queue] = set()
+        # Dict[model_name -> epoch]，每次失效加一，经注册表推送流同步到所有 API server 进程
+        self.embedding_cache_epochs: Dict[str, int] = {}
+
+    async def start(self):
+        self.client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=self.max_connections,
+                max_keepalive_connections=self.max_connections,
+            ),
+            timeout=httpx.Timeout(WORKER_API_TIMEOUT, connect=self.status_timeout),
         )
-        self.heart_beat_thread.start()
+        self.heart_beat_task = asyncio.create_task(heart_beat_controller(self))
+
+    async def close(self):
+        if self.heart_beat_task is not None:
+            self.heart_beat_task.cancel()
+        if self.client is not None:
+            await self.client.aclose()
 
-    def register_worker(
+    async def register_worker(
         self,
         worker_name: str,
         check_heart_beat: bool,
@@ -83,27 +175,35 @@ class Controller:
             logger.info(f"Register an existing worker: {worker_name}")
 
         if not worker_status:
-            worker_status = self.get_worker_status(worker_name)
+            worker_status = await self.get_worker_status(worker_name)
         if not worker_status:
             return False
 
-        self.worker_info[worker_name] = WorkerInfo(
-            worker_status["model_names"],
-            worker_status["speed"],
-            worker_status["queue_length"],
-            check_heart_beat,
-            time.time(),
-            multimodal,
+        self.update_worker(
+            worker_name,
+            WorkerInfo(
+                worker_status["model_names"],
+                worker_status["speed"],
+                worker_status["queue_length"],
+                check_heart_beat,
+                time.time(),
+                multimodal,
+            ),
         )
 
         logger.info(f"Register done: {worker_name}, {worker_status}")
         return True
 
-    def get_worker_status(self, worker_name: str):
+    async def get_worker_status(self, worker_name: str):
         try:
-            r = requests.post(worker_name + "/worker_get_status", timeout=5)
-        except requests.exceptions.RequestException as e:
-            logger.error(f"Get status fails: {worker_name}, {e}")
+            r = await asyncio.wait_for(
+                self.client.post(
+                    worker_name + "/worker_get_status", timeout=self.status_timeout
+                ),
+                timeout=self.status_timeout,
+            )
+        except (httpx.HTTPError, asyncio.TimeoutError) as e:
+            logger.error(f"Get status fails: {worker_name}, {e!r}")
             return None
 
         if r.status_code != 200:
@@ -112,18 +212,127 @@ class Controller:
 
         return r.json()
 
+    def update_worker(self, worker_name: str, w_info: WorkerInfo):
+        old_info = self.worker_info.get(worker_name)
+        self.worker_info[worker_name] = w_info
+        if (
+            old_info is not None
+            and old_info.model_names == w_info.model_names
+            and old_info.speed == w_info.speed
+            and old_info.multimodal == w_info.multimodal
+        ):
+            self.publish_queue_length(worker_name, old_info.queue_length)
+        else:
+            self.publish_registry_event(
+                "register", worker_name=worker_name, **self.dump_worker(w_info)
+            )
+
     def remove_worker(self, worker_name: str):
         del self.worker_info[worker_name]
+        self.publish_registry_event("remove", worker_name=worker_name)
 
-    def refresh_all_workers(self):
-        old_info = dict(self.worker_info)
-        self.worker_info = {}
+    @staticmethod
+    def dump_worker(w_info: WorkerInfo) -> dict:
+        return {
+            "model_names": w_info.model_names,
+            "speed": w_info.speed,
+            "queue_length": w_info.queue_length,
+            "multimodal": w_info.multimodal,
+        }
+
+    def publish_queue_length(self, worker_name: str, old_queue_length: int):
+        queue_length = self.worker_info[worker_name].queue_length
+        if queue_length != old_queue_length:
+            self.publish_registry_event(
+                "queue_length", worker_name=worker_name, queue_length=queue_length
+            )
+
+    def publish_registry_event(self, event_type: str, **data):
+        self.registry_version += 1
+        if not self.registry_subscribers:
+            return
+        event = {"type": event_type, "version": self.registry_version, **data}
+        for queue in list(self.registry_subscribers):
+            try:
+                queue.put_nowait(event)
+            except asyncio.QueueFull:
+                # 订阅方消费过慢：清空积压并通知其断开，重连后重新拉取快照
+                self.registry_subscribers.discard(queue)
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait(None)
+
+    def registry_snapshot(self) -> dict:
+        return {
+            "type": "snapshot",
+            "version": self.registry_version,
+            "workers": {
+                w_name: self.dump_worker(w_info)
+                for w_name, w_info in self.worker_info.items()
+            },
+            "embedding_cache_epochs": dict(self.embedding_cache_epochs),
+        }
+
+    def invalidate_embedding_cache(self, model_name: str) -> int:
+        epoch = self.embedding_cache_epochs.get(model_name, 0) + 1
+        self.embedding_cache_epochs[model_name] = epoch
+        self.publish_registry_event(
+            "embedding_cache_epoch", model_name=model_name, epoch=epoch
+        )
+        return epoch
 
-        for w_name, w_info in old_info.items():
-            if not self.register_worker(
-                w_name, w_info.check_heart_beat, None, w_info.multimodal
-            ):
+    async def registry_stream(self, request: Request):
+        """以 SSE 的形式推送注册表快照及之后的所有变更"""
+        queue = asyncio.Queue(maxsize=4096)
+        self.registry_subscribers.add(queue)
+        try:
+            yield f"data: {json.dumps(self.registry_snapshot())}\n\n"
+            while True:
+                try:
+                    event = await asyncio.wait_for(
+                        queue.get(), timeout=REGISTRY_PING_INTERVAL
+                    )
+                except asyncio.TimeoutError:
+                    if await request.is_disconnected():
+                        break
+                    yield ": ping\n\n"
+                    continue
+                if event is None:
+                    break
+                yield f"data: {json.dumps(event)}\n\n"
+        finally:
+            self.registry_subscribers.discard(queue)
+
+    async def refresh_all_workers(self):
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.create_task(self._refresh_all_workers())
+        await asyncio.shield(self._refresh_task)
+
+    async def _refresh_all_workers(self):
+        old_info = dict(self.worker_info)
+        # 并发探测所有 worker，总耗时不超过单个 worker 的截止时间
+        status_list = await asyncio.gather(
+            *[self.get_worker_status(w_name) for w_name in old_info]
+        )
+        for (w_name, w_info), worker_status in zip(old_info.items(), status_list):
+            if self.worker_info.get(w_name) is not w_info:
+                # 刷新期间 worker 已重新注册或被移除，以最新状态为准
+                continue
+            if not worker_status:
                 logger.info(f"Remove stale worker: {w_name}")
+                self.remove_worker(w_name)
+                continue
+            self.update_worker(
+                w_name,
+                WorkerInfo(
+                    worker_status["model_names"],
+                    worker_status["speed"],
+                    worker_status["queue_length"],
+                    w_info.check_heart_beat,
+                    time.time(),
+                    w_info.multimodal,
+                ),
+            )
 
     def list_models(self):
         model_names = set()
@@ -151,74 +360,37 @@ class Controller:
 
         return list(model_names)
 
-    # def get_worker_address_old(self, model_name: str):
-    #     if self.dispatch_method == DispatchMethod.LOTTERY:
-    #         worker_names = []
-    #         worker_speeds = []
-    #         for w_name, w_info in self.worker_info.items():
-    #             if model_name in w_info.model_names:
-    #                 worker_names.append(w_name)
-    #                 worker_speeds.append(w_info.speed)
-    #         worker_speeds = np.array(worker_speeds, dtype=np.float32)
-    #         norm = np.sum(worker_speeds)
-    #         if norm < 1e-4:
-    #             return ""
-    #         worker_speeds = worker_speeds / norm
-    #         if True:  # Directly return address
-    #             pt = np.random.choice(np.arange(len(worker_names)), p=worker_speeds)
-    #             worker_name = worker_names[pt]
-    #             return worker_name
-
-    #         # Check status before returning
-    #         while True:
-    #             pt = np.random.choice(np.arange(len(worker_names)), p=worker_speeds)
-    #             worker_name = worker_names[pt]
-
-    #             if self.get_worker_status(worker_name):
-    #                 break
-    #             else:
-    #                 self.remove_worker(worker_name)
-    #                 worker_speeds[pt] = 0
-    #                 norm = np.sum(worker_speeds)
-    #                 if norm < 1e-4:
-    #                     return ""
-    #                 worker_speeds = worker_speeds / norm
-    #                 continue
-    #         return worker_name
-    #     elif self.dispatch_method == DispatchMethod.SHORTEST_QUEUE:
-    #         worker_names = []
-    #         worker_qlen = []
-    #         for w_name, w_info in self.worker_info.items():
-    #             if model_name in w_info.model_names:
-    #                 worker_names.append(w_name)
-    #                 worker_qlen.append(w_info.queue_length / w_info.speed)
-    #         if len(worker_names) == 0:
-    #             return ""
-    #         min_index = np.argmin(worker_qlen)
-    #         w_name = worker_names[min_index]
-    #         self.worker_info[w_name].queue_length += 1
-    #         logger.info(
-    #             f"names: {worker_names}, queue_lens: {worker_qlen}, ret: {w_name}"
-    #         )
-    #         return w_name
-    #     else:
-    #         raise ValueError(f"Invalid dispatch method: {self.dispatch_method}")
-
-    def get_worker_address(self, model_name: str):
-
+    def get_worker_address_list(self, model_name: str) -> List[str]:
         worker_names = []
         for w_name, w_info in self.worker_info.items():
             if model_name in w_info.model_names:
                 worker_names.append(w_name)
-        return ",".join(worker_names)
+        return worker_names
+
+    def get_worker_address(self, model_name: str) -> str:
+        candidates = [
+            (w_name, w_info)
+            for w_name, w_info in self.worker_info.items()
+            if model_name in w_info.model_names
+        ]
+        if not candidates:
+            return ""
+        w_name = self.dispatch_strategy.select(candidates)
+        # 乐观地增加排队长度，直到下一次心跳上报真实值
+        self.worker_info[w_name].queue_length += 1
+        self.publish_queue_length(w_name, self.worker_info[w_name].queue_length - 1)
+        logger.debug(f"model: {model_name}, candidates: {len(candidates)}, ret: {w_name}")
+        return w_name
 
     def receive_heart_beat(self, worker_name: str, queue_length: int):
         if worker_name not in self.worker_info:
             logger.info(f"Receive unknown heart beat. {worker_name}")
             return False
 
+        old_queue_length = self.worker_info[worker_name].queue_length
         self.worker_info[worker_name].queue_length = queue_length
         self.worker_info[worker_name].last_heart_beat = time.time()
+        self.publish_queue_length(worker_name, old_queue_length)
         logger.info(f"Receive heart beat. {worker_name}")
         return True
 
@@ -250,13 +422,15 @@ class Controller:
 
     # Let the controller act as a worker to achieve hierarchical
     # management. This can be used to connect isolated sub networks.
-    def worker_api_get_status(self):
+    async def worker_api_get_status(self):
         model_names = set()
         speed = 0
         queue_length = 0
 
-        for w_name in self.worker_info:
-            worker_status = self.get_worker_status(w_name)
+        status_list = await asyncio.gather(
+            *[self.get_worker_status(w_name) for w_name in list(self.worker_info)]
+        )
+        for worker_status in status_list:
             if worker_status is not None:
                 model_names.update(worker_status["model_names"])
                 speed += worker_status["speed"]
@@ -269,32 +443,42 @@ class Controller:
             "queue_length": queue_length,
         }
 
-    def worker_api_generate_stream(self, params):
+    async def worker_api_generate_stream(self, params):
         worker_addr = self.get_worker_address(params["model"])
         if not worker_addr:
             yield self.handle_no_worker(params)
+            return
 
         try:
-            response = requests.post(
+            async with self.client.stream(
+                "POST",
                 worker_addr + "/worker_generate_stream",
                 json=params,
-                stream=True,
                 timeout=WORKER_API_TIMEOUT,
-            )
-            for chunk in response.iter_lines(decode_unicode=False, delimiter=b"\0"):
-                if chunk:
-                    yield chunk + b"\0"
-        except requests.exceptions.RequestException as e:
+            ) as response:
+                # 只转发完整的帧，不做解析
+                reader = FrameReader(loads=bytes)
+                async for raw_chunk in response.aiter_raw():
+                    for chunk in reader.feed(raw_chunk):
+                        yield chunk + b"\0"
+        except httpx.HTTPError as e:
             yield self.handle_worker_timeout(worker_addr)
 
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await controller.start()
+    yield
+    await controller.close()
+
+
+app = FastAPI(lifespan=lifespan)
 
 
 @app.post("/register_worker")
 async def register_worker(request: Request):
     data = await request.json()
-    controller.register_worker(
+    await controller.register_worker(
         data["worker_name"],
         data["check_heart_beat"],
         data.get("worker_status", None),
@@ -304,7 +488,7 @@ async def register_worker(request: Request):
 
 @app.post("/refresh_all_workers")
 async def refresh_all_workers():
-    models = controller.refresh_all_workers()
+    models = await controller.refresh_all_workers()
 
 
 @app.post("/list_models")
@@ -332,6 +516,20 @@ async def get_worker_address(request: Request):
     return {"address": addr}
 
 
+@app.post("/get_worker_address_list")
+async def get_worker_address_list(request: Request):
+    data = await request.json()
+    addr_list = controller.get_worker_address_list(data["model"])
+    return {"address": addr_list}
+
+
+@app.post("/invalidate_embedding_cache")
+async def invalidate_embedding_cache(request: Request):
+    data = await request.json()
+    epoch = controller.invalidate_embedding_cache(data["model"])
+    return {"model": data["model"], "epoch": epoch}
+
+
 @app.post("/receive_heart_beat")
 async def receive_heart_beat(request: Request):
     data = await request.json()
@@ -339,6 +537,16 @@ async def receive_heart_beat(request: Request):
     return {"exist": exist}
 
 
+@app.get("/registry_stream")
+async def registry_stream(request: Request):
+    generator = controller.registry_stream(request)
+    return StreamingResponse(
+        generator,
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 @app.post("/worker_generate_stream")
 async def worker_api_generate_stream(request: Request):
     params = await request.json()
@@ -348,7 +556,7 @@ async def worker_api_generate_stream(request: Request):
 
 @app.post("/worker_get_status")
 async def worker_api_get_status(request: Request):
-    return controller.worker_api_get_status()
+    return await controller.worker_api_get_status()
 
 
 @app.get("/test_connection")
@@ -363,9 +571,15 @@ def create_controller():
     parser.add_argument(
         "--dispatch-method",
         type=str,
-        choices=["lottery", "shortest_queue"],
+        choices=["lottery", "shortest_queue", "power_of_two"],
         default="shortest_queue",
     )
+    parser.add_argument(
+        "--status-timeout",
+        type=float,
+        default=5,
+        help="Deadline in seconds for probing the status of a single worker.",
+    )
     parser.add_argument(
         "--ssl",
         action="store_true",
@@ -376,7 +590,7 @@ def create_controller():
     args = parser.parse_args()
     logger.info(f"args: {args}")
 
-    controller = Controller(args.dispatch_method)
+    controller = Controller(args.dispatch_method, status_timeout=args.status_timeout)
     return args, controller
 
 
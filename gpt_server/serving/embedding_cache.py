@@ -0,0 +1,222 @@
+from collections import OrderedDict
+from dataclasses import dataclass
+import hashlib
+import mmap
+import os
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from loguru import logger
+import orjson
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    disk_hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    invalidations: int = 0
+
+
+class DiskTier:
+    """基于内存映射文件的磁盘缓存层
+
+    每个模型一个只追加的数据文件，索引保存在内存中，文件超过容量上限时整体清空。
+    文件名带进程号，多个 uvicorn 进程之间互不干扰；它只是内存层的溢出区，
+    进程退出时删除，不跨重启保留。
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+        # Dict[model_name -> Dict[key -> (offset, length)]]
+        self.indexes: Dict[str, Dict[bytes, Tuple[int, int]]] = {}
+        self.files: Dict[str, Any] = {}
+        self.mmaps: Dict[str, mmap.mmap] = {}
+
+    def get_path(self, model_name: str) -> str:
+        name = hashlib.blake2b(model_name.encode(), digest_size=8).hexdigest()
+        return os.path.join(self.cache_dir, f"{name}.{os.getpid()}.bin")
+
+    def get(self, model_name: str, key: bytes) -> Optional[bytes]:
+        index = self.indexes.get(model_name)
+        if not index or key not in index:
+            return None
+        offset, length = index[key]
+        mm = self.mmaps.get(model_name)
+        if mm is None or offset + length > len(mm):
+            # 文件在上次映射之后有追加，重新映射
+            if mm is not None:
+                mm.close()
+            f = self.files[model_name]
+            f.flush()
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.mmaps[model_name] = mm
+        return mm[offset : offset + length]
+
+    def put(self, model_name: str, key: bytes, value: bytes):
+        if len(value) > self.max_bytes:
+            return
+        f = self.files.get(model_name)
+        if f is None:
+            f = open(self.get_path(model_name), "w+b")
+            self.files[model_name] = f
+            self.indexes[model_name] = {}
+        index = self.indexes[model_name]
+        if key in index:
+            return
+        offset = f.seek(0, os.SEEK_END)
+        if offset + len(value) > self.max_bytes:
+            self.invalidate(model_name)
+            return self.put(model_name, key, value)
+        f.write(value)
+        index[key] = (offset, len(value))
+
+    def invalidate(self, model_name: str):
+        mm = self.mmaps.pop(model_name, None)
+        if mm is not None:
+            mm.close()
+        f = self.files.pop(model_name, None)
+        if f is not None:
+            f.close()
+            os.remove(f.name)
+        self.indexes.pop(model_name, None)
+
+    def size(self) -> int:
+        return sum(
+            length for index in self.indexes.values() for _, length in index.values()
+        )
+
+    def close(self):
+        for model_name in list(self.files):
+            self.invalidate(model_name)
+
+
+class EmbeddingCache:
+    """按 (model, 文本哈希, encoding_format) 寻址的 embedding 缓存
+
+    内存层为按字节数限额的 LRU，被淘汰的条目写入可选的磁盘层。
+    缓存保存在每个 API server 进程内，失效通过 controller 维护的每个模型的 epoch 同步：
+    epoch 变化时清空该模型的缓存，见 sync_epochs。
+    """
+
+    def __init__(
+        self,
+        max_bytes: int,
+        disk_dir: Optional[str] = None,
+        disk_max_bytes: int = 1 << 30,
+    ):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.entries: "OrderedDict[bytes, Tuple[str, bytes]]" = OrderedDict()
+        self.model_keys: Dict[str, Set[bytes]] = {}
+        self.disk = DiskTier(disk_dir, disk_max_bytes) if disk_dir else None
+        self.stats: Dict[str, CacheStats] = {}
+        # 本进程已同步到的每个模型的失效 epoch
+        self.epochs: Dict[str, int] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    @staticmethod
+    def make_key(model_name: str, text: Any, encoding_format: Optional[str]):
+        if isinstance(text, str):
+            data = text.encode()
+        else:
+            try:
+                data = orjson.dumps(text)
+            except TypeError:
+                return None
+        h = hashlib.blake2b(digest_size=16)
+        h.update(f"{model_name}\0{encoding_format}\0".encode())
+        h.update(data)
+        return h.digest()
+
+    def get_stats(self, model_name: str) -> CacheStats:
+        stats = self.stats.get(model_name)
+        if stats is None:
+            stats = self.stats[model_name] = CacheStats()
+        return stats
+
+    def get(self, model_name: str, key: Optional[bytes]):
+        stats = self.get_stats(model_name)
+        if key is None:
+            stats.misses += 1
+            return None
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+            stats.hits += 1
+            return orjson.loads(entry[1])
+        if self.disk is not None:
+            value = self.disk.get(model_name, key)
+            if value is not None:
+                stats.disk_hits += 1
+                self._put_memory(model_name, key, value)
+                return orjson.loads(value)
+        stats.misses += 1
+        return None
+
+    def lookup(
+        self, model_name: str, inputs: list, encoding_format: Optional[str]
+    ) -> Tuple[List[Optional[bytes]], Dict[int, Any]]:
+        """返回每个输入的缓存键，以及命中的 {输入下标: embedding}"""
+        keys = [self.make_key(model_name, text, encoding_format) for text in inputs]
+        cached = {}
+        for i, key in enumerate(keys):
+            embedding = self.get(model_name, key)
+            if embedding is not None:
+                cached[i] = embedding
+        return keys, cached
+
+    def put(self, model_name: str, key: Optional[bytes], embedding: Any):
+        if key is None or key in self.entries:
+            return
+        self._put_memory(model_name, key, orjson.dumps(embedding))
+
+    def _put_memory(self, model_name: str, key: bytes, value: bytes):
+        if len(value) > self.max_bytes:
+            return
+        self.entries[key] = (model_name, value)
+        self.model_keys.setdefault(model_name, set()).add(key)
+        self.current_bytes += len(value)
+        while self.current_bytes > self.max_bytes:
+            old_key, (old_model, old_value) = self.entries.popitem(last=False)
+            self.current_bytes -= len(old_value)
+            self.model_keys[old_model].discard(old_key)
+            self.get_stats(old_model).evictions += 1
+            if self.disk is not None:
+                self.disk.put(old_model, old_key, old_value)
+
+    def invalidate(self, model_name: str):
+        for key in self.model_keys.pop(model_name, ()):
+            _, value = self.entries.pop(key)
+            self.current_bytes -= len(value)
+        if self.disk is not None:
+            self.disk.invalidate(model_name)
+        self.get_stats(model_name).invalidations += 1
+        logger.info(f"embedding cache of {model_name} invalidated")
+
+    def sync_epochs(self, epochs: Dict[str, int]):
+        """epoch 与本进程记录的不同时清空该模型的缓存"""
+        for model_name, epoch in epochs.items():
+            if self.epochs.get(model_name, 0) != epoch:
+                self.epochs[model_name] = epoch
+                self.invalidate(model_name)
+
+    def metrics(self) -> dict:
+        return {
+            "max_bytes": self.max_bytes,
+            "current_bytes": self.current_bytes,
+            "entries": len(self.entries),
+            "disk_bytes": self.disk.size() if self.disk is not None else None,
+            "models": {
+                model_name: vars(stats) for model_name, stats in self.stats.items()
+            },
+        }
+
+    def close(self):
+        if self.disk is not None:
+            self.disk.close()
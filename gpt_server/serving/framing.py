@@ -0,0 +1,214 @@
+import importlib.util
+import json
+import struct
+from typing import Any, Callable, List, Optional
+
+import orjson
+
+
+class FrameReader:
+    """worker 流式响应的增量分帧解析器
+
+    worker 以分隔符（默认 b"\\0"）结尾的帧输出结果，一次网络读取可能包含多个帧，
+    也可能只包含半个帧。缓冲区为 bytearray，只保存尚未结束的帧尾部；
+    帧通过 memoryview 切片直接交给 loads 解析，不做额外的解码和拷贝。
+    """
+
+    def __init__(
+        self, delimiter: bytes = b"\0", loads: Callable[[Any], Any] = orjson.loads
+    ):
+        self.delimiter = delimiter
+        self.loads = loads
+        self.buffer = bytearray()
+
+    def feed(self, data: bytes) -> List[Any]:
+        """输入一次读取到的数据，返回其中所有完整帧的解析结果"""
+        buffer = self.buffer
+        if buffer:
+            buffer += data
+            source = buffer
+        else:
+            # 缓冲区为空时直接在本次读取的数据上查找，只拷贝剩余的半帧
+            source = data
+        delimiter = self.delimiter
+        loads = self.loads
+        frames = []
+        start = 0
+        with memoryview(source) as view:
+            while (end := source.find(delimiter, start)) >= 0:
+                if end > start:
+                    frames.append(loads(view[start:end]))
+                start = end + len(delimiter)
+        if source is buffer:
+            del buffer[:start]
+        elif start < len(data):
+            buffer += data[start:]
+        return frames
+
+    def pending(self) -> int:
+        """尚未收到分隔符的字节数"""
+        return len(self.buffer)
+
+
+# ---------------- worker 流式响应的帧格式 ----------------
+# json:    json.dumps(ret) + b"\0"，默认格式，兼容旧版本的 worker 和 API server
+# msgpack: 二进制帧，完整帧使用 msgpack 编码
+# delta:   二进制帧，完整帧使用 JSON 编码，不依赖 msgpack
+# 二进制帧由固定头 struct(">BIII") 与负载组成：
+#   (帧类型, completion_tokens, text 字节数, reasoning_content 字节数)
+# 普通 token 使用增量帧，只携带 UTF-8 文本和 completion_tokens，
+# usage 的其余字段只在发生变化时以及最后一帧（完整帧）中发送。
+FRAME_FORMAT_HEADER = "X-Frame-Format"
+FRAME_FORMATS = ("json", "msgpack", "delta")
+
+FRAME_HEADER = struct.Struct(">BIII")
+FRAME_DELTA = 0
+# 增量帧，且原始结果中带有 reasoning_content 字段
+FRAME_DELTA_REASONING = 1
+FRAME_FULL = 2
+
+DELTA_KEYS = {"text", "error_code", "usage", "finish_reason"}
+DELTA_REASONING_KEYS = DELTA_KEYS | {"reasoning_content"}
+USAGE_KEYS = {"prompt_tokens", "completion_tokens", "total_tokens"}
+
+msgpack_available = importlib.util.find_spec("msgpack") is not None
+
+
+def negotiate_frame_format(requested: Optional[str]) -> str:
+    """worker 端根据请求头选择帧格式，不支持时退回 json"""
+    if requested not in FRAME_FORMATS:
+        return "json"
+    if requested == "msgpack" and not msgpack_available:
+        return "json"
+    return requested
+
+
+class FrameEncoder:
+    """worker 端：把 generate_stream_gate 产出的 dict 编码为帧"""
+
+    def __init__(self, frame_format: str = "json"):
+        self.frame_format = frame_format
+        if frame_format == "msgpack":
+            import msgpack
+
+            self.dumps = msgpack.packb
+        else:
+            self.dumps = orjson.dumps
+        # 上一次通过完整帧发送的 usage
+        self.last_usage = None
+
+    def encode(self, ret: dict) -> bytes:
+        if self.frame_format == "json":
+            return json.dumps(ret).encode() + b"\0"
+        kind = self.delta_kind(ret)
+        if kind is None:
+            usage = ret.get("usage")
+            if isinstance(usage, dict):
+                self.last_usage = usage
+            body = self.dumps(ret)
+            return FRAME_HEADER.pack(FRAME_FULL, 0, len(body), 0) + body
+        text = ret["text"].encode()
+        reasoning = (
+            ret["reasoning_content"].encode()
+            if kind == FRAME_DELTA_REASONING
+            else b""
+        )
+        header = FRAME_HEADER.pack(
+            kind, ret["usage"]["completion_tokens"], len(text), len(reasoning)
+        )
+        return header + text + reasoning
+
+    def delta_kind(self, ret: dict) -> Optional[int]:
+        """判断能否使用增量帧：除文本和 completion_tokens 外，其余字段都可由接收端还原"""
+        keys = ret.keys()
+        if keys == DELTA_KEYS:
+            kind = FRAME_DELTA
+        elif keys == DELTA_REASONING_KEYS and isinstance(
+            ret["reasoning_content"], str
+        ):
+            kind = FRAME_DELTA_REASONING
+        else:
+            return None
+        if ret["error_code"] != 0 or ret["finish_reason"] is not None:
+            return None
+        if not isinstance(ret["text"], str):
+            return None
+        usage, last_usage = ret["usage"], self.last_usage
+        if last_usage is None or not isinstance(usage, dict):
+            return None
+        if usage.keys() != USAGE_KEYS:
+            return None
+        if usage["prompt_tokens"] != last_usage["prompt_tokens"]:
+            return None
+        completion_tokens = usage["completion_tokens"]
+        if not isinstance(completion_tokens, int):
+            return None
+        if not 0 <= completion_tokens < 1 << 32:
+            return None
+        if usage["total_tokens"] != usage["prompt_tokens"] + completion_tokens:
+            return None
+        return kind
+
+
+class BinaryFrameReader:
+    """API server 端：msgpack / delta 格式的增量解析器，接口与 FrameReader 相同"""
+
+    def __init__(self, frame_format: str):
+        if frame_format == "msgpack":
+            import msgpack
+
+            self.loads = msgpack.unpackb
+        else:
+            self.loads = orjson.loads
+        self.buffer = bytearray()
+        self.last_usage = None
+
+    def feed(self, data: bytes) -> List[Any]:
+        buffer = self.buffer
+        buffer += data
+        header_size = FRAME_HEADER.size
+        frames = []
+        start = 0
+        with memoryview(buffer) as view:
+            while len(buffer) - start >= header_size:
+                kind, completion_tokens, size, reasoning_size = (
+                    FRAME_HEADER.unpack_from(buffer, start)
+                )
+                end = start + header_size + size + reasoning_size
+                if end > len(buffer):
+                    break
+                body_start = start + header_size
+                if kind == FRAME_FULL:
+                    ret = self.loads(view[body_start:end])
+                    usage = ret.get("usage")
+                    if isinstance(usage, dict):
+                        self.last_usage = usage
+                else:
+                    prompt_tokens = self.last_usage["prompt_tokens"]
+                    text_end = body_start + size
+                    ret = {
+                        "text": str(view[body_start:text_end], "utf-8"),
+                        "error_code": 0,
+                        "usage": {
+                            "prompt_tokens": prompt_tokens,
+                            "completion_tokens": completion_tokens,
+                            "total_tokens": prompt_tokens + completion_tokens,
+                        },
+                        "finish_reason": None,
+                    }
+                    if kind == FRAME_DELTA_REASONING:
+                        ret["reasoning_content"] = str(view[text_end:end], "utf-8")
+                frames.append(ret)
+                start = end
+        del buffer[:start]
+        return frames
+
+    def pending(self) -> int:
+        return len(self.buffer)
+
+
+def create_frame_reader(frame_format: Optional[str]):
+    """根据 worker 响应头中的帧格式创建解析器，没有该响应头的旧 worker 使用 json"""
+    if frame_format in ("msgpack", "delta"):
+        return BinaryFrameReader(frame_format)
+    return FrameReader()
@@ -0,0 +1,92 @@
+import asyncio
+import os
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from loguru import logger
+
+
+class ModelInfo:
+    """API server 缓存的模型信息：上下文长度和本地 tokenizer（模型路径不可访问时为 None）"""
+
+    def __init__(self, context_length: int, tokenizer=None):
+        self.context_length = context_length
+        self.tokenizer = tokenizer
+
+    def count_tokens(self, prompts: List[str]) -> List[int]:
+        """一次批量分词，fast tokenizer 在 Rust 中并行处理"""
+        if not prompts:
+            return []
+        return [len(input_ids) for input_ids in self.tokenizer(prompts).input_ids]
+
+    def count_chat_tokens(self, messages: Any, tools: Optional[list] = None):
+        """估算 chat 请求的 prompt token 数，无法估算（如多模态）时返回 None
+
+        worker 的 chat template 可能与 tokenizer 自带的不同，结果只用于上下文长度检查
+        """
+        if isinstance(messages, str):
+            return self.count_tokens([messages])[0]
+        if any(not isinstance(message.get("content") or "", str) for message in messages):
+            return None
+        if getattr(self.tokenizer, "chat_template", None):
+            try:
+                return len(
+                    self.tokenizer.apply_chat_template(
+                        messages, tools=tools, tokenize=True, add_generation_prompt=True
+                    )
+                )
+            except Exception:
+                pass
+        texts = [message.get("content") or "" for message in messages]
+        return sum(self.count_tokens(texts))
+
+
+def load_tokenizer(model_path: str):
+    from transformers import AutoTokenizer
+
+    return AutoTokenizer.from_pretrained(model_path, trust_remote_code=True)
+
+
+class ModelInfoRegistry:
+    """按模型名懒加载并缓存 ModelInfo
+
+    上下文长度和模型路径从 worker 的 /model_details 获取，tokenizer 从模型路径加载，
+    同一模型的并发请求共享一次加载。
+    """
+
+    def __init__(self, fetch_details: Callable[[str], Awaitable[dict]]):
+        self.fetch_details = fetch_details
+        self.infos: Dict[str, ModelInfo] = {}
+        self.loading: Dict[str, asyncio.Future] = {}
+
+    async def get(self, model_name: str) -> ModelInfo:
+        info = self.infos.get(model_name)
+        if info is not None:
+            return info
+        task = self.loading.get(model_name)
+        if task is None:
+            task = asyncio.ensure_future(self.load(model_name))
+            self.loading[model_name] = task
+            task.add_done_callback(lambda _: self.loading.pop(model_name, None))
+        # 单个请求取消时不取消共享的加载任务
+        return await asyncio.shield(task)
+
+    async def load(self, model_name: str) -> ModelInfo:
+        details = await self.fetch_details(model_name)
+        tokenizer = None
+        model_path = details.get("model_path", None)
+        # 只从本地路径加载，API server 与 worker 不在同一台机器时使用 worker 计数
+        if model_path and os.path.isdir(model_path):
+            try:
+                tokenizer = await asyncio.to_thread(load_tokenizer, model_path)
+            except Exception as e:
+                logger.warning(f"{model_name} 无法加载本地 tokenizer, 使用 worker 计数: {e!r}")
+        info = ModelInfo(int(details["context_length"]), tokenizer)
+        self.infos[model_name] = info
+        logger.info(
+            f"{model_name} context_length: {info.context_length}, "
+            f"local tokenizer: {tokenizer is not None}"
+        )
+        return info
+
+    def invalidate(self, model_name: str):
+        self.infos.pop(model_name, None)
@@ -15,9 +15,9 @@ import orjson
 import os
 import time
 import traceback
-from typing import Generator, Optional, Union, Dict, List, Any
+from functools import lru_cache
+from typing import Generator, Optional, Tuple, Union, Dict, List, Any
 
-import aiohttp
 import fastapi
 from fastapi import Depends, HTTPException, responses
 from fastapi.exceptions import RequestValidationError
@@ -72,23 +72,20 @@ from loguru import logger
 
 conv_template_map = {}
 
-fetch_timeout = aiohttp.ClientTimeout(total=3 * 3600)
-
 
 async def fetch_remote(url, pload=None, name=None):
-    async with aiohttp.ClientSession(timeout=fetch_timeout) as session:
-        async with session.post(url, json=pload) as response:
-            chunks = []
-            if response.status != 200:
-                ret = {
-                    "text": f"{response.reason}",
-                    "error_code": ErrorCode.INTERNAL_ERROR,
-                }
-                return json.dumps(ret)
-
-            async for chunk, _ in response.content.iter_chunks():
-                chunks.append(chunk)
-        output = b"".join(chunks)
+    response = await client_pool.post(url, json=pload, headers=headers)
+    return parse_response(response, name)
+
+
+def parse_response(response: httpx.Response, name=None):
+    if response.status_code != 200:
+        ret = {
+            "text": f"{response.reason_phrase}",
+            "error_code": ErrorCode.INTERNAL_ERROR,
+        }
+        return json.dumps(ret)
+    output = response.content
 
     if name is not None:
         res = json.loads(output)
@@ -103,6 +100,30 @@ class AppSettings(BaseSettings):
     # The address of the model controller.
     controller_address: str = "http://localhost:21001"
     api_keys: Optional[List[str]] = None
+    # 每个 worker 的最大连接数和最大空闲长连接数
+    worker_max_connections: int = 512
+    worker_max_keepalive: int = 128
+    # worker 连接失败后被暂停分发的时间（秒）
+    worker_failure_cooldown: float = 10.0
+    # 路由模式：least_outstanding 或 prefix_affinity（按前缀一致性哈希，提升前缀缓存命中）
+    routing_mode: str = "least_outstanding"
+    prefix_affinity_load_factor: float = 1.25
+    # 尚未输出任何内容时，连接错误、超时或 5xx 换其他副本重试的次数
+    worker_retries: int = 2
+    # embedding/rerank/classify 单个请求同时发往 worker 的最大批次数
+    embedding_batch_concurrency: int = 8
+    # 向 worker 请求的流式帧格式：json、msgpack 或 delta，worker 不支持时退回 json
+    worker_frame_format: str = "json"
+    # chat 流式输出的合并窗口（毫秒），0 表示不合并；单次合并的最大字节数
+    stream_coalesce_window_ms: float = 0
+    stream_coalesce_max_bytes: int = 1024
+    # embedding 缓存的内存上限（字节），0 表示关闭缓存
+    embedding_cache_max_bytes: int = 0
+    # 可选的磁盘缓存目录及其每个模型的容量上限（字节）
+    embedding_cache_disk_dir: Optional[str] = None
+    embedding_cache_disk_max_bytes: int = 1 << 30
+    # prompt 加 max_tokens 超出上下文长度时的处理：off 不检查、clamp 调小 max_tokens、reject 直接返回错误
+    max_tokens_policy: str = "off"
 
     @validator("api_keys", pre=True)
     def split_api_keys(cls, v):
@@ -120,37 +141,100 @@ class AppSettings(BaseSettings):
 app_settings = AppSettings()
 from contextlib import asynccontextmanager
 
-model_address_map = {}
-models_ = []
+from gpt_server.serving.client_pool import ClientPool
+from gpt_server.serving.framing import FRAME_FORMAT_HEADER, create_frame_reader
+from gpt_server.serving.sse import ChatChunkSerializer, coalesce_stream
 
+client_pool = ClientPool(
+    max_connections_per_worker=app_settings.worker_max_connections,
+    max_keepalive_per_worker=app_settings.worker_max_keepalive,
+)
+headers = {"User-Agent": "gpt_server API Server"}
+stream_headers = {**headers, FRAME_FORMAT_HEADER: app_settings.worker_frame_format}
 
-async def timing_tasks():
-    """定时任务"""
-    global model_address_map, models_
+from gpt_server.serving.embedding_cache import EmbeddingCache
+
+embedding_cache = EmbeddingCache(
+    max_bytes=app_settings.embedding_cache_max_bytes,
+    disk_dir=app_settings.embedding_cache_disk_dir,
+    disk_max_bytes=app_settings.embedding_cache_disk_max_bytes,
+)
+
+from gpt_server.serving.registry import WorkerRegistry
+
+worker_registry = WorkerRegistry()
+# 推送流断开后，退回到轮询的间隔（秒）
+REGISTRY_POLL_INTERVAL = 6
+# 推送流正常结束（版本不连续或 controller 关闭连接）后，重新订阅前的等待时间（秒）
+REGISTRY_RESUBSCRIBE_DELAY = 1
+
+
+async def poll_registry():
+    """从 controller 轮询完整的注册表，作为推送流不可用时的兜底"""
+    controller_address = app_settings.controller_address
+    models = await fetch_remote(controller_address + "/list_models", None, "models")
+    worker_addr_coro_list = []
+    for model in models:
+        worker_addr_coro = fetch_remote(
+            controller_address + "/get_worker_address_list",
+            {"model": model},
+            "address",
+        )
+        worker_addr_coro_list.append(worker_addr_coro)
+    worker_address_list = await asyncio.gather(*worker_addr_coro_list)
+    workers = {}
+    for model, worker_addrs in zip(models, worker_address_list):
+        for worker_addr in worker_addrs:
+            w_info = workers.setdefault(
+                worker_addr,
+                {
+                    "model_names": [],
+                    "speed": 1,
+                    "queue_length": worker_registry.get_queue_length(worker_addr),
+                    "multimodal": False,
+                },
+            )
+            w_info["model_names"].append(model)
+    worker_registry.apply_snapshot({"workers": workers, "version": -1})
+
+
+async def subscribe_registry():
+    """订阅 controller 的注册表推送流，直到连接断开或版本不连续"""
     controller_address = app_settings.controller_address
+    timeout = httpx.Timeout(None, connect=5, read=60)
+    async with httpx.AsyncClient(timeout=timeout) as client:
+        async with client.stream(
+            "GET", controller_address + "/registry_stream", headers=headers
+        ) as response:
+            if response.status_code != 200:
+                raise RuntimeError(f"registry_stream: {response.status_code}")
+            async for line in response.aiter_lines():
+                if not line.startswith("data: "):
+                    continue
+                event = orjson.loads(line[6:])
+                if not worker_registry.apply_event(event):
+                    logger.warning("worker registry version gap, resync")
+                    return
+                if event["type"] in ("snapshot", "embedding_cache_epoch"):
+                    embedding_cache.sync_epochs(worker_registry.embedding_cache_epochs)
+
 
+async def timing_tasks():
+    """维护本地 worker 注册表：优先使用推送流，失败时轮询"""
     while True:
         try:
-            # ret = await fetch_remote(controller_address + "/refresh_all_workers")
-            models = await fetch_remote(
-                controller_address + "/list_models", None, "models"
-            )
-            worker_addr_coro_list = []
-            for model in models:
-                worker_addr_coro = fetch_remote(
-                    controller_address + "/get_worker_address",
-                    {"model": model},
-                    "address",
-                )
-                worker_addr_coro_list.append(worker_addr_coro)
-            worker_address_list = await asyncio.gather(*worker_addr_coro_list)
-            for model, worker_addr in zip(models, worker_address_list):
-                model_address_map[model] = worker_addr
-            models_ = list(model_address_map.keys())
-            await asyncio.sleep(6)
+            await subscribe_registry()
+            # 版本不连续或 controller 关闭了连接，稍后重新订阅以拉取快照，
+            # 避免 controller 反复立即断开时陷入忙循环
+            await asyncio.sleep(REGISTRY_RESUBSCRIBE_DELAY)
+            continue
+        except Exception as e:
+            logger.warning(f"registry stream unavailable: {e!r}")
+        try:
+            await poll_registry()
         except Exception:
             traceback.print_exc()
-            await asyncio.sleep(6)
+        await asyncio.sleep(REGISTRY_POLL_INTERVAL)
 
 
 @asynccontextmanager
@@ -158,10 +242,11 @@ async def lifespan(app: fastapi.FastAPI):
     logger.info(f"app_settings: {app_settings}")
     asyncio.create_task(timing_tasks())
     yield
+    await client_pool.aclose()
+    embedding_cache.close()
 
 
 app = fastapi.FastAPI(docs_url="/", lifespan=lifespan)
-headers = {"User-Agent": "gpt_server API Server"}
 get_bearer_token = HTTPBearer(auto_error=False)
 
 
@@ -199,10 +284,9 @@ async def validation_exception_handler(request, exc):
 
 
 def check_model(request) -> Optional[JSONResponse]:
-    global model_address_map, models_
     ret = None
-    models = models_
-    if request.model not in models_:
+    models = worker_registry.models
+    if request.model not in models:
         ret = create_error_response(
             ErrorCode.INVALID_MODEL,
             f"Only {'&&'.join(models)} allowed now, your model {request.model}",
@@ -210,30 +294,45 @@ def check_model(request) -> Optional[JSONResponse]:
     return ret
 
 
+@lru_cache(maxsize=None)
+def get_tiktoken_encoding(model_name: str):
+    try:
+        return tiktoken.model.encoding_for_model(model_name)
+    except KeyError:
+        logger.warning("Warning: model not found. Using cl100k_base encoding.")
+        return tiktoken.get_encoding("cl100k_base")
+
+
 def process_input(model_name, inp):
     if isinstance(inp, str):
         inp = [inp]
     elif isinstance(inp, list):
         if isinstance(inp[0], int):
-            try:
-                decoding = tiktoken.model.encoding_for_model(model_name)
-            except KeyError:
-                logger.warning("Warning: model not found. Using cl100k_base encoding.")
-                model = "cl100k_base"
-                decoding = tiktoken.get_encoding(model)
+            decoding = get_tiktoken_encoding(model_name)
             inp = [decoding.decode(inp)]
         elif isinstance(inp[0], list):
-            try:
-                decoding = tiktoken.model.encoding_for_model(model_name)
-            except KeyError:
-                logger.warning("Warning: model not found. Using cl100k_base encoding.")
-                model = "cl100k_base"
-                decoding = tiktoken.get_encoding(model)
+            decoding = get_tiktoken_encoding(model_name)
             inp = [decoding.decode(text) for text in inp]
 
     return inp
 
 
+def split_token_inputs(inp) -> Tuple[list, bool]:
+    """把输入规范为列表，返回 (inputs, is_token_ids)
+
+    token ids 输入原样转发给 worker，由 worker 使用模型自己的 tokenizer，
+    不再用 tiktoken 解码为文本后再由 worker 重新分词
+    """
+    if isinstance(inp, str):
+        return [inp], False
+    if isinstance(inp, list) and len(inp) > 0:
+        if isinstance(inp[0], int):
+            return [inp], True
+        if isinstance(inp[0], list):
+            return inp, True
+    return inp, False
+
+
 def create_openai_logprobs(logprob_dict):
     """Create OpenAI-style logprobs."""
     return LogProbs(**logprob_dict) if logprob_dict is not None else None
@@ -269,6 +368,7 @@ def get_gen_params(
     response_format=None,
     reasoning_parser: str = None,
     enable_thinking: bool = True,
+    prompt_token_ids: Optional[List[int]] = None,
 ) -> Dict[str, Any]:
     images = []
     if isinstance(messages, str):
@@ -309,35 +409,19 @@ def get_gen_params(
     gen_params["response_format"] = response_format
     gen_params["reasoning_parser"] = reasoning_parser
     gen_params["enable_thinking"] = enable_thinking
+    if prompt_token_ids is not None:
+        gen_params["prompt_token_ids"] = prompt_token_ids
     return gen_params
 
 
-class AddressManager:
-    def __init__(self):
+from gpt_server.serving.router import WorkerRouter, prefix_affinity_key
 
-        self.lock = threading.Lock()
-        self.last_index = -1  # 轮询索引
-
-    def get_address(self, model):
-        global model_address_map
-        ips = model_address_map[model]
-        self.worker_addr_list = ips.split(",")
-        with self.lock:
-            current_list = self.worker_addr_list.copy()
-
-        if not current_list:
-            return None
-
-        n = len(current_list)
-        if n == 1:
-            return current_list[0]
-
-        # 计算下一个索引（若列表长度变化，自动取模）
-        self.last_index = (self.last_index + 1) % n
-        return current_list[self.last_index]
-
-
-address_manager = AddressManager()
+worker_router = WorkerRouter(
+    worker_registry,
+    failure_cooldown=app_settings.worker_failure_cooldown,
+    routing_mode=app_settings.routing_mode,
+    affinity_load_factor=app_settings.prefix_affinity_load_factor,
+)
 
 
 def get_worker_address(model_name: str) -> str:
@@ -345,20 +429,79 @@ def get_worker_address(model_name: str) -> str:
     Get worker address based on the requested model
 
     :param model_name: The worker's model name
-    :return: Worker address from the controller
+    :return: Worker address from the local worker registry
     :raises: :class:`ValueError`: No available worker for requested model
     """
-    # global model_address_map
-    # worker_addr = model_address_map[model_name]
-    worker_addr = address_manager.get_address(model=model_name)
+    worker_addr = worker_router.get_router(model_name).select()
 
     # No available worker
-    if worker_addr == "":
+    if not worker_addr:
         raise ValueError(f"No available worker for {model_name}")
     logger.debug(f"model_name: {model_name}, worker_addr: {worker_addr}")
     return worker_addr
 
 
+class WorkerServerError(Exception):
+    """worker 返回了 5xx"""
+
+    def __init__(self, status_code: int, detail: str):
+        super().__init__(f"worker error {status_code}: {detail}")
+        self.status_code = status_code
+        self.detail = detail
+
+
+# 输出第一个字节之前出现这些错误时，换其他副本重试
+RETRYABLE_ERRORS = (httpx.TransportError, WorkerServerError)
+
+
+def should_retry(model_name: str, worker_addr: str, exclude: set, attempt: int):
+    """记录失败的 worker 并判断是否还能换副本重试"""
+    worker_router.record_failure(model_name, worker_addr)
+    exclude.add(worker_addr)
+    if attempt >= app_settings.worker_retries:
+        return False
+    return worker_router.has_worker(model_name, exclude)
+
+
+async def fetch_worker(
+    model_name: str,
+    path: str,
+    payload: Dict[str, Any],
+    name=None,
+    record_ttft=True,
+    affinity_key: Optional[int] = None,
+):
+    """按路由策略选择 worker 并转发一次非流式请求，失败时换其他副本重试"""
+    exclude = set()
+    attempt = 0
+    while True:
+        with worker_router.acquire(model_name, exclude, affinity_key) as worker_addr:
+            start = time.perf_counter()
+            try:
+                response = await client_pool.post(
+                    worker_addr + path, json=payload, headers=headers
+                )
+                if response.status_code >= 500:
+                    raise WorkerServerError(
+                        response.status_code, response.reason_phrase
+                    )
+            except RETRYABLE_ERRORS as e:
+                if not should_retry(model_name, worker_addr, exclude, attempt):
+                    if isinstance(e, WorkerServerError):
+                        return parse_response(response, name)
+                    raise
+                attempt += 1
+                logger.warning(
+                    f"{model_name} worker {worker_addr} failed: {e!r}, retry {attempt}"
+                )
+                continue
+            if record_ttft:
+                worker_router.record_ttft(
+                    model_name, worker_addr, time.perf_counter() - start
+                )
+            return parse_response(response, name)
+
+
 async def get_conv(model_name: str, worker_addr: str):
     conv_template = conv_template_map.get((worker_addr, model_name))
     if conv_template is None:
@@ -369,6 +512,119 @@ async def get_conv(model_name: str, worker_addr: str):
     return conv_template
 
 
+from gpt_server.serving.model_info import ModelInfoRegistry
+
+
+async def fetch_model_details(model_name: str) -> dict:
+    details = await fetch_worker(
+        model_name, "/model_details", {"model": model_name}, "", record_ttft=False
+    )
+    if not isinstance(details, dict):
+        raise ValueError(f"{model_name} model_details error: {details}")
+    return details
+
+
+model_info_registry = ModelInfoRegistry(fetch_model_details)
+
+
+async def count_prompt_tokens(model_name: str, prompts: List[str]) -> List[int]:
+    """批量计数：有本地 tokenizer 时一次分词完成，否则并发请求 worker 的 /count_token"""
+    info = await model_info_registry.get(model_name)
+    if info.tokenizer is not None:
+        return await asyncio.to_thread(info.count_tokens, prompts)
+    return await asyncio.gather(
+        *[
+            fetch_worker(
+                model_name,
+                "/count_token",
+                {"prompt": prompt, "model": model_name},
+                "count",
+                record_ttft=False,
+            )
+            for prompt in prompts
+        ]
+    )
+
+
+def fit_max_tokens(
+    context_length: int, prompt_tokens: Optional[int], max_tokens: Optional[int]
+) -> Tuple[Optional[int], Optional[str]]:
+    """按 max_tokens_policy 返回 (max_tokens, 错误信息)"""
+    if prompt_tokens is None:
+        return max_tokens, None
+    available = context_length - prompt_tokens
+    if available <= 0:
+        return max_tokens, (
+            f"This model's maximum context length is {context_length} tokens. "
+            f"However, your messages resulted in {prompt_tokens} tokens. "
+            "Please reduce the length of the messages."
+        )
+    # 未指定 max_tokens 时保持 None，交给原有的默认值处理
+    if max_tokens is not None and max_tokens > available:
+        if app_settings.max_tokens_policy == "reject":
+            return max_tokens, (
+                f"This model's maximum context length is {context_length} tokens. "
+                f"However, you requested {prompt_tokens + max_tokens} tokens "
+                f"({prompt_tokens} in the messages, {max_tokens} in the completion). "
+                "Please reduce the length of the messages or completion."
+            )
+        return available, None
+    return max_tokens, None
+
+
+async def get_model_info_for_check(model_name: str):
+    """max_tokens_policy 打开且能在本地计数时返回 ModelInfo，否则返回 None（不检查）"""
+    if app_settings.max_tokens_policy == "off":
+        return None
+    try:
+        return await model_info_registry.get(model_name)
+    except Exception as e:
+        logger.warning(f"{model_name} 获取上下文长度失败, 跳过检查: {e!r}")
+        return None
+
+
+async def check_chat_context(gen_params: Dict[str, Any]) -> Optional[JSONResponse]:
+    """发往 worker 之前检查上下文长度，按策略调小 max_new_tokens 或返回错误"""
+    info = await get_model_info_for_check(gen_params["model"])
+    if info is None or info.tokenizer is None:
+        return None
+    prompt_tokens = await asyncio.to_thread(
+        info.count_chat_tokens, gen_params["messages"], gen_params["tools"]
+    )
+    max_tokens, error = fit_max_tokens(
+        info.context_length, prompt_tokens, gen_params["max_new_tokens"]
+    )
+    if error is not None:
+        return create_error_response(ErrorCode.CONTEXT_OVERFLOW, error)
+    gen_params["max_new_tokens"] = max_tokens
+    return None
+
+
+async def check_completion_context(
+    request: CompletionRequest, token_inputs: bool
+) -> Tuple[List[Optional[int]], Optional[JSONResponse]]:
+    """返回每个 prompt 的 max_tokens，多个 prompt 一次批量计数"""
+    max_tokens_list = [request.max_tokens] * len(request.prompt)
+    info = await get_model_info_for_check(request.model)
+    if info is None:
+        return max_tokens_list, None
+    if token_inputs:
+        prompt_tokens = [len(prompt) for prompt in request.prompt]
+    elif info.tokenizer is not None:
+        prompt_tokens = await asyncio.to_thread(info.count_tokens, request.prompt)
+    else:
+        return max_tokens_list, None
+    for i, num in enumerate(prompt_tokens):
+        max_tokens_list[i], error = fit_max_tokens(
+            info.context_length, num, request.max_tokens
+        )
+        if error is not None:
+            return max_tokens_list, create_error_response(
+                ErrorCode.CONTEXT_OVERFLOW, error
+            )
+    return max_tokens_list, None
+
+
 from gpt_server.openai_api_protocol.custom_api_protocol import CustomModelCard
 
 
@@ -407,8 +663,55 @@ from gpt_server.openai_api_protocol.custom_api_protocol import (
     response_class=responses.ORJSONResponse,
 )
 def get_model_address_map():
-    global model_address_map
-    return model_address_map
+    return worker_registry.model_address_map
+
+
+@app.get(
+    "/get_client_pool_metrics",
+    dependencies=[Depends(check_api_key)],
+    response_class=responses.ORJSONResponse,
+)
+def get_client_pool_metrics():
+    return client_pool.metrics()
+
+
+@app.get(
+    "/get_router_metrics",
+    dependencies=[Depends(check_api_key)],
+    response_class=responses.ORJSONResponse,
+)
+def get_router_metrics():
+    return worker_router.metrics()
+
+
+@app.get(
+    "/get_embedding_cache_metrics",
+    dependencies=[Depends(check_api_key)],
+    response_class=responses.ORJSONResponse,
+)
+def get_embedding_cache_metrics():
+    return embedding_cache.metrics()
+
+
+@app.post("/invalidate_embedding_cache", dependencies=[Depends(check_api_key)])
+async def invalidate_embedding_cache(request: Dict[str, Any]):
+    """清空某个模型的 embedding 缓存
+
+    由 controller 增加该模型的 epoch，并通过注册表推送流通知所有 API server 进程
+    """
+    model_name = request["model"]
+    ret = await fetch_remote(
+        app_settings.controller_address + "/invalidate_embedding_cache",
+        {"model": model_name},
+        "",
+    )
+    if not isinstance(ret, dict) or "epoch" not in ret:
+        return create_error_response(
+            ErrorCode.INTERNAL_ERROR, f"invalidate embedding cache failed: {ret}"
+        )
+    # 本进程立即生效，不等待推送流
+    embedding_cache.sync_epochs({model_name: ret["epoch"]})
+    return ret
 
 
 @app.post(
@@ -421,8 +724,8 @@ async def create_chat_completion(request: CustomChatCompletionRequest):
     error_check_ret = check_model(request)
     if error_check_ret is not None:
         return error_check_ret
-    worker_addr = get_worker_address(request.model)
-    max_tokens = 1024 * 8
+    # 只传入客户端指定的值，默认值在上下文长度检查之后再设置
+    max_tokens = None
     if request.max_completion_tokens:
         max_tokens = request.max_completion_tokens
     if request.max_tokens:
@@ -445,19 +748,22 @@ async def create_chat_completion(request: CustomChatCompletionRequest):
         reasoning_parser=request.reasoning_parser,
         enable_thinking=request.enable_thinking,
     )
+    error_check_ret = await check_chat_context(gen_params)
+    if error_check_ret is not None:
+        return error_check_ret
     if gen_params["max_new_tokens"] is None:
-        gen_params["max_new_tokens"] = 1024 * 16
+        gen_params["max_new_tokens"] = 1024 * 8
 
     if request.stream:
         generator = chat_completion_stream_generator(
-            request.model, gen_params, request.n, worker_addr
+            request.model, gen_params, request.n
         )
         return StreamingResponse(generator, media_type="text/event-stream")
 
     choices = []
     chat_completions = []
     for i in range(request.n):
-        content = asyncio.create_task(generate_completion(gen_params, worker_addr))
+        content = asyncio.create_task(generate_completion(gen_params))
         chat_completions.append(content)
     try:
         all_tasks = await asyncio.gather(*chat_completions)
@@ -498,53 +804,74 @@ from gpt_server.openai_api_protocol.custom_api_protocol import (
 
 
 async def chat_completion_stream_generator(
-    model_name: str, gen_params: Dict[str, Any], n: int, worker_addr: str
+    model_name: str, gen_params: Dict[str, Any], n: int
 ) -> Generator[str, Any, None]:  # type: ignore
     """
     Event stream format:
     https://developer.mozilla.org/en-US/docs/Web/API/Server-sent_events/Using_server-sent_events#event_stream_format
     """
     id = f"chatcmpl-{shortuuid.random()}"
+    serializer = ChatChunkSerializer(id, model_name)
     finish_stream_events = []
-    for i in range(n):
-        async for content in generate_completion_stream(gen_params, worker_addr):
-            try:
-                error_code = content["error_code"]
-            except Exception as e:
-                logger.exception(f"发生异常 content：{content}")
-                content["error_code"] = ErrorCode.INTERNAL_ERROR
-            if content["error_code"] != 0:
-                yield f"data: {json.dumps(content, ensure_ascii=False)}\n\n"
-                yield "data: [DONE]\n\n"
-                return
-            delta_text = content.get("text", "")
+    # n 个候选同时请求，按到达顺序交错输出
+    streams = [generate_completion_stream(gen_params) for _ in range(n)]
+    if app_settings.stream_coalesce_window_ms > 0:
+        # 合并短时间内到达的增量，减少高吞吐时的 SSE 帧数和 socket 写入
+        streams = [
+            coalesce_stream(
+                stream,
+                app_settings.stream_coalesce_window_ms / 1000,
+                app_settings.stream_coalesce_max_bytes,
+            )
+            for stream in streams
+        ]
+    async for i, content in merge_streams(streams):
+        try:
+            error_code = content["error_code"]
+        except Exception as e:
+            logger.exception(f"发生异常 content：{content}")
+            content["error_code"] = ErrorCode.INTERNAL_ERROR
+        if content["error_code"] != 0:
+            yield f"data: {json.dumps(content, ensure_ascii=False)}\n\n"
+            yield "data: [DONE]\n\n"
+            return
+        delta_text = content.get("text", "")
+        tool_calls = content.get("tool_calls", None)
+        reasoning_content = content.get("reasoning_content", None)
+        finish_reason = content.get("finish_reason", "stop")
+        usage = content.get("usage", None)
+        data = serializer.serialize(
+            i, delta_text, tool_calls, reasoning_content, finish_reason, usage
+        )
+        if data is None:
+            # 快速序列化无法处理的内容，交给 pydantic 校验和序列化
             choice_data = CustomChatCompletionResponseStreamChoice(
                 index=i,
                 delta=CustomDeltaMessage(
                     role="assistant",
                     content=delta_text,
-                    tool_calls=content.get("tool_calls", None),
-                    reasoning_content=content.get("reasoning_content", None),
+                    tool_calls=tool_calls,
+                    reasoning_content=reasoning_content,
                 ),
-                finish_reason=content.get("finish_reason", "stop"),
+                finish_reason=finish_reason,
             )
-
             chunk = CustomChatCompletionStreamResponse(
                 id=id,
                 choices=[choice_data],
                 model=model_name,
-                usage=content.get("usage", None),
+                usage=usage,
                 created=int(time.time()),
                 object="chat.completion.chunk",
             )
-            if delta_text is None:
-                if content.get("finish_reason", None) is not None:
-                    finish_stream_events.append(chunk)
-                continue
-            yield f"data: {chunk.model_dump_json(exclude_unset=True)}\n\n"
+            data = f"data: {chunk.model_dump_json(exclude_unset=True)}\n\n"
+        if delta_text is None:
+            if content.get("finish_reason", None) is not None:
+                finish_stream_events.append(data)
+            continue
+        yield data
     # There is not "content" field in the last delta message, so exclude_none to exclude field "content".
     for finish_chunk in finish_stream_events:
-        yield f"data: {finish_chunk.model_dump_json(exclude_unset=True)}\n\n"
+        yield finish_chunk
     yield "data: [DONE]\n\n"
 
 
@@ -558,41 +885,41 @@ async def create_completion(request: CompletionRequest):
     if error_check_ret is not None:
         return error_check_ret
 
-    request.prompt = process_input(request.model, request.prompt)
+    request.prompt, token_inputs = split_token_inputs(request.prompt)
 
-    worker_addr = get_worker_address(request.model)
-    max_tokens = request.max_tokens
-    for text in request.prompt:
-        if isinstance(max_tokens, int) and max_tokens < request.max_tokens:
-            request.max_tokens = max_tokens
+    max_tokens_list, error_check_ret = await check_completion_context(
+        request, token_inputs
+    )
+    if error_check_ret is not None:
+        return error_check_ret
     if request.stream:
         generator = generate_completion_stream_generator(
-            request, request.n, worker_addr
+            request, request.n, token_inputs, max_tokens_list
         )
         return StreamingResponse(generator, media_type="text/event-stream")
     else:
         text_completions = []
-        for text in request.prompt:
+        for prompt, max_tokens in zip(request.prompt, max_tokens_list):
+            text, prompt_token_ids = ("", prompt) if token_inputs else (prompt, None)
             gen_params = get_gen_params(
                 request.model,
-                worker_addr,
+                "",
                 text,
                 temperature=request.temperature,
                 top_p=request.top_p,
                 top_k=request.top_k,
                 frequency_penalty=request.frequency_penalty,
                 presence_penalty=request.presence_penalty,
-                max_tokens=request.max_tokens,
+                max_tokens=max_tokens,
                 logprobs=request.logprobs,
                 echo=request.echo,
                 stop=request.stop,
                 best_of=request.best_of,
                 use_beam_search=request.use_beam_search,
+                prompt_token_ids=prompt_token_ids,
             )
             for i in range(request.n):
-                content = asyncio.create_task(
-                    generate_completion(gen_params, worker_addr)
-                )
+                content = asyncio.create_task(generate_completion(gen_params))
                 text_completions.append(content)
 
         try:
@@ -623,87 +950,189 @@ async def create_completion(request: CompletionRequest):
 
 
 async def generate_completion_stream_generator(
-    request: CompletionRequest, n: int, worker_addr: str
+    request: CompletionRequest,
+    n: int,
+    token_inputs: bool = False,
+    max_tokens_list: Optional[List[Optional[int]]] = None,
 ):
     model_name = request.model
     id = f"cmpl-{shortuuid.random()}"
     finish_stream_events = []
-    for text in request.prompt:
-        for i in range(n):
-            previous_text = ""
-            gen_params = get_gen_params(
-                request.model,
-                worker_addr,
-                text,
-                temperature=request.temperature,
-                top_p=request.top_p,
-                top_k=request.top_k,
-                presence_penalty=request.presence_penalty,
-                frequency_penalty=request.frequency_penalty,
-                max_tokens=request.max_tokens,
-                logprobs=request.logprobs,
-                echo=request.echo,
-                stop=request.stop,
-            )
-            async for content in generate_completion_stream(gen_params, worker_addr):
-                if content["error_code"] != 0:
-                    yield f"data: {json.dumps(content, ensure_ascii=False)}\n\n"
-                    yield "data: [DONE]\n\n"
-                    return
-                decoded_unicode = content["text"].replace("\ufffd", "")
-                delta_text = decoded_unicode[len(previous_text) :]
-                previous_text = (
-                    decoded_unicode
-                    if len(decoded_unicode) > len(previous_text)
-                    else previous_text
-                )
-                # todo: index is not apparent
-                choice_data = CompletionResponseStreamChoice(
-                    index=i,
-                    text=delta_text,
-                    logprobs=create_openai_logprobs(content.get("logprobs", None)),
-                    finish_reason=content.get("finish_reason", None),
-                )
-                chunk = CompletionStreamResponse(
-                    id=id,
-                    object="text_completion",
-                    choices=[choice_data],
-                    model=model_name,
-                )
-                if len(delta_text) == 0:
-                    if content.get("finish_reason", None) is not None:
-                        finish_stream_events.append(chunk)
-                    continue
-                yield f"data: {chunk.json(exclude_unset=True, ensure_ascii=False)}\n\n"
+    streams = []
+    if max_tokens_list is None:
+        max_tokens_list = [request.max_tokens] * len(request.prompt)
+    for prompt, max_tokens in zip(request.prompt, max_tokens_list):
+        text, prompt_token_ids = ("", prompt) if token_inputs else (prompt, None)
+        gen_params = get_gen_params(
+            request.model,
+            "",
+            text,
+            temperature=request.temperature,
+            top_p=request.top_p,
+            top_k=request.top_k,
+            presence_penalty=request.presence_penalty,
+            frequency_penalty=request.frequency_penalty,
+            max_tokens=max_tokens,
+            logprobs=request.logprobs,
+            echo=request.echo,
+            stop=request.stop,
+            prompt_token_ids=prompt_token_ids,
+        )
+        for _ in range(n):
+            streams.append(generate_completion_stream(gen_params))
+    # 第 p 个 prompt 的第 i 个候选的 index 为 p * n + i
+    previous_texts = [""] * len(streams)
+    async for i, content in merge_streams(streams):
+        if content["error_code"] != 0:
+            yield f"data: {json.dumps(content, ensure_ascii=False)}\n\n"
+            yield "data: [DONE]\n\n"
+            return
+        previous_text = previous_texts[i]
+        decoded_unicode = content["text"].replace("\ufffd", "")
+        delta_text = decoded_unicode[len(previous_text) :]
+        previous_texts[i] = (
+            decoded_unicode
+            if len(decoded_unicode) > len(previous_text)
+            else previous_text
+        )
+        choice_data = CompletionResponseStreamChoice(
+            index=i,
+            text=delta_text,
+            logprobs=create_openai_logprobs(content.get("logprobs", None)),
+            finish_reason=content.get("finish_reason", None),
+        )
+        chunk = CompletionStreamResponse(
+            id=id,
+            object="text_completion",
+            choices=[choice_data],
+            model=model_name,
+        )
+        if len(delta_text) == 0:
+            if content.get("finish_reason", None) is not None:
+                finish_stream_events.append(chunk)
+            continue
+        yield f"data: {chunk.json(exclude_unset=True, ensure_ascii=False)}\n\n"
     # There is not "content" field in the last delta message, so exclude_none to exclude field "content".
     for finish_chunk in finish_stream_events:
         yield f"data: {finish_chunk.json(exclude_unset=True, ensure_ascii=False)}\n\n"
     yield "data: [DONE]\n\n"
 
 
-async def generate_completion_stream(payload: Dict[str, Any], worker_addr: str):
-    async with httpx.AsyncClient() as client:
-        delimiter = b"\0"
-        async with client.stream(
-            "POST",
-            worker_addr + "/worker_generate_stream",
-            headers=headers,
-            json=payload,
-            timeout=60,
-        ) as response:
-            # content = await response.aread()
-            buffer = b""
-            async for raw_chunk in response.aiter_raw():
-                buffer += raw_chunk
-                while (chunk_end := buffer.find(delimiter)) >= 0:
-                    chunk, buffer = buffer[:chunk_end], buffer[chunk_end + 1 :]
-                    if not chunk:
-                        continue
-                    yield orjson.loads(chunk.decode())
+async def merge_streams(streams: list):
+    """同时消费多个异步生成器，按到达顺序产出 (下标, 元素)，全部结束后返回"""
+    if len(streams) == 1:
+        # 客户端断开时立即关闭到 worker 的流，worker 随之中止生成
+        try:
+            async for item in streams[0]:
+                yield 0, item
+        finally:
+            await streams[0].aclose()
+        return
+    queue = asyncio.Queue(maxsize=len(streams) * 8)
+    done = object()
+
+    async def pump(i, stream):
+        try:
+            async for item in stream:
+                await queue.put((i, item))
+        except Exception as e:
+            await queue.put((i, e))
+        else:
+            await queue.put((i, done))
+        finally:
+            # 在 queue.put 处被取消时流仍处于挂起状态，需要显式关闭到 worker 的连接
+            await stream.aclose()
+
+    tasks = [asyncio.create_task(pump(i, stream)) for i, stream in enumerate(streams)]
+    try:
+        remaining = len(tasks)
+        while remaining:
+            i, item = await queue.get()
+            if item is done:
+                remaining -= 1
+            elif isinstance(item, Exception):
+                raise item
+            else:
+                yield i, item
+    finally:
+        # 提前结束（出错或客户端断开）时取消其余的流
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def generate_completion_stream(payload: Dict[str, Any]):
+    model_name = payload["model"]
+    affinity_key = None
+    if worker_router.prefix_affinity:
+        affinity_key = prefix_affinity_key(
+            payload.get("prompt_token_ids") or payload["messages"], payload.get("tools")
+        )
+    exclude = set()
+    attempt = 0
+    while True:
+        with worker_router.acquire(model_name, exclude, affinity_key) as worker_addr:
+            start = time.perf_counter()
+            first_chunk = True
+            try:
+                async with client_pool.stream(
+                    "POST",
+                    worker_addr + "/worker_generate_stream",
+                    headers=stream_headers,
+                    json=payload,
+                    timeout=60,
+                ) as response:
+                    if response.status_code >= 500:
+                        await response.aread()
+                        raise WorkerServerError(
+                            response.status_code, response.reason_phrase
+                        )
+                    # worker 在响应头中返回实际使用的帧格式
+                    reader = create_frame_reader(
+                        response.headers.get(FRAME_FORMAT_HEADER)
+                    )
+                    async for raw_chunk in response.aiter_raw():
+                        for content in reader.feed(raw_chunk):
+                            if first_chunk:
+                                first_chunk = False
+                                worker_router.record_ttft(
+                                    model_name, worker_addr, time.perf_counter() - start
+                                )
+                            yield content
+                return
+            except RETRYABLE_ERRORS as e:
+                # 已经输出过内容的请求无法透明重试
+                if not first_chunk:
+                    worker_router.record_failure(model_name, worker_addr)
+                    raise
+                if not should_retry(model_name, worker_addr, exclude, attempt):
+                    if isinstance(e, WorkerServerError):
+                        yield {
+                            "text": e.detail,
+                            "error_code": ErrorCode.INTERNAL_ERROR,
+                        }
+                        return
+                    raise
+                attempt += 1
+                logger.warning(
+                    f"{model_name} worker {worker_addr} failed: {e!r}, retry {attempt}"
+                )
 
 
-async def generate_completion(payload: Dict[str, Any], worker_addr: str):
-    return await fetch_remote(worker_addr + "/worker_generate", payload, "")
+async def generate_completion(payload: Dict[str, Any]):
+    affinity_key = None
+    if worker_router.prefix_affinity:
+        affinity_key = prefix_affinity_key(
+            payload.get("prompt_token_ids") or payload["messages"], payload.get("tools")
+        )
+    return await fetch_worker(
+        payload["model"],
+        "/worker_generate",
+        payload,
+        "",
+        record_ttft=False,
+        affinity_key=affinity_key,
+    )
 
 
 # TODO 使用CustomEmbeddingsRequest
@@ -718,11 +1147,8 @@ from gpt_server.openai_api_protocol.custom_api_protocol import (
 
 
 async def get_images_gen(payload: Dict[str, Any]):
-    model_name = payload["model"]
-    worker_addr = get_worker_address(model_name)
-
-    transcription = await fetch_remote(
-        worker_addr + "/worker_get_image_output", payload
+    transcription = await fetch_worker(
+        payload["model"], "/worker_get_image_output", payload
     )
     return json.loads(transcription)
 
@@ -748,20 +1174,43 @@ import uuid
 OUTPUT_DIR = "./edge_tts_cache"
 
 
-async def generate_voice_stream(payload: Dict[str, Any], worker_addr: str):
-    async with httpx.AsyncClient() as client:
-        async with client.stream(
-            "POST",
-            worker_addr,
-            headers=headers,
-            json=payload,
-            timeout=WORKER_API_TIMEOUT,
-        ) as response:
-            if response.status_code != 200:
-                error_detail = await response.aread()
-                raise Exception(f"API请求失败: {response.status_code},  {error_detail}")
-            async for chunk in response.aiter_bytes():  # 流式迭代器
-                yield chunk
+async def generate_voice_stream(payload: Dict[str, Any], path: str):
+    model_name = payload["model"]
+    exclude = set()
+    attempt = 0
+    while True:
+        with worker_router.acquire(model_name, exclude) as worker_addr:
+            first_chunk = True
+            try:
+                async with client_pool.stream(
+                    "POST",
+                    worker_addr + path,
+                    headers=headers,
+                    json=payload,
+                    timeout=WORKER_API_TIMEOUT,
+                ) as response:
+                    if response.status_code >= 500:
+                        error_detail = await response.aread()
+                        raise WorkerServerError(response.status_code, error_detail)
+                    if response.status_code != 200:
+                        error_detail = await response.aread()
+                        raise Exception(
+                            f"API请求失败: {response.status_code},  {error_detail}"
+                        )
+                    async for chunk in response.aiter_bytes():  # 流式迭代器
+                        first_chunk = False
+                        yield chunk
+                return
+            except RETRYABLE_ERRORS as e:
+                if not first_chunk:
+                    worker_router.record_failure(model_name, worker_addr)
+                    raise
+                if not should_retry(model_name, worker_addr, exclude, attempt):
+                    raise
+                attempt += 1
+                logger.warning(
+                    f"{model_name} worker {worker_addr} failed: {e!r}, retry {attempt}"
+                )
 
 
 @app.post("/v1/audio/speech", dependencies=[Depends(check_api_key)])
@@ -777,7 +1226,6 @@ async def speech(request: OpenAISpeechRequest):
     if error_check_ret is not None:
         return error_check_ret
 
-    worker_addr = get_worker_address(request.model)
     response_format = request.response_format
     payload = {
         "model": request.model,
@@ -796,9 +1244,7 @@ async def speech(request: OpenAISpeechRequest):
         "pcm": "audio/pcm",
     }.get(response_format, f"audio/{response_format}")
     if request.stream:
-        stream_output = generate_voice_stream(
-            payload, worker_addr + "/worker_generate_voice_stream"
-        )
+        stream_output = generate_voice_stream(payload, "/worker_generate_voice_stream")
         return StreamingResponse(
             stream_output,
             media_type=content_type,
@@ -838,12 +1284,8 @@ async def speech(request: SpeechRequest):
 
 
 async def get_transcriptions(payload: Dict[str, Any]):
-    controller_address = app_settings.controller_address
-    model_name = payload["model"]
-    worker_addr = get_worker_address(model_name)
-
-    transcription = await fetch_remote(
-        worker_addr + "/worker_get_transcription", payload
+    transcription = await fetch_worker(
+        payload["model"], "/worker_get_transcription", payload
     )
     return json.loads(transcription)
 
@@ -892,20 +1334,21 @@ async def classify(request: ModerationsRequest):
     request.input = process_input(request.model, request.input)
     results = []
     token_num = 0
-    batch_size = WORKER_API_EMBEDDING_BATCH_SIZE
-    batches = [
-        request.input[i : min(i + batch_size, len(request.input))]
-        for i in range(0, len(request.input), batch_size)
-    ]
-    for num_batch, batch in enumerate(batches):
-        payload = {
-            "model": request.model,
-            "input": batch,
-            "threshold": request.threshold,
-        }
-        classify = await get_classify(payload)
+    batches = split_batches(request.model, request.input)
+    outputs = await gather_batches(
+        get_classify(
+            {
+                "model": request.model,
+                "input": batch,
+                "threshold": request.threshold,
+            }
+        )
+        for _, batch in batches
+    )
+    for classify in outputs:
         if "error_code" in classify and classify["error_code"] != 0:
             return create_error_response(classify["error_code"], classify["text"])
+    for classify in outputs:
         for i, res in enumerate(classify["results"]):
             result = {
                 "flagged": res["flagged"],
@@ -935,31 +1378,33 @@ async def rerank(request: RerankRequest):
     request.documents = process_input(request.model, request.documents)
     results = []
     token_num = 0
-    batch_size = WORKER_API_EMBEDDING_BATCH_SIZE
-    batches = [
-        request.documents[i : min(i + batch_size, len(request.documents))]
-        for i in range(0, len(request.documents), batch_size)
-    ]
-    for num_batch, batch in enumerate(batches):
-        payload = {
-            "model": request.model,
-            "input": batch,
-            "encoding_format": None,
-            "query": request.query,  # TODO add query
-        }
-        embedding = await get_embedding(payload)
+    batches = split_batches(request.model, request.documents)
+    outputs = await gather_batches(
+        get_embedding(
+            {
+                "model": request.model,
+                "input": batch,
+                "encoding_format": None,
+                "query": request.query,  # TODO add query
+            }
+        )
+        for _, batch in batches
+    )
+    for embedding in outputs:
         if "error_code" in embedding and embedding["error_code"] != 0:
             return create_error_response(embedding["error_code"], embedding["text"])
+    for (offset, _), embedding in zip(batches, outputs):
         for i, emb in enumerate(embedding["embedding"]):
             result = {
-                "index": num_batch * batch_size + i,
+                "index": offset + i,
                 "relevance_score": emb[0],
             }
             if request.return_documents:
-                result["document"] = request.documents[num_batch * batch_size + i]
+                result["document"] = request.documents[offset + i]
             results.append(result)
 
         token_num += embedding["token_num"]
+    # 所有批次返回后再做全局排序和 top_n
     results.sort(key=lambda x: x["relevance_score"], reverse=True)
     if request.top_n:
         results = results[: request.top_n]
@@ -984,34 +1429,59 @@ async def create_embeddings(request: CustomEmbeddingsRequest, model_name: str =
     if error_check_ret is not None:
         return error_check_ret
 
-    request.input = process_input(request.model, request.input)
+    request.input, token_inputs = split_token_inputs(request.input)
+    # token ids 以 input_ids 转发给 worker
+    input_key = "input_ids" if token_inputs else "input"
 
     data = []
     token_num = 0
-    batch_size = WORKER_API_EMBEDDING_BATCH_SIZE
-    batches = [
-        request.input[i : min(i + batch_size, len(request.input))]
-        for i in range(0, len(request.input), batch_size)
-    ]
-    for num_batch, batch in enumerate(batches):
-        payload = {
-            "model": request.model,
-            "input": batch,
-            "encoding_format": request.encoding_format,
-            "query": request.query,  # TODO add query
-        }
-        embedding = await get_embedding(payload)
-        if "error_code" in embedding and embedding["error_code"] != 0:
-            return create_error_response(embedding["error_code"], embedding["text"])
-        data += [
+    # query 会影响 embedding 结果，带 query 的请求不走缓存
+    use_cache = embedding_cache.enabled and request.query is None
+    cached = {}
+    inputs = request.input
+    if use_cache:
+        # token ids 与文本的缓存键区分开
+        keys, cached = embedding_cache.lookup(
+            request.model,
+            [{"input_ids": i} for i in inputs] if token_inputs else inputs,
+            request.encoding_format,
+        )
+        # 只把未命中的输入发给 worker
+        miss_indices = [i for i in range(len(request.input)) if i not in cached]
+        inputs = [request.input[i] for i in miss_indices]
+    batches = split_batches(request.model, inputs)
+    outputs = await gather_batches(
+        get_embedding(
             {
-                "object": "embedding",
-                "embedding": emb,
-                "index": num_batch * batch_size + i,
+                "model": request.model,
+                "input": None,
+                input_key: batch,
+                "encoding_format": request.encoding_format,
+                "query": request.query,  # TODO add query
             }
-            for i, emb in enumerate(embedding["embedding"])
-        ]
+        )
+        for _, batch in batches
+    )
+    for embedding in outputs:
+        if "error_code" in embedding and embedding["error_code"] != 0:
+            return create_error_response(embedding["error_code"], embedding["text"])
+    embeddings = []
+    for embedding in outputs:
+        embeddings += embedding["embedding"]
         token_num += embedding["token_num"]
+    if use_cache:
+        for i, emb in zip(miss_indices, embeddings):
+            embedding_cache.put(request.model, keys[i], emb)
+            cached[i] = emb
+        embeddings = [cached[i] for i in range(len(request.input))]
+    data = [
+        {
+            "object": "embedding",
+            "embedding": emb,
+            "index": i,
+        }
+        for i, emb in enumerate(embeddings)
+    ]
     return EmbeddingsResponse(
         data=data,
         model=request.model,
@@ -1023,21 +1493,42 @@ async def create_embeddings(request: CustomEmbeddingsRequest, model_name: str =
     ).dict(exclude_none=True)
 
 
-async def get_classify(payload: Dict[str, Any]):
-    controller_address = app_settings.controller_address
-    model_name = payload["model"]
-    worker_addr = get_worker_address(model_name)
+# 输入少于该条数时不再继续拆分到多个副本
+MIN_SHARD_SIZE = 32
+
 
-    classify = await fetch_remote(worker_addr + "/worker_get_classify", payload)
+def split_batches(model_name: str, inputs: list) -> List[tuple]:
+    """把输入切分为 [(offset, batch)]，批次数不少于模型的副本数，使所有副本同时工作"""
+    batch_size = WORKER_API_EMBEDDING_BATCH_SIZE
+    num_workers = len(worker_registry.get_workers(model_name))
+    if num_workers > 1:
+        shard_size = max(-(-len(inputs) // num_workers), MIN_SHARD_SIZE)
+        batch_size = min(batch_size, shard_size)
+    return [
+        (i, inputs[i : i + batch_size]) for i in range(0, len(inputs), batch_size)
+    ]
+
+
+async def gather_batches(coros) -> list:
+    """以有限并发执行各批次请求，结果按输入顺序返回"""
+    semaphore = asyncio.Semaphore(app_settings.embedding_batch_concurrency)
+
+    async def run(coro):
+        async with semaphore:
+            return await coro
+
+    return await asyncio.gather(*[run(coro) for coro in coros])
+
+
+async def get_classify(payload: Dict[str, Any]):
+    classify = await fetch_worker(payload["model"], "/worker_get_classify", payload)
     return json.loads(classify)
 
 
 async def get_embedding(payload: Dict[str, Any]):
-    controller_address = app_settings.controller_address
-    model_name = payload["model"]
-    worker_addr = get_worker_address(model_name)
-
-    embedding = await fetch_remote(worker_addr + "/worker_get_embeddings", payload)
+    embedding = await fetch_worker(
+        payload["model"], "/worker_get_embeddings", payload
+    )
     return json.loads(embedding)
 
 
@@ -1050,32 +1541,30 @@ async def count_tokens(request: APITokenCheckRequest):
     Checks the token count for each message in your list
     This is not part of the OpenAI API spec.
     """
-    checkedList = []
-    for item in request.prompts:
-        worker_addr = get_worker_address(item.model)
-
-        context_len = await fetch_remote(
-            worker_addr + "/model_details",
-            {"prompt": item.prompt, "model": item.model},
-            "context_length",
-        )
-
-        token_num = await fetch_remote(
-            worker_addr + "/count_token",
-            {"prompt": item.prompt, "model": item.model},
-            "count",
+    # 按模型分组，每个模型的 prompt 一次批量计数
+    groups: Dict[str, List[int]] = {}
+    for i, item in enumerate(request.prompts):
+        if item.model not in groups:
+            error_check_ret = check_model(item)
+            if error_check_ret is not None:
+                return error_check_ret
+        groups.setdefault(item.model, []).append(i)
+    checkedList = [None] * len(request.prompts)
+
+    async def check(model_name: str, indices: List[int]):
+        info = await model_info_registry.get(model_name)
+        token_nums = await count_prompt_tokens(
+            model_name, [request.prompts[i].prompt for i in indices]
         )
-
-        can_fit = True
-        if token_num + item.max_tokens > context_len:
-            can_fit = False
-
-        checkedList.append(
-            APITokenCheckResponseItem(
-                fits=can_fit, contextLength=context_len, tokenCount=token_num
+        for i, token_num in zip(indices, token_nums):
+            item = request.prompts[i]
+            checkedList[i] = APITokenCheckResponseItem(
+                fits=token_num + item.max_tokens <= info.context_length,
+                contextLength=info.context_length,
+                tokenCount=token_num,
             )
-        )
 
+    await asyncio.gather(*[check(model, indices) for model, indices in groups.items()])
     return APITokenCheckResponse(prompts=checkedList)
 
 
@@ -1086,11 +1575,9 @@ async def create_chat_completion(request: APIChatCompletionRequest):
     if error_check_ret is not None:
         return error_check_ret
 
-    worker_addr = get_worker_address(request.model)
-
     gen_params = get_gen_params(
         request.model,
-        worker_addr,
+        "",
         request.messages,
         temperature=request.temperature,
         top_p=request.top_p,
@@ -1107,14 +1594,14 @@ async def create_chat_completion(request: APIChatCompletionRequest):
 
     if request.stream:
         generator = chat_completion_stream_generator(
-            request.model, gen_params, request.n, worker_addr
+            request.model, gen_params, request.n
         )
         return StreamingResponse(generator, media_type="text/event-stream")
 
     choices = []
     chat_completions = []
     for i in range(request.n):
-        content = asyncio.create_task(generate_completion(gen_params, worker_addr))
+        content = asyncio.create_task(generate_completion(gen_params))
         chat_completions.append(content)
     try:
         all_tasks = await asyncio.gather(*chat_completions)
@@ -1168,6 +1655,93 @@ def create_openai_api_server():
         default=None,
         help="Optional list of comma separated API keys",
     )
+    parser.add_argument(
+        "--worker-max-connections",
+        type=int,
+        default=512,
+        help="Max HTTP connections from one API server process to one worker",
+    )
+    parser.add_argument(
+        "--worker-max-keepalive",
+        type=int,
+        default=128,
+        help="Max idle keep-alive connections kept per worker",
+    )
+    parser.add_argument(
+        "--worker-failure-cooldown",
+        type=float,
+        default=10.0,
+        help="Seconds a worker is skipped by the router after a failed connection",
+    )
+    parser.add_argument(
+        "--worker-retries",
+        type=int,
+        default=2,
+        help="How many other replicas to try when a worker fails before sending any output",
+    )
+    parser.add_argument(
+        "--embedding-batch-concurrency",
+        type=int,
+        default=8,
+        help="Max concurrent worker batches for one embedding, rerank or moderation request",
+    )
+    parser.add_argument(
+        "--embedding-cache-max-bytes",
+        type=int,
+        default=0,
+        help="In-memory embedding cache budget in bytes, 0 disables the cache",
+    )
+    parser.add_argument(
+        "--embedding-cache-disk-dir",
+        type=str,
+        default=None,
+        help="Directory of the memory-mapped on-disk embedding cache tier",
+    )
+    parser.add_argument(
+        "--embedding-cache-disk-max-bytes",
+        type=int,
+        default=1 << 30,
+        help="On-disk embedding cache budget per model in bytes",
+    )
+    parser.add_argument(
+        "--worker-frame-format",
+        type=str,
+        choices=["json", "msgpack", "delta"],
+        default="json",
+        help="Wire format requested from workers for streaming generation",
+    )
+    parser.add_argument(
+        "--stream-coalesce-window-ms",
+        type=float,
+        default=0,
+        help="Merge chat stream deltas arriving within this window, 0 disables it",
+    )
+    parser.add_argument(
+        "--stream-coalesce-max-bytes",
+        type=int,
+        default=1024,
+        help="Flush a coalesced chat stream chunk once it reaches this many bytes",
+    )
+    parser.add_argument(
+        "--routing-mode",
+        type=str,
+        choices=["least_outstanding", "prefix_affinity"],
+        default="least_outstanding",
+        help="How requests are spread over replicas of the same model",
+    )
+    parser.add_argument(
+        "--prefix-affinity-load-factor",
+        type=float,
+        default=1.25,
+        help="Max in-flight load of a replica relative to the average before prefix-affinity routing overflows",
+    )
+    parser.add_argument(
+        "--max-tokens-policy",
+        type=str,
+        choices=["off", "clamp", "reject"],
+        default="off",
+        help="What to do when prompt tokens plus max_tokens exceed the model's context length",
+    )
     parser.add_argument(
         "--ssl",
         action="store_true",
@@ -1187,6 +1761,23 @@ def create_openai_api_server():
     os.environ["controller_address"] = args.controller_address
     if args.api_keys:
         os.environ["api_keys"] = args.api_keys
+    os.environ["worker_max_connections"] = str(args.worker_max_connections)
+    os.environ["worker_max_keepalive"] = str(args.worker_max_keepalive)
+    os.environ["worker_failure_cooldown"] = str(args.worker_failure_cooldown)
+    os.environ["worker_retries"] = str(args.worker_retries)
+    os.environ["embedding_batch_concurrency"] = str(args.embedding_batch_concurrency)
+    os.environ["embedding_cache_max_bytes"] = str(args.embedding_cache_max_bytes)
+    if args.embedding_cache_disk_dir:
+        os.environ["embedding_cache_disk_dir"] = args.embedding_cache_disk_dir
+    os.environ["embedding_cache_disk_max_bytes"] = str(
+        args.embedding_cache_disk_max_bytes
+    )
+    os.environ["worker_frame_format"] = args.worker_frame_format
+    os.environ["stream_coalesce_window_ms"] = str(args.stream_coalesce_window_ms)
+    os.environ["stream_coalesce_max_bytes"] = str(args.stream_coalesce_max_bytes)
+    os.environ["routing_mode"] = args.routing_mode
+    os.environ["prefix_affinity_load_factor"] = str(args.prefix_affinity_load_factor)
+    os.environ["max_tokens_policy"] = args.max_tokens_policy
 
     logger.info(f"args: {args}")
     return args
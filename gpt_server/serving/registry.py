@@ -0,0 +1,88 @@
+from typing import Dict, List
+
+
+class WorkerRegistry:
+    """API server 进程内的 worker 注册表副本
+
+    由 controller 的 /registry_stream 推送的快照和增量事件维护，
+    每个事件带有递增的 version，出现版本空洞时需要重新拉取快照。
+    """
+
+    def __init__(self):
+        self.version = -1
+        # Dict[worker_addr -> {"model_names", "speed", "queue_length", "multimodal"}]
+        self.workers: Dict[str, dict] = {}
+        # Dict[model_name -> List[worker_addr]]
+        self.model_workers: Dict[str, List[str]] = {}
+        # Dict[model_name -> "addr1,addr2"]，保持与 controller 旧接口一致的格式
+        self.model_address_map: Dict[str, str] = {}
+        self.models: List[str] = []
+        # Dict[model_name -> epoch]，embedding 缓存的失效代数
+        self.embedding_cache_epochs: Dict[str, int] = {}
+
+    def apply_snapshot(self, snapshot: dict):
+        self.workers = {
+            w_name: dict(w_info) for w_name, w_info in snapshot["workers"].items()
+        }
+        self.version = snapshot.get("version", -1)
+        if "embedding_cache_epochs" in snapshot:
+            self.embedding_cache_epochs = dict(snapshot["embedding_cache_epochs"])
+        self._rebuild()
+
+    def apply_event(self, event: dict) -> bool:
+        """应用一个增量事件，返回 False 表示版本不连续，需要重新同步"""
+        if event["type"] == "snapshot":
+            self.apply_snapshot(event)
+            return True
+        version = event["version"]
+        if version <= self.version:
+            return True
+        if version != self.version + 1:
+            return False
+        self.version = version
+        if event["type"] == "embedding_cache_epoch":
+            self.embedding_cache_epochs[event["model_name"]] = event["epoch"]
+            return True
+        worker_name = event["worker_name"]
+        if event["type"] == "register":
+            self.workers[worker_name] = {
+                "model_names": event["model_names"],
+                "speed": event["speed"],
+                "queue_length": event["queue_length"],
+                "multimodal": event["multimodal"],
+            }
+            self._rebuild()
+        elif event["type"] == "remove":
+            if self.workers.pop(worker_name, None) is not None:
+                self._rebuild()
+        elif event["type"] == "queue_length":
+            if worker_name in self.workers:
+                self.workers[worker_name]["queue_length"] = event["queue_length"]
+        return True
+
+    def _rebuild(self):
+        model_workers = {}
+        for w_name, w_info in self.workers.items():
+            for model_name in w_info["model_names"]:
+                model_workers.setdefault(model_name, []).append(w_name)
+        self.model_workers = model_workers
+        self.model_address_map = {
+            model_name: ",".join(w_names)
+            for model_name, w_names in model_workers.items()
+        }
+        self.models = list(model_workers.keys())
+
+    def get_workers(self, model_name: str) -> List[str]:
+        return self.model_workers.get(model_name, [])
+
+    def get_queue_length(self, worker_addr: str) -> int:
+        w_info = self.workers.get(worker_addr)
+        if w_info is None:
+            return 0
+        return w_info["queue_length"]
+
+    def get_speed(self, worker_addr: str) -> float:
+        w_info = self.workers.get(worker_addr)
+        if w_info is None:
+            return 1
+        return w_info["speed"]
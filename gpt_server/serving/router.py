@@ -0,0 +1,288 @@
+import bisect
+from contextlib import contextmanager
+from dataclasses import dataclass
+import hashlib
+import math
+import random
+import time
+from typing import Any, Dict, Iterable, List, Optional
+
+import orjson
+
+from gpt_server.serving.registry import WorkerRegistry
+
+# 计算前缀亲和键时，纯文本 prompt 取前多少个字符
+PROMPT_AFFINITY_CHARS = 1024
+# token ids prompt 取前多少个 token
+PROMPT_AFFINITY_TOKENS = 256
+
+
+def hash_bytes(data: bytes) -> int:
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), "big")
+
+
+def prefix_affinity_key(messages: Any, tools: Optional[list] = None) -> Optional[int]:
+    """根据请求的前导消息块（system prompt、工具定义）计算亲和键
+
+    没有 system 和 tools 时使用第一条消息，使同一多轮会话落到同一副本。
+    """
+    if isinstance(messages, str):
+        if not messages:
+            return None
+        return hash_bytes(messages[:PROMPT_AFFINITY_CHARS].encode())
+    if not messages:
+        return None
+    if isinstance(messages[0], int):
+        # 客户端直接传入的 prompt token ids
+        return hash_bytes(orjson.dumps(messages[:PROMPT_AFFINITY_TOKENS]))
+    leading = []
+    for message in messages:
+        if message.get("role") != "system":
+            break
+        leading.append(message)
+    if not leading and not tools:
+        leading = messages[:1]
+    try:
+        data = orjson.dumps([leading, tools])
+    except TypeError:
+        return None
+    return hash_bytes(data)
+
+
+class ConsistentHashRing:
+    """带虚拟节点的一致性哈希环"""
+
+    def __init__(self, nodes: List[str], replicas: int = 64):
+        ring = []
+        for node in nodes:
+            for i in range(replicas):
+                ring.append((hash_bytes(f"{node}#{i}".encode()), node))
+        ring.sort()
+        self.hashes = [h for h, _ in ring]
+        self.nodes = [node for _, node in ring]
+
+    def iter_nodes(self, key: int):
+        """从 key 所在位置开始顺时针遍历，每个节点只返回一次"""
+        if not self.nodes:
+            return
+        seen = set()
+        start = bisect.bisect(self.hashes, key)
+        for i in range(len(self.nodes)):
+            node = self.nodes[(start + i) % len(self.nodes)]
+            if node not in seen:
+                seen.add(node)
+                yield node
+
+
+@dataclass
+class WorkerLoad:
+    # 本进程向该 worker 发出、尚未结束的请求数
+    in_flight: int = 0
+    # 首包耗时（秒）的指数滑动平均，0 表示还没有样本
+    ttft_ewma: float = 0.0
+    # 连接失败后的隔离截止时间
+    failed_until: float = 0.0
+    failures: int = 0
+
+
+class ModelRouter:
+    """单个模型的路由器：选择未完成请求最少（按近期 TTFT 加权）的 worker
+
+    未完成请求数取本进程的 in_flight 与 controller 推送的 queue_length 中的较大值，
+    queue_length 包含其它 API server 发往该 worker 的请求，再按 worker 上报的速度归一化。
+    """
+
+    def __init__(
+        self,
+        model_name: str,
+        failure_cooldown: float = 10.0,
+        ttft_alpha: float = 0.2,
+        affinity_load_factor: float = 1.25,
+        registry: Optional[WorkerRegistry] = None,
+    ):
+        self.model_name = model_name
+        self.registry = registry
+        self.failure_cooldown = failure_cooldown
+        self.ttft_alpha = ttft_alpha
+        # 有界负载一致性哈希：单个副本的未完成请求数不超过平均值的该倍数
+        self.affinity_load_factor = affinity_load_factor
+        self.workers: List[str] = []
+        self.loads: Dict[str, WorkerLoad] = {}
+        self.ring = ConsistentHashRing([])
+
+    def set_workers(self, workers: List[str]):
+        self.workers = workers
+        self.ring = ConsistentHashRing(workers)
+        for worker_addr in workers:
+            if worker_addr not in self.loads:
+                self.loads[worker_addr] = WorkerLoad()
+        for worker_addr in list(self.loads):
+            # 已下线且没有未完成请求的 worker 不再保留统计
+            if worker_addr not in workers and self.loads[worker_addr].in_flight <= 0:
+                del self.loads[worker_addr]
+
+    def outstanding(self, worker_addr: str) -> int:
+        in_flight = self.loads[worker_addr].in_flight
+        if self.registry is None:
+            return in_flight
+        return max(in_flight, self.registry.get_queue_length(worker_addr))
+
+    def score(self, worker_addr: str, default_ttft: float) -> float:
+        ttft = self.loads[worker_addr].ttft_ewma or default_ttft
+        speed = 1 if self.registry is None else self.registry.get_speed(worker_addr)
+        return (self.outstanding(worker_addr) + 1) * ttft / max(speed, 1e-4)
+
+    def select(
+        self, exclude: Iterable[str] = (), affinity_key: Optional[int] = None
+    ) -> Optional[str]:
+        candidates = [w for w in self.workers if w not in exclude]
+        if not candidates:
+            return None
+        now = time.monotonic()
+        healthy = [w for w in candidates if self.loads[w].failed_until <= now]
+        # 所有副本都处于隔离期时，仍然尝试其中一个
+        candidates = healthy or candidates
+        if len(candidates) == 1:
+            return candidates[0]
+        if affinity_key is not None:
+            worker_addr = self.select_by_affinity(candidates, affinity_key)
+            if worker_addr is not None:
+                return worker_addr
+        known_ttft = [
+            self.loads[w].ttft_ewma for w in candidates if self.loads[w].ttft_ewma
+        ]
+        default_ttft = sum(known_ttft) / len(known_ttft) if known_ttft else 1.0
+        scores = [self.score(w, default_ttft) for w in candidates]
+        min_score = min(scores)
+        best = [w for w, score in zip(candidates, scores) if score == min_score]
+        return random.choice(best)
+
+    def select_by_affinity(self, candidates: List[str], affinity_key: int):
+        """沿哈希环选择第一个未超出负载上限的副本，超出时溢出到环上的下一个"""
+        outstanding = {w: self.outstanding(w) for w in candidates}
+        max_load = math.ceil(
+            self.affinity_load_factor
+            * (sum(outstanding.values()) + 1)
+            / len(candidates)
+        )
+        for worker_addr in self.ring.iter_nodes(affinity_key):
+            if worker_addr not in outstanding:
+                continue
+            if outstanding[worker_addr] < max_load:
+                return worker_addr
+        return None
+
+    def acquire(self, worker_addr: str):
+        self.loads.setdefault(worker_addr, WorkerLoad()).in_flight += 1
+
+    def release(self, worker_addr: str):
+        load = self.loads.get(worker_addr)
+        if load is not None:
+            load.in_flight -= 1
+
+    def record_ttft(self, worker_addr: str, ttft: float):
+        load = self.loads.get(worker_addr)
+        if load is None:
+            return
+        if load.ttft_ewma:
+            load.ttft_ewma += self.ttft_alpha * (ttft - load.ttft_ewma)
+        else:
+            load.ttft_ewma = ttft
+        load.failures = 0
+
+    def record_failure(self, worker_addr: str):
+        load = self.loads.get(worker_addr)
+        if load is None:
+            return
+        load.failures += 1
+        load.failed_until = time.monotonic() + self.failure_cooldown
+
+    def metrics(self) -> dict:
+        now = time.monotonic()
+        return {
+            worker_addr: {
+                "in_flight": load.in_flight,
+                "queue_length": (
+                    None
+                    if self.registry is None
+                    else self.registry.get_queue_length(worker_addr)
+                ),
+                "ttft_ewma": load.ttft_ewma,
+                "quarantined": load.failed_until > now,
+                "failures": load.failures,
+            }
+            for worker_addr, load in self.loads.items()
+        }
+
+
+class WorkerRouter:
+    """API server 进程内按模型划分的路由器集合，worker 列表取自本地注册表"""
+
+    def __init__(
+        self,
+        registry: WorkerRegistry,
+        failure_cooldown: float = 10.0,
+        routing_mode: str = "least_outstanding",
+        affinity_load_factor: float = 1.25,
+    ):
+        if routing_mode not in ("least_outstanding", "prefix_affinity"):
+            raise ValueError(f"Invalid routing mode: {routing_mode}")
+        self.registry = registry
+        self.failure_cooldown = failure_cooldown
+        self.routing_mode = routing_mode
+        self.affinity_load_factor = affinity_load_factor
+        self.routers: Dict[str, ModelRouter] = {}
+
+    @property
+    def prefix_affinity(self) -> bool:
+        return self.routing_mode == "prefix_affinity"
+
+    def get_router(self, model_name: str) -> ModelRouter:
+        router = self.routers.get(model_name)
+        if router is None:
+            router = ModelRouter(
+                model_name,
+                failure_cooldown=self.failure_cooldown,
+                affinity_load_factor=self.affinity_load_factor,
+                registry=self.registry,
+            )
+            self.routers[model_name] = router
+        workers = self.registry.get_workers(model_name)
+        # 注册表在成员变化时会重建列表对象，因此按对象身份判断即可
+        if router.workers is not workers:
+            router.set_workers(workers)
+        return router
+
+    @contextmanager
+    def acquire(
+        self,
+        model_name: str,
+        exclude: Iterable[str] = (),
+        affinity_key: Optional[int] = None,
+    ):
+        """选择一个 worker 并在使用期间计入其未完成请求数"""
+        router = self.get_router(model_name)
+        if not self.prefix_affinity:
+            affinity_key = None
+        worker_addr = router.select(exclude, affinity_key)
+        if worker_addr is None:
+            raise ValueError(f"No available worker for {model_name}")
+        router.acquire(worker_addr)
+        try:
+            yield worker_addr
+        finally:
+            router.release(worker_addr)
+
+    def has_worker(self, model_name: str, exclude: Iterable[str] = ()) -> bool:
+        return any(w not in exclude for w in self.registry.get_workers(model_name))
+
+    def record_ttft(self, model_name: str, worker_addr: str, ttft: float):
+        self.get_router(model_name).record_ttft(worker_addr, ttft)
+
+    def record_failure(self, model_name: str, worker_addr: str):
+        self.get_router(model_name).record_failure(worker_addr)
+
+    def metrics(self) -> dict:
+        return {
+            model_name: router.metrics() for model_name, router in self.routers.items()
+        }
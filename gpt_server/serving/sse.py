@@ -0,0 +1,209 @@
+import asyncio
+import time
+from typing import Any, Optional
+
+import orjson
+
+# CustomChatCompletionResponseStreamChoice.finish_reason 允许的取值
+FINISH_REASONS = {None, "stop", "length", "tool_calls", "error"}
+# UsageInfo 的字段顺序
+USAGE_FIELDS = ("prompt_tokens", "total_tokens", "completion_tokens")
+
+
+def dump_usage(usage: Any) -> Optional[bytes]:
+    """按 UsageInfo 的字段顺序序列化 usage，只输出传入的字段（与 exclude_unset 一致）"""
+    if usage is None:
+        return b"null"
+    if not isinstance(usage, dict):
+        return None
+    parts = []
+    for field in USAGE_FIELDS:
+        if field not in usage:
+            continue
+        value = usage[field]
+        if type(value) is not int and not (
+            value is None and field == "completion_tokens"
+        ):
+            return None
+        parts.append(b'"%s":%s' % (field.encode(), orjson.dumps(value)))
+    return b"{" + b",".join(parts) + b"}"
+
+
+class ChatChunkSerializer:
+    """chat.completion.chunk 的 SSE 快速序列化
+
+    每个流只构造一次 id、object、created、model 等固定部分，
+    每个 token 只序列化变化的字段，输出与
+    CustomChatCompletionStreamResponse.model_dump_json(exclude_unset=True) 逐字节一致。
+    无法保证一致的输入（需要 pydantic 做类型转换或校验）返回 None，由调用方走原来的逻辑。
+    """
+
+    def __init__(self, id: str, model: str, created: Optional[int] = None):
+        if created is None:
+            created = int(time.time())
+        self.prefix = b"".join(
+            [
+                b'data: {"id":',
+                orjson.dumps(id),
+                b',"object":"chat.completion.chunk","created":',
+                str(created).encode(),
+                b',"model":',
+                orjson.dumps(model),
+                b',"choices":[{"index":',
+            ]
+        )
+
+    def serialize(
+        self,
+        index: int,
+        content: Optional[str],
+        tool_calls: Optional[list],
+        reasoning_content: Optional[str],
+        finish_reason: Optional[str],
+        usage: Any,
+    ) -> Optional[bytes]:
+        if finish_reason not in FINISH_REASONS:
+            return None
+        if content is not None and type(content) is not str:
+            return None
+        if reasoning_content is not None and type(reasoning_content) is not str:
+            return None
+        if tool_calls is not None and type(tool_calls) is not list:
+            return None
+        usage_bytes = dump_usage(usage)
+        if usage_bytes is None:
+            return None
+        try:
+            tool_calls_bytes = orjson.dumps(tool_calls)
+        except TypeError:
+            return None
+        return b"".join(
+            [
+                self.prefix,
+                str(index).encode(),
+                b',"delta":{"role":"assistant","content":',
+                orjson.dumps(content),
+                b',"tool_calls":',
+                tool_calls_bytes,
+                b',"reasoning_content":',
+                orjson.dumps(reasoning_content),
+                b'},"finish_reason":',
+                orjson.dumps(finish_reason),
+                b'}],"usage":',
+                usage_bytes,
+                b"}\n\n",
+            ]
+        )
+
+
+# coalesce_stream 中等待合并的帧数上限
+COALESCE_QUEUE_SIZE = 64
+
+# 可以合并的增量帧只包含这些字段
+COALESCE_KEYS = {
+    "text",
+    "error_code",
+    "usage",
+    "finish_reason",
+    "reasoning_content",
+}
+
+
+def is_coalescable(content: dict) -> bool:
+    return (
+        content.keys() <= COALESCE_KEYS
+        and content.get("error_code", 0) == 0
+        and content.get("finish_reason") is None
+        and isinstance(content.get("text", ""), str)
+        and isinstance(content.get("reasoning_content") or "", str)
+    )
+
+
+def crosses_reasoning_boundary(pending: dict, content: dict) -> bool:
+    """content 是否在思考内容与正文之间发生了切换"""
+    if content.get("reasoning_content"):
+        return bool(pending.get("text"))
+    if content.get("text"):
+        return bool(pending.get("reasoning_content"))
+    return False
+
+
+async def coalesce_stream(stream, window: float, max_bytes: int):
+    """合并在 window 秒内到达、总计不超过 max_bytes 字节的增量帧
+
+    第一帧、带 finish_reason / tool_calls / 错误的帧立即输出，
+    在思考内容与正文之间切换时先输出已合并的部分。
+    """
+    # 有界队列：客户端消费过慢时 pump 阻塞，背压传递到 worker 连接
+    queue = asyncio.Queue(maxsize=COALESCE_QUEUE_SIZE)
+    done = object()
+
+    async def pump():
+        try:
+            async for item in stream:
+                await queue.put(item)
+        except Exception as e:
+            await queue.put(e)
+        else:
+            await queue.put(done)
+        finally:
+            # 在 queue.put 处被取消时流仍处于挂起状态，需要显式关闭
+            await stream.aclose()
+
+    task = asyncio.create_task(pump())
+    loop = asyncio.get_running_loop()
+    pending = None
+    pending_bytes = 0
+    deadline = 0.0
+    first = True
+    try:
+        while True:
+            if pending is None:
+                item = await queue.get()
+            else:
+                try:
+                    async with asyncio.timeout_at(deadline):
+                        item = await queue.get()
+                except TimeoutError:
+                    yield pending
+                    pending = None
+                    continue
+            if item is done:
+                break
+            if isinstance(item, Exception):
+                raise item
+            if first or not is_coalescable(item):
+                first = False
+                if pending is not None:
+                    yield pending
+                    pending = None
+                yield item
+                continue
+            if pending is not None and crosses_reasoning_boundary(pending, item):
+                yield pending
+                pending = None
+            text = item.get("text", "")
+            reasoning_content = item.get("reasoning_content")
+            size = len(text.encode()) + len((reasoning_content or "").encode())
+            if pending is None:
+                pending = dict(item)
+                pending_bytes = size
+                deadline = loop.time() + window
+            else:
+                pending["text"] = pending.get("text", "") + text
+                if reasoning_content:
+                    # 没有任何思考内容时保持 None，与不合并时的输出一致
+                    pending["reasoning_content"] = (
+                        pending.get("reasoning_content") or ""
+                    ) + reasoning_content
+                if "usage" in item:
+                    pending["usage"] = item["usage"]
+                pending_bytes += size
+            if pending_bytes >= max_bytes:
+                yield pending
+                pending = None
+        if pending is not None:
+            yield pending
+    finally:
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
@@ -71,13 +71,36 @@ def start_controller(controller_host, controller_port, dispatch_method):
     controller_process.start()
 
 
-def start_openai_server(host, port, controller_address, api_keys=None):
+# serve_args 中可选的 openai_api_server 参数，按 --key-name 的形式透传
+openai_server_optional_args = [
+    "worker_max_connections",
+    "worker_max_keepalive",
+    "worker_failure_cooldown",
+    "worker_retries",
+    "embedding_batch_concurrency",
+    "embedding_cache_max_bytes",
+    "embedding_cache_disk_dir",
+    "embedding_cache_disk_max_bytes",
+    "worker_frame_format",
+    "stream_coalesce_window_ms",
+    "stream_coalesce_max_bytes",
+    "routing_mode",
+    "prefix_affinity_load_factor",
+    "max_tokens_policy",
+]
+
+
+def start_openai_server(
+    host, port, controller_address, api_keys=None, extra_args: dict = None
+):
     """Start OpenAI API service"""
     os.environ["FASTCHAT_WORKER_API_EMBEDDING_BATCH_SIZE"] = "100000"
 
     cmd = f"python -m gpt_server.serving.openai_api_server --host {host} --port {port} --controller-address {controller_address}"
     if api_keys:
         cmd += f" --api-keys {api_keys}"
+    for key, value in (extra_args or {}).items():
+        cmd += f" --{key.replace('_', '-')} {value}"
     openai_server_process = Process(target=run_cmd, args=(cmd,))
     openai_server_process.start()
 
@@ -88,6 +111,11 @@ def start_api_server(config: dict):
     port = config["serve_args"]["port"]
     controller_address = config["serve_args"]["controller_address"]
     api_keys = config["serve_args"].get("api_keys", None)
+    extra_args = {
+        key: config["serve_args"][key]
+        for key in openai_server_optional_args
+        if config["serve_args"].get(key, None) is not None
+    }
 
     controller_enable = config["controller_args"].get("enable", True)
     controller_host = config["controller_args"]["host"]
@@ -109,7 +137,7 @@ def start_api_server(config: dict):
         start_controller(controller_host, controller_port, dispatch_method)
     if port not in used_ports and server_enable:
         # Start OpenAI API service
-        start_openai_server(host, port, controller_address, api_keys)
+        start_openai_server(host, port, controller_address, api_keys, extra_args)
     # -----------------------------------------------------------------------
 
 
@@ -172,6 +200,11 @@ def start_model_worker(config: dict):
                     vad_model = engine_config.get("vad_model", "")
                     punc_model = engine_config.get("punc_model", "")
                     task_type = engine_config.get("task_type", "auto")
+                    max_num_seqs = engine_config.get("max_num_seqs", None)
+                    grammar_warmup_schemas = engine_config.get(
+                        "grammar_warmup_schemas", None
+                    )
+                    preprocess_workers = engine_config.get("preprocess_workers", None)
 
                 else:
                     logger.error(
@@ -268,6 +301,12 @@ def start_model_worker(config: dict):
                         cmd += f" --lora '{json.dumps(lora)}'"
                     if max_model_len:
                         cmd += f" --max_model_len '{max_model_len}'"
+                    if grammar_warmup_schemas:
+                        cmd += f" --grammar_warmup_schemas '{json.dumps(grammar_warmup_schemas)}'"
+                    if max_num_seqs:
+                        cmd += f" --max_num_seqs {max_num_seqs}"
+                    if preprocess_workers:
+                        cmd += f" --preprocess_workers {preprocess_workers}"
                     if vad_model:
                         cmd += f" --vad_model '{vad_model}'"
                     if punc_model:
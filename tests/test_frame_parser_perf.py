@@ -0,0 +1,123 @@
+"""worker 流式响应分帧解析的微基准
+
+模拟 10k 路并发流交错到达，每次网络读取携带数量不等的帧（可能在帧中间截断），
+对比旧的 `buffer += chunk` + 切片方式与 FrameReader 的单 token 开销。
+"""
+
+import random
+import time
+
+import orjson
+
+from gpt_server.serving.framing import FrameReader
+
+NUM_STREAMS = 10000
+TOKENS_PER_STREAM = 50
+
+
+def make_frames(stream_id: int):
+    frames = []
+    text = ""
+    for i in range(TOKENS_PER_STREAM):
+        text += "你好"
+        ret = {
+            "text": text[-2:],
+            "error_code": 0,
+            "usage": {"prompt_tokens": 32, "completion_tokens": i + 1},
+            "finish_reason": None,
+        }
+        frames.append(orjson.dumps(ret) + b"\0")
+    return b"".join(frames)
+
+
+def split_reads(data: bytes, rng: random.Random):
+    """把一个流的数据切成随机长度的网络读取"""
+    reads = []
+    pos = 0
+    while pos < len(data):
+        size = rng.choice([64, 512, 4096, 16384])
+        reads.append(data[pos : pos + size])
+        pos += size
+    return reads
+
+
+def legacy_parse(reads):
+    delimiter = b"\0"
+    buffer = b""
+    count = 0
+    for raw_chunk in reads:
+        buffer += raw_chunk
+        while (chunk_end := buffer.find(delimiter)) >= 0:
+            chunk, buffer = buffer[:chunk_end], buffer[chunk_end + 1 :]
+            if not chunk:
+                continue
+            orjson.loads(chunk.decode())
+            count += 1
+    return count
+
+
+def bench(name, streams):
+    # 所有流轮流读取一次，模拟事件循环中大量并发流交错处理
+    start = time.perf_counter()
+    count = 0
+    if name == "legacy":
+        buffers = [b""] * len(streams)
+        cursors = [0] * len(streams)
+        active = list(range(len(streams)))
+        while active:
+            next_active = []
+            for sid in active:
+                reads = streams[sid]
+                raw_chunk = reads[cursors[sid]]
+                cursors[sid] += 1
+                buffer = buffers[sid] + raw_chunk
+                while (chunk_end := buffer.find(b"\0")) >= 0:
+                    chunk, buffer = buffer[:chunk_end], buffer[chunk_end + 1 :]
+                    if chunk:
+                        orjson.loads(chunk.decode())
+                        count += 1
+                buffers[sid] = buffer
+                if cursors[sid] < len(reads):
+                    next_active.append(sid)
+            active = next_active
+    else:
+        readers = [FrameReader() for _ in streams]
+        cursors = [0] * len(streams)
+        active = list(range(len(streams)))
+        while active:
+            next_active = []
+            for sid in active:
+                reads = streams[sid]
+                count += len(readers[sid].feed(reads[cursors[sid]]))
+                cursors[sid] += 1
+                if cursors[sid] < len(reads):
+                    next_active.append(sid)
+            active = next_active
+    elapsed = time.perf_counter() - start
+    print(
+        f"{name:>12}: {count} tokens, {elapsed:.3f}s, "
+        f"{elapsed / count * 1e6:.3f} us/token"
+    )
+    return count
+
+
+if __name__ == "__main__":
+    rng = random.Random(0)
+    data = make_frames(0)
+    streams = [split_reads(data, rng) for _ in range(NUM_STREAMS)]
+    legacy_count = bench("legacy", streams)
+    reader_count = bench("FrameReader", streams)
+    assert legacy_count == reader_count == NUM_STREAMS * TOKENS_PER_STREAM
+
+    # 单次读取携带大量帧时旧实现退化为平方复杂度
+    big = data * 200
+    start = time.perf_counter()
+    legacy_parse([big])
+    legacy_time = time.perf_counter() - start
+    start = time.perf_counter()
+    FrameReader().feed(big)
+    reader_time = time.perf_counter() - start
+    print(
+        f"single read with {TOKENS_PER_STREAM * 200} frames: "
+        f"legacy {legacy_time:.3f}s, FrameReader {reader_time:.3f}s"
+    )
@@ -0,0 +1,131 @@
+"""HF 后端连续批处理的 CPU 测试
+
+使用随机初始化的小型 Llama 模型，无需下载权重：
+1. 贪心解码时，并发请求（含中途加入批次的请求）的输出与逐个 model.generate 一致
+2. 关闭生成器后，序列在下一步被移出批次
+3. 对比逐个生成与连续批处理的吞吐
+"""
+
+import asyncio
+import time
+
+import torch
+from transformers import LlamaConfig, LlamaForCausalLM
+
+from gpt_server.model_backend.hf_batching import ContinuousBatchingEngine
+
+VOCAB_SIZE = 256
+EOS_TOKEN_ID = 2
+MAX_NEW_TOKENS = 32
+
+
+class ByteTokenizer:
+    """每个 token id 对应一个字符"""
+
+    eos_token_id = EOS_TOKEN_ID
+
+    def decode(self, token_ids, skip_special_tokens=True):
+        return "".join(chr(ord("a") + i % 26) for i in token_ids)
+
+
+def build_model():
+    torch.manual_seed(0)
+    config = LlamaConfig(
+        vocab_size=VOCAB_SIZE,
+        hidden_size=64,
+        intermediate_size=128,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        eos_token_id=EOS_TOKEN_ID,
+    )
+    return LlamaForCausalLM(config).eval()
+
+
+def make_prompts(num: int):
+    generator = torch.Generator().manual_seed(1)
+    return [
+        torch.randint(3, VOCAB_SIZE, (4 + 3 * i,), generator=generator).tolist()
+        for i in range(num)
+    ]
+
+
+def reference_generate(model, prompt):
+    with torch.inference_mode():
+        output = model.generate(
+            torch.tensor([prompt]),
+            attention_mask=torch.ones(1, len(prompt), dtype=torch.long),
+            max_new_tokens=MAX_NEW_TOKENS,
+            do_sample=False,
+            eos_token_id=EOS_TOKEN_ID,
+            pad_token_id=EOS_TOKEN_ID,
+        )
+    return output[0, len(prompt) :].tolist()
+
+
+async def collect(engine, prompt, delay=0.0):
+    await asyncio.sleep(delay)
+    token_ids = []
+    async for output in engine.generate(
+        prompt, max_new_tokens=MAX_NEW_TOKENS, temperature=0.0
+    ):
+        token_ids.append(output["token_id"])
+    return token_ids
+
+
+async def check_matches_generate(model, engine):
+    prompts = make_prompts(6)
+    # 后 3 个请求在前面的请求解码过程中加入批次
+    outputs = await asyncio.gather(
+        *[
+            collect(engine, prompt, delay=0.01 * (i // 3))
+            for i, prompt in enumerate(prompts)
+        ]
+    )
+    for prompt, output in zip(prompts, outputs):
+        assert output == reference_generate(model, prompt), (prompt, output)
+    print("batched outputs match model.generate")
+
+
+async def check_cancel(engine):
+    prompt = make_prompts(1)[0]
+    stream = engine.generate(prompt, max_new_tokens=10000, temperature=0.0)
+    count = 0
+    async for _ in stream:
+        count += 1
+        if count == 5:
+            break
+    await stream.aclose()
+    steps = engine.steps
+    await asyncio.sleep(0.2)
+    assert engine.get_metrics()["running"] == 0
+    assert engine.steps - steps <= 1
+    print("cancelled sequence removed from the batch")
+
+
+async def bench(model, engine, num: int):
+    prompts = make_prompts(num)
+    start = time.perf_counter()
+    for prompt in prompts:
+        reference_generate(model, prompt)
+    sequential_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    await asyncio.gather(*[collect(engine, prompt) for prompt in prompts])
+    batched_time = time.perf_counter() - start
+    print(
+        f"{num} requests: sequential {sequential_time:.2f}s, "
+        f"continuous batching {batched_time:.2f}s"
+    )
+
+
+async def main():
+    model = build_model()
+    engine = ContinuousBatchingEngine(model, ByteTokenizer(), max_batch_size=8)
+    await check_matches_generate(model, engine)
+    await check_cancel(engine)
+    await bench(model, engine, 16)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
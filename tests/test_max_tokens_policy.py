@@ -0,0 +1,100 @@
+"""max_tokens_policy 的上下文长度检查
+
+不需要启动 worker：直接向 API server 的本地注册表写入模型和 ModelInfo，
+流式请求在通过检查后只返回 StreamingResponse，不会连接 worker。
+"""
+
+import asyncio
+
+import pytest
+from fastapi.responses import JSONResponse, StreamingResponse
+
+from gpt_server.openai_api_protocol.custom_api_protocol import (
+    CustomChatCompletionRequest,
+)
+from gpt_server.serving import openai_api_server as server
+from gpt_server.serving.model_info import ModelInfo
+
+MODEL = "test-model"
+CONTEXT_LENGTH = 64
+# 模块中 /api/v1/chat/completions 的同名函数覆盖了 /v1/chat/completions，从路由中取
+create_chat_completion = next(
+    route.endpoint
+    for route in server.app.routes
+    if getattr(route, "path", None) == "/v1/chat/completions"
+)
+
+
+class WhitespaceTokenizer:
+    """每个空格分隔的单词是一个 token，没有 chat template"""
+
+    chat_template = None
+
+    def __call__(self, prompts):
+        class Encoding:
+            input_ids = [prompt.split() for prompt in prompts]
+
+        return Encoding()
+
+
+@pytest.fixture
+def policy(monkeypatch):
+    server.worker_registry.apply_snapshot(
+        {
+            "workers": {
+                "http://worker": {
+                    "model_names": [MODEL],
+                    "speed": 1,
+                    "queue_length": 0,
+                    "multimodal": False,
+                }
+            },
+            "version": 0,
+        }
+    )
+    monkeypatch.setitem(
+        server.model_info_registry.infos,
+        MODEL,
+        ModelInfo(CONTEXT_LENGTH, WhitespaceTokenizer()),
+    )
+
+    def set_policy(value: str):
+        monkeypatch.setattr(server.app_settings, "max_tokens_policy", value)
+
+    return set_policy
+
+
+def chat(max_tokens=None, prompt_tokens=CONTEXT_LENGTH - 4):
+    request = CustomChatCompletionRequest(
+        model=MODEL,
+        messages=[{"role": "user", "content": " ".join(["word"] * prompt_tokens)}],
+        max_tokens=max_tokens,
+        stream=True,
+    )
+    return asyncio.run(create_chat_completion(request))
+
+
+@pytest.mark.parametrize("value", ["reject", "clamp"])
+def test_unset_max_tokens_near_limit_is_accepted(policy, value):
+    policy(value)
+    assert isinstance(chat(), StreamingResponse)
+
+
+def test_reject_explicit_max_tokens_over_limit(policy):
+    policy("reject")
+    response = chat(max_tokens=16)
+    assert isinstance(response, JSONResponse)
+    assert response.status_code == 400
+
+
+def test_reject_prompt_over_limit(policy):
+    policy("reject")
+    response = chat(prompt_tokens=CONTEXT_LENGTH + 1)
+    assert isinstance(response, JSONResponse)
+
+
+def test_fit_max_tokens_clamp(policy):
+    policy("clamp")
+    assert server.fit_max_tokens(100, 40, None) == (None, None)
+    assert server.fit_max_tokens(100, 40, 80) == (60, None)
+    assert server.fit_max_tokens(100, 40, 10) == (10, None)
@@ -0,0 +1,98 @@
+"""预处理进程池的基准
+
+并发分词多个长 prompt，同时用一个定时任务测量事件循环的最大延迟：
+线程中分词会和事件循环争抢 GIL，进程池中分词时事件循环基本不受影响。
+使用本地训练的小型 BPE tokenizer，无需下载模型；同时校验共享内存传回的 token ids 与直接分词一致。
+"""
+
+import asyncio
+import random
+import tempfile
+import time
+
+from tokenizers import Tokenizer, models, pre_tokenizers, trainers
+from transformers import AutoTokenizer, PreTrainedTokenizerFast
+
+from gpt_server.model_worker.base.preprocess_pool import (
+    SHM_MIN_IDS,
+    PreprocessPool,
+    render_prompt,
+)
+
+NUM_PROMPTS = 8
+WORDS_PER_PROMPT = 100000
+
+
+def build_tokenizer(path: str, words):
+    tokenizer = Tokenizer(models.BPE(unk_token="[UNK]"))
+    tokenizer.pre_tokenizer = pre_tokenizers.Whitespace()
+    trainer = trainers.BpeTrainer(vocab_size=2000, special_tokens=["[UNK]"])
+    tokenizer.train_from_iterator([" ".join(words)], trainer)
+    PreTrainedTokenizerFast(tokenizer_object=tokenizer).save_pretrained(path)
+
+
+async def max_loop_latency(stop: asyncio.Event, interval: float = 0.001):
+    """事件循环的最大调度延迟"""
+    latency = 0.0
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        latency = max(latency, time.perf_counter() - start - interval)
+    return latency
+
+
+async def measure(tokenize, prompts):
+    stop = asyncio.Event()
+    monitor = asyncio.create_task(max_loop_latency(stop))
+    start = time.perf_counter()
+    results = await asyncio.gather(*[tokenize(prompt) for prompt in prompts])
+    elapsed = time.perf_counter() - start
+    stop.set()
+    return results, elapsed, await monitor
+
+
+async def main():
+    rng = random.Random(0)
+    vocab = ["".join(rng.choice("abcdefgh") for _ in range(5)) for _ in range(5000)]
+    prompts = [
+        " ".join(rng.choice(vocab) for _ in range(WORDS_PER_PROMPT))
+        for _ in range(NUM_PROMPTS)
+    ]
+    with tempfile.TemporaryDirectory() as path:
+        build_tokenizer(path, vocab)
+        tokenizer = AutoTokenizer.from_pretrained(path)
+        pool = PreprocessPool(path, num_workers=4)
+
+        async def thread_tokenize(prompt):
+            return await asyncio.to_thread(
+                render_prompt, None, tokenizer, prompt, None, True, {}
+            )
+
+        async def pool_tokenize(prompt):
+            return await pool.render_prompt(None, prompt, tokenize=True)
+
+        # 等待子进程启动并加载 tokenizer
+        await pool_tokenize("warmup")
+
+        thread_results, thread_time, thread_latency = await measure(
+            thread_tokenize, prompts
+        )
+        pool_results, pool_time, pool_latency = await measure(pool_tokenize, prompts)
+        pool.shutdown()
+
+    assert thread_results == pool_results
+    assert len(pool_results[0][1]) >= SHM_MIN_IDS
+    num_tokens = sum(len(input_ids) for _, input_ids in pool_results)
+    print(f"{NUM_PROMPTS} prompts, {num_tokens} tokens")
+    print(
+        f"asyncio.to_thread: {thread_time:.2f}s, "
+        f"max event loop latency {thread_latency * 1000:.1f} ms"
+    )
+    print(
+        f"PreprocessPool:    {pool_time:.2f}s, "
+        f"max event loop latency {pool_latency * 1000:.1f} ms"
+    )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,100 @@
+"""chat template 渲染缓存的基准
+
+模拟多轮 agent 请求：30 个 tools，每轮在历史消息后追加 assistant(tool_calls) + tool + user 消息。
+对比每次清空缓存后渲染与命中缓存时的耗时，并校验两者渲染结果一致。
+"""
+
+import copy
+import time
+
+from gpt_server.model_handler.prompts import MODELS
+
+NUM_TOOLS = 30
+NUM_TURNS = 20
+
+tools = [
+    {
+        "type": "function",
+        "function": {
+            "name": f"tool_{i}",
+            "description": f"工具 {i} 的说明，" * 10,
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "query": {"type": "string", "description": "查询内容"},
+                    "limit": {"type": "integer", "description": "返回数量"},
+                },
+                "required": ["query"],
+            },
+        },
+    }
+    for i in range(NUM_TOOLS)
+]
+
+
+def make_conversations():
+    """返回每一轮请求的 messages"""
+    messages = [
+        {"role": "system", "content": "你是一个会使用工具的助手。"},
+        {"role": "user", "content": "帮我查一下资料"},
+    ]
+    conversations = [copy.deepcopy(messages)]
+    for turn in range(NUM_TURNS):
+        messages += [
+            {
+                "role": "assistant",
+                "content": "",
+                "tool_calls": [
+                    {
+                        "id": f"call_{turn}",
+                        "type": "function",
+                        "function": {
+                            "name": f"tool_{turn % NUM_TOOLS}",
+                            "arguments": '{"query": "资料", "limit": 3}',
+                        },
+                    }
+                ],
+            },
+            {"role": "tool", "content": f"第 {turn} 次查询的结果" * 20},
+            {"role": "user", "content": f"继续第 {turn} 步"},
+        ]
+        conversations.append(copy.deepcopy(messages))
+    return conversations
+
+
+def bench(name: str):
+    chat_template = MODELS.module_dict[name]()
+    conversations = make_conversations()
+    # messages2prompt 可能修改传入的 messages，每次都传入副本
+    inputs = [
+        (copy.deepcopy(messages), copy.deepcopy(tools))
+        for messages in conversations
+        for _ in range(2)
+    ]
+
+    cold_inputs, warm_inputs = copy.deepcopy(inputs), copy.deepcopy(inputs)
+
+    cold_prompts = []
+    start = time.perf_counter()
+    for messages, request_tools in cold_inputs:
+        chat_template.init_prompt_cache()
+        cold_prompts.append(chat_template.messages2prompt(messages, True, request_tools))
+    cold_time = time.perf_counter() - start
+
+    chat_template.init_prompt_cache()
+    warm_prompts = []
+    start = time.perf_counter()
+    for messages, request_tools in warm_inputs:
+        warm_prompts.append(chat_template.messages2prompt(messages, True, request_tools))
+    warm_time = time.perf_counter() - start
+    assert cold_prompts == warm_prompts
+
+    print(f"{name}: {len(inputs)} requests, {NUM_TOOLS} tools")
+    print(f"  no cache: {cold_time / len(inputs) * 1e6:.0f} us/request")
+    print(f"  cached:   {warm_time / len(inputs) * 1e6:.0f} us/request")
+    print(f"  {chat_template.prompt_cache_metrics()}")
+
+
+if __name__ == "__main__":
+    bench("qwen2_5")
+    bench("glm4")
@@ -0,0 +1,97 @@
+"""chat 流式输出 SSE 序列化的基准
+
+对比每个 token 构造 pydantic 对象再 model_dump_json 的旧方式与 ChatChunkSerializer，
+同时校验两者输出逐字节一致。
+"""
+
+import time
+
+from gpt_server.openai_api_protocol.custom_api_protocol import (
+    CustomChatCompletionStreamResponse,
+    CustomChatCompletionResponseStreamChoice,
+    CustomDeltaMessage,
+)
+from gpt_server.serving.sse import ChatChunkSerializer
+
+NUM_TOKENS = 100000
+ID = "chatcmpl-3Kx9bQ2mLpZ7"
+MODEL = "qwen"
+
+
+def make_contents():
+    contents = []
+    for i in range(NUM_TOKENS):
+        contents.append(
+            {
+                "text": ["你好", " world", '"quoted"\n', "\\t"][i % 4],
+                "error_code": 0,
+                "usage": {
+                    "prompt_tokens": 128,
+                    "completion_tokens": i + 1,
+                    "total_tokens": 129 + i,
+                },
+                "finish_reason": None,
+                "reasoning_content": "思考" if i % 5 == 0 else None,
+            }
+        )
+    contents[-1]["finish_reason"] = "stop"
+    contents[-1]["tool_calls"] = [
+        {"id": "call_0", "type": "function", "function": {"name": "f", "arguments": "{}"}}
+    ]
+    return contents
+
+
+def pydantic_chunk(content, created):
+    choice_data = CustomChatCompletionResponseStreamChoice(
+        index=0,
+        delta=CustomDeltaMessage(
+            role="assistant",
+            content=content.get("text", ""),
+            tool_calls=content.get("tool_calls", None),
+            reasoning_content=content.get("reasoning_content", None),
+        ),
+        finish_reason=content.get("finish_reason", "stop"),
+    )
+    chunk = CustomChatCompletionStreamResponse(
+        id=ID,
+        choices=[choice_data],
+        model=MODEL,
+        usage=content.get("usage", None),
+        created=created,
+        object="chat.completion.chunk",
+    )
+    return f"data: {chunk.model_dump_json(exclude_unset=True)}\n\n".encode()
+
+
+def fast_chunk(serializer, content):
+    return serializer.serialize(
+        0,
+        content.get("text", ""),
+        content.get("tool_calls", None),
+        content.get("reasoning_content", None),
+        content.get("finish_reason", "stop"),
+        content.get("usage", None),
+    )
+
+
+if __name__ == "__main__":
+    contents = make_contents()
+    created = int(time.time())
+    serializer = ChatChunkSerializer(ID, MODEL, created)
+    for content in contents[:1000] + contents[-1:]:
+        assert pydantic_chunk(content, created) == fast_chunk(serializer, content)
+
+    start = time.perf_counter()
+    for content in contents:
+        pydantic_chunk(content, int(time.time()))
+    pydantic_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    serializer = ChatChunkSerializer(ID, MODEL)
+    for content in contents:
+        fast_chunk(serializer, content)
+    fast_time = time.perf_counter() - start
+
+    print(f"pydantic:            {NUM_TOKENS / pydantic_time:,.0f} tokens/s")
+    print(f"ChatChunkSerializer: {NUM_TOKENS / fast_time:,.0f} tokens/s")
+    print(f"speedup: {pydantic_time / fast_time:.1f}x")
@@ -0,0 +1,117 @@
+"""流式停止词匹配的基准
+
+对比逐个停止词在累计文本上查找（并用 is_partial_stop 判断是否扣留末尾）的方式与 StopMatcher，
+同时用随机文本和随机切分校验两者的输出一致。
+"""
+
+import random
+import string
+import time
+
+from gpt_server.model_backend.utils import get_stop_matcher
+
+NUM_STOP_WORDS = 200
+NUM_STREAMS = 50
+TOKENS_PER_STREAM = 500
+
+
+def is_partial_stop(output: str, stop_str: str):
+    """output 的末尾是否是 stop_str 的前缀（与 fastchat.utils.is_partial_stop 相同）"""
+    for i in range(0, min(len(output), len(stop_str))):
+        if stop_str.startswith(output[-i:]):
+            return True
+    return False
+
+
+def naive_stream(chunks, stop_words):
+    """每个增量文本都在累计文本上查找全部停止词"""
+    output = ""
+    sent = 0
+    text = ""
+    for chunk in chunks:
+        text += chunk
+        positions = [
+            text.find(stop) + len(stop) for stop in stop_words if stop in text
+        ]
+        if positions:
+            end = min(positions)
+            # 截断到最早结束的停止词之前（同一位置结束的取最长的停止词）
+            start = min(
+                end - len(stop)
+                for stop in stop_words
+                if stop in text and text.find(stop) + len(stop) == end
+            )
+            output += text[sent:start]
+            return output, True
+        # 扣留末尾可能是停止词前缀的最长部分
+        hold = 0
+        for stop in stop_words:
+            if is_partial_stop(text, stop):
+                for i in range(min(len(text), len(stop) - 1), 0, -1):
+                    if stop.startswith(text[-i:]):
+                        hold = max(hold, i)
+                        break
+        output += text[sent : len(text) - hold]
+        sent = len(text) - hold
+    return output + text[sent:], False
+
+
+def matcher_stream(chunks, stop_words):
+    stop_stream = get_stop_matcher(stop_words).stream()
+    output = ""
+    for chunk in chunks:
+        text, stopped = stop_stream.feed(chunk)
+        output += text
+        if stopped:
+            return output, True
+    return output + stop_stream.flush(), False
+
+
+def make_streams(rng: random.Random, alphabet: str, stop_words, num_streams: int):
+    streams = []
+    for _ in range(num_streams):
+        chunks = [
+            "".join(rng.choice(alphabet) for _ in range(rng.randint(1, 4)))
+            for _ in range(TOKENS_PER_STREAM)
+        ]
+        if rng.random() < 0.5:
+            # 在随机位置插入一个停止词，并把它拆到多个增量文本中
+            stop = rng.choice(stop_words)
+            pos = rng.randrange(len(chunks))
+            chunks[pos : pos + 1] = [stop[: len(stop) // 2], stop[len(stop) // 2 :]]
+        streams.append(chunks)
+    return streams
+
+
+if __name__ == "__main__":
+    rng = random.Random(0)
+    # 小字母表上的随机校验，部分匹配与重叠的停止词很常见
+    for _ in range(2000):
+        stop_words = [
+            "".join(rng.choice("ab") for _ in range(rng.randint(1, 5)))
+            for _ in range(3)
+        ]
+        stream = make_streams(rng, "abc", stop_words, 1)[0][:20]
+        expected = naive_stream(stream, stop_words)
+        assert expected == matcher_stream(stream, stop_words), (stream, stop_words)
+
+    stop_words = [
+        "".join(rng.choice(string.ascii_letters) for _ in range(rng.randint(4, 12)))
+        for _ in range(NUM_STOP_WORDS)
+    ]
+    streams = make_streams(rng, string.ascii_letters + " ", stop_words, NUM_STREAMS)
+    num_tokens = sum(len(chunks) for chunks in streams)
+
+    start = time.perf_counter()
+    naive_results = [naive_stream(chunks, stop_words) for chunks in streams]
+    naive_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    matcher_results = [matcher_stream(chunks, stop_words) for chunks in streams]
+    matcher_time = time.perf_counter() - start
+    assert naive_results == matcher_results
+
+    print(f"{NUM_STOP_WORDS} stop words, {num_tokens} tokens")
+    print(f"naive:       {naive_time / num_tokens * 1e6:.2f} us/token")
+    print(f"StopMatcher: {matcher_time / num_tokens * 1e6:.2f} us/token")
+    print(f"speedup: {naive_time / matcher_time:.1f}x")